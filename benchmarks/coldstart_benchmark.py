@@ -0,0 +1,71 @@
+"""
+Cold start cost of a run: every measurement is a fresh interpreter, which
+imports flatscrape and builds what main() builds before scraping (state,
+caches, tenants, pipeline) for the sample event. Also lists the optional
+modules that were loaded, none should be before they are used.
+
+    python benchmarks/coldstart_benchmark.py [runs] [--importtime]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+FLATSCRAPE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "flatscrape")
+OPTIONAL_MODULES = ["telegram", "deep_translator", "geopy", "numpy"]
+
+COLD_START = f"""
+import json, sys, time
+start = time.perf_counter()
+import flatscrape
+imported = time.perf_counter()
+from cache import ResponseCache
+from geocoding import Geocoder
+from tenants import load_tenants
+from translation import Translator
+from transport import TelegramTransport
+import seenoffers
+with open("sampleEvent.json") as f:
+    event = json.load(f)
+seenOffers = seenoffers.load_seen_offers({{}})
+responseCache = ResponseCache.from_serializable({{}})
+geocoder = Geocoder.from_serializable({{}})
+translator = Translator()
+tenants = load_tenants(event, {{}}, geocoder, TelegramTransport(None))
+pipeline = flatscrape.build_pipeline(tenants, geocoder, translator)
+pipeline.close()
+initialised = time.perf_counter()
+print(json.dumps({{"import": imported - start, "init": initialised - imported,
+                  "loaded": [m for m in {OPTIONAL_MODULES!r} if m in sys.modules]}}))
+"""
+
+def cold_start():
+    result = subprocess.run([sys.executable, "-c", COLD_START], cwd=FLATSCRAPE,\
+        capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def import_times(top=10):
+    """The modules with the largest cumulative import time in microseconds."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import flatscrape"],\
+        cwd=FLATSCRAPE, capture_output=True, text=True, check=True)
+    times = []
+    for line in result.stderr.splitlines()[1:]:
+        _, cumulative, name = line.split("|")
+        times.append((int(cumulative), name.rstrip()))
+    return sorted(times, reverse=True)[:top]
+
+def main(runs=10, importtime=False):
+    results = [cold_start() for _ in range(runs)]
+    for phase in ["import", "init"]:
+        samples = [r[phase] * 1000 for r in results]
+        print(f"{phase:7} median {statistics.median(samples):7.1f} ms, "
+              f"min {min(samples):7.1f} ms, max {max(samples):7.1f} ms")
+    print(f"optional modules loaded: {', '.join(results[-1]['loaded']) or 'none'}")
+    if importtime:
+        for cumulative, name in import_times():
+            print(f"{cumulative / 1000:8.1f} ms {name}")
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    main(*map(int, args), importtime="--importtime" in sys.argv)
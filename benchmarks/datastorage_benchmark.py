@@ -0,0 +1,104 @@
+"""
+Memory per advert and field access speed of the slotted data storage
+records, through the field views and with get_value, compared with the
+previous layout (one DataField per field in the instance dict), and the
+cost of the validation modes.
+
+    python benchmarks/datastorage_benchmark.py [adverts]
+"""
+import datetime as dt
+import sys
+import time
+import tracemalloc
+import standins
+import DataStorage
+from advert import Advert, AdvertNoPrint
+
+class DataField():
+    """One object per field, as in the previous layout."""
+    def __init__(self, expectedTypes=[object]):
+        self.expectedTypes = expectedTypes
+        self.isset = False
+        self.val = None
+    def __bool__(self):
+        return self.isset
+    def set(self, val):
+        if not any(map(lambda t: isinstance(val, t), self.expectedTypes)):
+            raise TypeError(f"Type {type(val)} not supported")
+        self.val = val
+        self.isset = True
+    def get(self):
+        if not self.isset:
+            raise AttributeError(f"Cannot get unitialized data field value.")
+        return self.val
+
+def legacy_storage_class(classname, dataTypes):
+    """The layout before the slotted records, for comparison."""
+    class LegacyStorage():
+        def __init__(self):
+            self.__dict__.update({t: DataField(dataTypes[t]) for t in dataTypes})
+        def __getattr__(self, name):
+            if not name in self.__dict__:
+                raise ValueError(f"Field `{name}` cannot be stored.")
+            return self.__dict__[name]
+    LegacyStorage.__name__ = classname
+    return LegacyStorage
+
+LegacyAdvert = legacy_storage_class("LegacyAdvert",\
+    {name: list(types) for (name, types) in\
+     zip(AdvertNoPrint._fieldNames, AdvertNoPrint._expectedTypes)})
+
+def fill(advert, i):
+    advert.adid.set(i)
+    advert.url.set(f"https://www.wg-gesucht.de/{i}.html")
+    advert.website.set("https://www.wg-gesucht.de")
+    advert.title.set(f"Wohnung {i}")
+    advert.address.set(f"Strasse {i}")
+    advert.flatType.set("Individual Apartment")
+    advert.price.set(500 + i % 500)
+    advert.size.set(20 + i % 80)
+    advert.limited.set(bool(i % 2))
+    advert.moveInDate.set(dt.datetime(2023, 1 + i % 12, 1))
+    return advert
+
+def memory_per_advert(advertClass, numAdverts):
+    tracemalloc.start()
+    adverts = [fill(advertClass(), i) for i in range(numAdverts)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current / numAdverts
+
+def access_time(adverts):
+    start = time.perf_counter()
+    total = 0
+    for advert in adverts:
+        if advert.price and advert.size:
+            total += advert.price.get() + advert.size.get()
+    return (time.perf_counter() - start) / len(adverts)
+
+def set_time(advertClass, numAdverts):
+    start = time.perf_counter()
+    for i in range(numAdverts):
+        fill(advertClass(), i)
+    return (time.perf_counter() - start) / numAdverts
+
+def main(numAdverts=20000):
+    print(f"{'layout':<22}{'bytes/advert':>14}{'create+fill us':>16}{'read us':>10}")
+    for name, advertClass in [("legacy DataField", LegacyAdvert), ("slotted record", Advert)]:
+        memory = memory_per_advert(advertClass, numAdverts)
+        adverts = [fill(advertClass(), i) for i in range(numAdverts)]
+        print(f"{name:<22}{memory:>14.0f}{set_time(advertClass, numAdverts) * 1e6:>16.2f}"
+              f"{access_time(adverts) * 1e6:>10.3f}")
+    adverts = [fill(Advert(), i) for i in range(numAdverts)]
+    start = time.perf_counter()
+    for advert in adverts:
+        advert.get_value("price", 0) + advert.get_value("size", 0)
+    print(f"{'record get_value':<22}{'':>14}{'':>16}"
+          f"{(time.perf_counter() - start) / numAdverts * 1e6:>10.3f}")
+    for mode in DataStorage.VALIDATION_MODES:
+        DataStorage.validationMode = mode
+        print(f"validation {mode:<11}{'':>14}{set_time(Advert, numAdverts) * 1e6:>16.2f}")
+    DataStorage.validationMode = "strict"
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
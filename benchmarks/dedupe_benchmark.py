@@ -0,0 +1,106 @@
+"""
+Duplicate detection on a growing index: every flat is listed once, a share
+of them again on the other site or reposted with a slightly changed title
+or price. Each site has its own text: wg-gesucht adverts have no
+description and the street address, ebay ones a description of their own
+and only postcode and district. Some distinct flats share the title of an
+earlier one, as agencies list many flats with the same text. Reports the
+lookup time per advert as the index grows, the reposts found and the
+distinct flats wrongly dropped.
+
+    python benchmarks/dedupe_benchmark.py [flats] [repost share]
+"""
+import random
+import sys
+import time
+import standins
+from advert import Advert
+from duplicates import DuplicateIndex
+
+WORDS = ["schoene", "helle", "ruhige", "moeblierte", "zimmer", "wohnung", "altbau",
+         "balkon", "neubau", "dachgeschoss", "wg", "mitte", "kreuzberg", "neukoelln",
+         "friedrichshain", "pankow", "nahe", "park", "ubahn", "zentral", "familie",
+         "studenten", "befristet", "unbefristet", "tausch", "kueche", "bad", "garten"]
+STREETS = ["strasse", "weg", "allee", "platz", "ring"]
+DISTRICTS = ["Mitte", "Kreuzberg", "Neukoelln", "Friedrichshain", "Pankow", "Wedding",
+             "Moabit", "Charlottenburg", "Schoeneberg", "Lichtenberg"]
+# share of distinct flats with the title of an earlier flat
+SHARED_TITLE_SHARE = 0.1
+SYLLABLES = ["ber", "lin", "wo", "nung", "zim", "mer", "haus", "stra", "sse", "platz",
+             "gar", "ten", "kue", "che", "bal", "kon", "hof", "alt", "neu", "bau"]
+
+def vocabulary(rng, size=2000):
+    """The common words and made up ones, so texts differ like real ones."""
+    return WORDS + ["".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))\
+                    for _ in range(size)]
+
+def random_flat(rng, words, flats):
+    title = " ".join(rng.choice(words) for _ in range(rng.randint(5, 9)))
+    if flats and rng.random() < SHARED_TITLE_SHARE:
+        title = rng.choice(flats)["title"]
+    return {
+        "title": title,
+        "street": f"{rng.choice(words).title()}{rng.choice(STREETS)} {rng.randint(1, 200)}",
+        "postcode": rng.randint(10115, 14199),
+        "district": rng.choice(DISTRICTS),
+        "price": rng.randint(300, 1500),
+        "size": rng.randint(10, 90),
+    }
+
+def repost(rng, flat):
+    """The same flat, listed again with small changes."""
+    changed = dict(flat)
+    words = flat["title"].split()
+    if rng.random() < 0.5:
+        words[rng.randrange(len(words))] = rng.choice(WORDS)
+    changed["title"] = " ".join(words)
+    if rng.random() < 0.5:
+        changed["price"] = int(flat["price"] * rng.uniform(0.98, 1.02))
+    return changed
+
+def make_advert(rng, words, flat, site, adid):
+    """The advert of a flat as the site shows it."""
+    advert = Advert()
+    advert.adid.set(adid)
+    if site == "wggesucht":
+        advert.website.set("https://www.wg-gesucht.de")
+        advert.address.set(f"{flat['street']}, Berlin {flat['district']}")
+    else:
+        advert.website.set("https://www.ebay-kleinanzeigen.de")
+        advert.address.set(f"{flat['postcode']} Berlin - {flat['district']}")
+        advert.description.set(" ".join(rng.choice(words)\
+                                        for _ in range(rng.randint(30, 80))))
+    for field in ["title", "price", "size"]:
+        getattr(advert, field).set(flat[field])
+    return advert
+
+def main(numFlats=20000, repostShare=0.2):
+    rng = random.Random(0)
+    index = DuplicateIndex()
+    words = vocabulary(rng)
+    flats = []
+    for _ in range(numFlats):
+        flats.append(random_flat(rng, words, flats))
+    reposts = set(rng.sample(range(numFlats), int(numFlats * repostShare)))
+    falseDrops = found = 0
+    times = []
+    for i, flat in enumerate(flats):
+        site = rng.choice(["wggesucht", "ebay"])
+        advert = make_advert(rng, words, flat, site, i)
+        start = time.perf_counter()
+        if index.check(advert, "user") is not None:
+            falseDrops += 1
+        times.append(time.perf_counter() - start)
+        if i in reposts:
+            site = rng.choice(["wggesucht", "ebay"])
+            found += index.check(make_advert(rng, words, repost(rng, flat), site,\
+                                             numFlats + i), "user") is not None
+    window = max(numFlats // 10, 1)
+    for end in [window, numFlats // 2, numFlats]:
+        part = times[max(end - window, 0):end]
+        print(f"index {end:6}: {sum(part) / len(part) * 1e6:7.1f} us per lookup")
+    print(f"reposts found {found}/{len(reposts)}, distinct flats dropped {falseDrops}")
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(*([int(args[0])] if args else []), *map(float, args[1:]))
@@ -0,0 +1,48 @@
+"""
+Compare the per pair geodesic loop (geopy.distance.distance, as used before)
+with the vectorised haversine distance matrix, and report the largest
+relative error of the approximation.
+
+    python benchmarks/distance_benchmark.py [adverts] [pois]
+"""
+import random
+import sys
+import time
+import geopy.distance
+import standins
+import distances
+
+# bounding box around Berlin
+LAT_RANGE = (52.35, 52.68)
+LON_RANGE = (13.08, 13.76)
+
+def random_points(rng, n):
+    return [(rng.uniform(*LAT_RANGE), rng.uniform(*LON_RANGE)) for _ in range(n)]
+
+def geodesic_loop(points, pois):
+    return [[geopy.distance.distance(poi, point).km for poi in pois] for point in points]
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def main(numAdverts=500, numPois=20):
+    rng = random.Random(0)
+    points, pois = random_points(rng, numAdverts), random_points(rng, numPois)
+    # numpy is imported lazily, not part of the timed call
+    hasNumpy = distances.load_numpy() is not None
+    loopTime, exact = timed(geodesic_loop, points, pois)
+    matrixTime, approx = timed(distances.distance_matrix, points, pois)
+    pythonTime, _ = timed(distances._distance_matrix_python, points, pois)
+    maxError = max(abs(a - e) / e for (rowA, rowE) in zip(approx, exact)\
+                   for (a, e) in zip(rowA, rowE) if e > 0)
+    print(f"{numAdverts} adverts x {numPois} POIs")
+    print(f"geodesic loop       {loopTime * 1000:10.1f} ms")
+    print(f"haversine (python)  {pythonTime * 1000:10.1f} ms")
+    print(f"haversine matrix    {matrixTime * 1000:10.1f} ms"
+          f"{'' if hasNumpy else ' (numpy not installed)'}")
+    print(f"max relative error  {maxError * 100:10.3f} %")
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,64 @@
+"""
+Match adverts against many search profiles: every advert against every
+profile with filter_advert, versus the compiled predicates alone and the
+ProfileIndex. All three must find the same matches.
+
+    python benchmarks/filter_benchmark.py [profiles] [adverts]
+"""
+import datetime as dt
+import random
+import sys
+import time
+import standins
+from advert import Advert, filter_advert
+from DataStorage import SearchParameters
+from filters import ProfileIndex, compile_filter
+
+def random_date(rng):
+    return dt.datetime(2023, 1, 1) + dt.timedelta(days=rng.randint(0, 365))
+
+def random_profile(rng):
+    profile = SearchParameters({})
+    profile.maxPrice = rng.randint(300, 2000)
+    profile.minSize = rng.randint(0, 80)
+    if rng.random() < 0.5:
+        profile.moveInLower = random_date(rng)
+        profile.moveInUpper = profile.moveInLower + dt.timedelta(days=rng.randint(10, 120))
+    return profile
+
+def random_advert(rng):
+    advert = Advert()
+    advert.price.set(rng.randint(200, 2500))
+    advert.size.set(rng.randint(10, 120))
+    if rng.random() < 0.8:
+        advert.moveInDate.set(random_date(rng))
+    return advert
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+def main(numProfiles=1000, numAdverts=1000):
+    rng = random.Random(0)
+    profiles = {i: random_profile(rng) for i in range(numProfiles)}
+    adverts = [random_advert(rng) for _ in range(numAdverts)]
+
+    naiveTime, naive = timed(lambda: [sorted(key for (key, profile) in profiles.items()
+                                             if filter_advert(advert, profile))
+                                      for advert in adverts])
+    predicates = {key: compile_filter(profile) for (key, profile) in profiles.items()}
+    compiledTime, compiled = timed(lambda: [sorted(key for (key, predicate) in predicates.items()
+                                                   if predicate(advert))
+                                            for advert in adverts])
+    buildTime, index = timed(lambda: ProfileIndex(profiles))
+    indexTime, indexed = timed(lambda: [sorted(index.match(advert)) for advert in adverts])
+    assert naive == compiled == indexed, "matches differ"
+    matches = sum(map(len, naive))
+    print(f"{numProfiles} profiles x {numAdverts} adverts, {matches} matches")
+    print(f"filter_advert loop   {naiveTime * 1000:10.1f} ms")
+    print(f"compiled predicates  {compiledTime * 1000:10.1f} ms")
+    print(f"profile index        {indexTime * 1000:10.1f} ms (+{buildTime * 1000:.1f} ms build)")
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
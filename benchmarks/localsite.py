@@ -0,0 +1,142 @@
+"""
+Local stand-in for the scraped websites: a HTTP server on localhost serving
+recorded (or synthetic) pages, and fetch engines to route the scrapers to it
+and to record pages from the real websites.
+
+Recorded pages are kept in a directory with a manifest.json of
+url -> file name, see record_fixtures.py.
+"""
+import hashlib
+import http.server
+import json
+import os
+import threading
+import urllib
+import standins # import path of the flatscrape modules
+from fetch import FetchEngine
+
+MANIFEST = "manifest.json"
+# what the websites answer for result pages past the last one
+EMPTY_PAGE = "<html><body></body></html>"
+
+def _key(url):
+    """Pages are looked up without the scheme."""
+    parts = urllib.parse.urlsplit(url)
+    return parts.netloc + parts.path + (f"?{parts.query}" if parts.query else "")
+
+def load_fixtures(directory):
+    """Recorded pages of a fixture directory as dict url -> html."""
+    with open(os.path.join(directory, MANIFEST), "r") as f:
+        manifest = json.load(f)
+    pages = {}
+    for url, filename in manifest.items():
+        with open(os.path.join(directory, filename), "r", encoding="utf-8") as f:
+            pages[url] = f.read()
+    return pages
+
+def save_fixtures(pages, directory):
+    os.makedirs(directory, exist_ok=True)
+    manifest = {}
+    for i, (url, text) in enumerate(sorted(pages.items())):
+        manifest[url] = f"page{i:04d}.html"
+        with open(os.path.join(directory, manifest[url]), "w", encoding="utf-8") as f:
+            f.write(text)
+    with open(os.path.join(directory, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=1)
+
+
+class LocalSite():
+    """
+    Serve pages (dict url -> html) on localhost. Requests for /<host>/<path>
+    get the page of https://<host>/<path>. Unknown pages are answered with an
+    empty page, like result pages past the last one. Pages carry an ETag, so
+    conditional requests get a 304.
+    """
+    def __init__(self, pages):
+        self._pages = {_key(url): text.encode("utf-8") for (url, text) in pages.items()}
+        self._etags = {key: hashlib.sha1(body).hexdigest()\
+                       for (key, body) in self._pages.items()}
+        self.requests = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = None
+
+    def _handler(self):
+        site = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                key = self.path.lstrip("/")
+                with site._lock:
+                    site.requests += 1
+                    site.misses += key not in site._pages
+                body = site._pages.get(key, EMPTY_PAGE.encode("utf-8"))
+                etag = site._etags.get(key)
+                if etag and self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                if etag:
+                    self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+        return Handler
+
+    def set_page(self, url, text):
+        """Add or change a page while serving, e.g. new offers."""
+        body = text.encode("utf-8")
+        with self._lock:
+            self._pages[_key(url)] = body
+            self._etags[_key(url)] = hashlib.sha1(body).hexdigest()
+
+    def local_url(self, url):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/{_key(url)}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class LocalSiteFetchEngine(FetchEngine):
+    """FetchEngine that sends all requests to a LocalSite. The limits and
+    connection pools still follow the original hosts."""
+    def __init__(self, site, siteLimits=None, timeout=30):
+        super(LocalSiteFetchEngine, self).__init__(siteLimits, timeout)
+        self._site = site
+
+    def _target_url(self, url):
+        return self._site.local_url(url)
+
+
+class RecordingFetchEngine(FetchEngine):
+    """FetchEngine that keeps the text of every successful response."""
+    def __init__(self, *args, **kwargs):
+        super(RecordingFetchEngine, self).__init__(*args, **kwargs)
+        self.pages = {}
+        self._recordLock = threading.Lock()
+
+    def get(self, url, headers=None):
+        # unconditional, a 304 would not give a page to record
+        resp = super(RecordingFetchEngine, self).get(url)
+        if resp.status_code == 200:
+            with self._recordLock:
+                self.pages[url] = resp.text
+        return resp
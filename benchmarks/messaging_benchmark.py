@@ -0,0 +1,36 @@
+"""
+Offline load test of the telegram fan-out with the local stand-in
+transport: time to send messages to several recipients, serial (one worker)
+versus concurrent, with simulated latency and flood control.
+
+    python benchmarks/messaging_benchmark.py [recipients] [messages] [latency ms]
+"""
+import logging
+import sys
+import time
+import standins
+from transport import Broadcaster, LocalTransport
+
+logging.disable(logging.WARNING)
+
+def run(recipients, messages, latency, workers):
+    transport = LocalTransport(latency=latency, rateLimitEvery=25, retryAfter=latency)
+    # no per chat limit here, that would dominate the measurement
+    broadcaster = Broadcaster(transport, maxWorkers=workers, perChatRate=1000)
+    start = time.perf_counter()
+    for i in range(messages):
+        broadcaster.broadcast(range(recipients), f"message {i}")
+    duration = time.perf_counter() - start
+    broadcaster.close()
+    assert len(transport.sent) == recipients * messages
+    return duration
+
+def main(recipients=5, messages=10, latencyMs=50):
+    latency = latencyMs / 1000
+    for workers in [1, recipients]:
+        duration = run(recipients, messages, latency, workers)
+        print(f"{workers} worker(s): {duration:.2f}s for {messages} messages "
+              f"to {recipients} recipients ({duration / messages * 1000:.0f} ms/message)")
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,66 @@
+"""
+Synthetic search and expose pages that mimic the markup the scrapers rely
+on, padded with the kind of noise (navigation, scripts, ads) real pages have.
+"""
+import random
+
+NOISE_BLOCKS = 150
+
+def _noise(rng, blocks=NOISE_BLOCKS):
+    parts = []
+    for i in range(blocks):
+        parts.append(f'<div class="nav-item col-sm-{i % 12}"><a href="/link/{i}">'
+                     f'Link {rng.random()}</a><span class="badge">{i}</span></div>')
+        if i % 10 == 0:
+            parts.append(f'<script>var tracking{i} = "{rng.random()}";</script>')
+    return "\n".join(parts)
+
+def wggesucht_search_page(offerIds, seed=0):
+    rng = random.Random(seed)
+    offers = []
+    for offerId in offerIds:
+        price = rng.randint(300, 1500)
+        size = rng.randint(10, 90)
+        offers.append(f'''
+<div class="wgg_card offer_list_item" data-id="{offerId}">
+  <div class="row"><h3 class="truncate_title noprint">
+    <a href="/wohnungen-in-Berlin-Mitte.{offerId}.html">  Schoene Wohnung   {offerId} </a></h3>
+  <div class="col-xs-11"><span>1-Zimmer-Wohnung | Berlin Mitte | Strasse {offerId % 97}</span></div>
+  <div class="col-xs-3"><b>{price} €</b></div>
+  <div class="col-xs-3 text-right"><b>{size} m²</b></div>
+  <div class="col-xs-5 text-center">
+    {"ab 01.0%d.2023" % rng.randint(1, 9) if offerId % 2 else
+     "01.0%d.2023 - 01.1%d.2023" % (rng.randint(1, 9), rng.randint(0, 2))}
+  </div></div>
+</div>''')
+    return (f'<html><head><title>WG</title></head><body>{_noise(rng)}'
+            f'<div id="main_column">{"".join(offers)}</div>{_noise(rng)}</body></html>')
+
+def ebay_search_page(offerIds, seed=0):
+    rng = random.Random(seed)
+    offers = [f'<li class="ad-listitem"><article class="aditem" data-adid="{offerId}" '
+              f'data-href="/s-anzeige/wohnung-{offerId}/{offerId}"><h2>Wohnung {offerId}</h2>'
+              f'<p>{rng.random()}</p></article></li>' for offerId in offerIds]
+    return (f'<html><body>{_noise(rng)}<ul id="srchrslt-adtable">{"".join(offers)}'
+            f'</ul>{_noise(rng)}</body></html>')
+
+def ebay_expose_page(offerId, seed=0):
+    rng = random.Random(seed + offerId)
+    details = "".join(f'<li class="addetailslist--detail">{key}\n<span class="addetailslist--detail--value">{val}</span></li>'
+                      for (key, val) in [("Wohnfläche", f"{rng.randint(20, 90)} m²"),
+                                         ("Zimmer", str(rng.randint(1, 4))),
+                                         ("Verfügbar ab", "01.04.2023"),
+                                         ("Art der Unterkunft", "Wohnung"),
+                                         ("Mietart", "befristet")])
+    checktags = "".join(f'<li class="checktag">{tag}</li>'
+                        for tag in ["Herd", "Möbliert", "Balkon", "Kühlschrank"])
+    description = " ".join(f"Satz {i} der Beschreibung." for i in range(80))
+    return f'''<html><body>{_noise(rng)}
+<div id="viewad-main">
+  <h1 class="boxedarticle--title" id="viewad-title">  Wohnung {offerId} in Berlin </h1>
+  <h2 class="boxedarticle--price">{rng.randint(400, 1500)} €</h2>
+  <span id="viewad-locality" itemprop="locality">1{offerId % 9}115 Berlin - Mitte</span>
+  <ul class="addetailslist">{details}</ul>
+  <ul class="checktaglist">{checktags}</ul>
+  <p id="viewad-description-text" itemprop="description">{description}</p>
+</div>{_noise(rng)}</body></html>'''
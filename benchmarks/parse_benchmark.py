@@ -0,0 +1,67 @@
+"""
+Compare the default parsing with the fast parse mode (strained subtrees,
+lxml if installed): parse time and peak memory per page, and check that both
+produce identical adverts.
+
+    python benchmarks/parse_benchmark.py [repetitions]
+"""
+import logging
+import sys
+import time
+import tracemalloc
+import pages
+from standins import StaticFetchEngine
+import parsing
+from scraper import WgGesuchtScraper, EbayScraper
+
+logging.disable(logging.WARNING)
+
+def measure(function, repetitions):
+    """Return mean seconds and peak traced memory in bytes of one call."""
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        function()
+    duration = (time.perf_counter() - start) / repetitions
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duration, peak
+
+def scrape(scraperClass, searchURL, servedPages, fastParse):
+    scraper = scraperClass(fetchEngine=StaticFetchEngine(servedPages), fastParse=fastParse,
+                           maxPages=1)
+    return [advert.to_dict() for advert in scraper.scrape_search_page(searchURL)]
+
+def main(repetitions=20):
+    offerIds = list(range(1000, 1025))
+    wgURL = "https://www.wg-gesucht.de/wohnungen-in-Berlin.8.2.1.0.html"
+    ebayURL = "https://www.ebay-kleinanzeigen.de/s-wohnung-mieten/berlin/c203l3331"
+    servedPages = {wgURL: pages.wggesucht_search_page(offerIds),
+                   ebayURL: pages.ebay_search_page(offerIds)}
+    for offerId in offerIds:
+        servedPages[f"https://www.ebay-kleinanzeigen.de/s-anzeige/wohnung-{offerId}/{offerId}"] =\
+            pages.ebay_expose_page(offerId)
+
+    # identical output
+    for scraperClass, url in [(WgGesuchtScraper, wgURL), (EbayScraper, ebayURL)]:
+        full = scrape(scraperClass, url, servedPages, False)
+        fast = scrape(scraperClass, url, servedPages, True)
+        assert full == fast, f"{scraperClass.__name__}: fast parse output differs"
+        assert len(full) == len(offerIds)
+    print(f"fast parser: {parsing.FAST_PARSER}, outputs identical")
+
+    exposeHtml = servedPages[f"https://www.ebay-kleinanzeigen.de/s-anzeige/wohnung-{offerIds[0]}/{offerIds[0]}"]
+    cases = [
+        ("wggesucht search", servedPages[wgURL], WgGesuchtScraper()._keep_search_page_tag),
+        ("ebay search", servedPages[ebayURL], EbayScraper()._keep_search_page_tag),
+        ("ebay expose", exposeHtml, EbayScraper()._keep_expose_tag),
+    ]
+    print(f"{'page':<18}{'mode':<6}{'ms/page':>10}{'peak KiB':>10}")
+    for name, html, keepTag in cases:
+        for mode, tagFilter in [("full", None), ("fast", keepTag)]:
+            duration, peak = measure(lambda: parsing.make_soup(html, tagFilter), repetitions)
+            print(f"{name:<18}{mode:<6}{duration * 1000:>10.2f}{peak / 1024:>10.0f}")
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
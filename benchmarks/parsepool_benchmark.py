@@ -0,0 +1,110 @@
+"""
+Parse pool scaling: a sweep over many search urls of both sites through
+flatscrape.ebay() and flatscrape.wggesucht(), one thread per site as in
+main(), with the pages served by the local site. Pages are parsed in the
+scraper threads (workers 0) or shipped to a parse pool of 1 to N processes.
+With a pool, each site scrapes as many urls at a time as there are workers
+and fetches the next result page while a page is parsed.
+
+    python benchmarks/parsepool_benchmark.py [max workers] [urls per site] [repetitions]
+"""
+import logging
+import os
+import sys
+import threading
+import time
+import pages
+from localsite import LocalSite, LocalSiteFetchEngine
+import flatscrape
+from scraper import make_parse_pool
+import seenoffers
+from suite import FETCH_LIMITS, OFFERS_PER_PAGE
+from tenants import load_tenants, close_broadcasters
+from transport import LocalTransport
+
+logging.disable(logging.WARNING)
+
+PAGES_PER_URL = 2
+
+class AdvertSink():
+    """Stand-in for the pipeline, keeps the adverts put by the scrapers."""
+    def __init__(self):
+        self.adverts = []
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        with self._lock:
+            self.adverts.append(item[0])
+
+def sweep_site(urlsPerSite):
+    """Pages of urlsPerSite search urls per site, with PAGES_PER_URL pages
+    of offers each, and the event that searches them."""
+    served = {}
+    event = {"ebayUrls": [], "wggesuchtUrls": {"Flat": [], "WG": []},
+             "MAX_PAGES": PAGES_PER_URL, "TELEGRAM_USER_IDS": [1]}
+    for i in range(urlsPerSite):
+        wgURL = f"https://www.wg-gesucht.de/wg-zimmer-in-Berlin-{i}.8.0.1.0.html"
+        ebayURL = f"https://www.ebay-kleinanzeigen.de/s-wohnung-mieten/berlin/c203l{i}"
+        for page in range(PAGES_PER_URL):
+            first = 10000 + (i * PAGES_PER_URL + page) * OFFERS_PER_PAGE
+            ids = list(range(first, first + OFFERS_PER_PAGE))
+            served[wgURL.replace(".0.html", f".{page}.html")] =\
+                pages.wggesucht_search_page(ids, seed=page)
+            ebayPage = ebayURL.replace("/c203l", f"/seite:{page + 1}/c203l")\
+                if page else ebayURL
+            served[ebayPage] = pages.ebay_search_page(ids, seed=page)
+            for offerId in ids:
+                served[f"https://www.ebay-kleinanzeigen.de/s-anzeige/wohnung-{offerId}/{offerId}"] =\
+                    pages.ebay_expose_page(offerId)
+        event["wggesuchtUrls"]["WG"].append(wgURL)
+        event["ebayUrls"].append(ebayURL)
+    return served, event
+
+def run_sweep(site, event, parsePool, workers):
+    """Scrape all searches of the event with an empty state, return the
+    seconds and adverts."""
+    engine = LocalSiteFetchEngine(site, FETCH_LIMITS)
+    tenants = load_tenants(event, {}, transport=LocalTransport())
+    explored = seenoffers.load_explored_offers({})
+    sink = AdvertSink()
+    services = {"fetchEngine": engine, "parsePool": parsePool,\
+                "scrapeWorkers": workers or 1}
+    threads = [
+        threading.Thread(target=flatscrape.ebay,\
+            args=(explored["ebay"], tenants, sink), kwargs=services),
+        threading.Thread(target=flatscrape.wggesucht,\
+            args=(explored["wggesucht"], tenants, sink, True), kwargs=services)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duration = time.perf_counter() - start
+    close_broadcasters(tenants)
+    engine.close()
+    return duration, len(sink.adverts)
+
+def main(maxWorkers=None, urlsPerSite=8, repetitions=3):
+    maxWorkers = maxWorkers or os.cpu_count()
+    served, event = sweep_site(urlsPerSite)
+    numPages = len(served)
+    numAdverts = 2 * urlsPerSite * PAGES_PER_URL * OFFERS_PER_PAGE
+    print(f"{2 * urlsPerSite} search urls, {numPages} pages, {os.cpu_count()} cpus")
+    print(f"{'workers':>8}{'seconds':>10}{'pages/s':>10}{'speedup':>9}")
+    baseline = None
+    with LocalSite(served) as site:
+        for workers in [0] + list(range(1, maxWorkers + 1)):
+            parsePool = make_parse_pool(workers)
+            # the first sweep spawns the workers and imports the parser
+            assert run_sweep(site, event, parsePool, workers)[1] == numAdverts
+            duration = min(run_sweep(site, event, parsePool, workers)[0]\
+                           for _ in range(repetitions))
+            if parsePool:
+                parsePool.shutdown()
+            baseline = baseline or duration
+            label = workers if workers else "threads"
+            print(f"{label:>8}{duration:10.2f}{numPages / duration:10.1f}"
+                  f"{baseline / duration:8.2f}x")
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,39 @@
+"""
+Record the search and expose pages of an event from the real websites, as
+fixtures for the offline benchmarks. Only the scrapers run, nothing is
+geocoded, translated or sent. Mind the politeness limits (FETCH_LIMITS).
+
+    python benchmarks/record_fixtures.py event.json fixtureDirectory
+"""
+import json
+import logging
+import sys
+from localsite import RecordingFetchEngine, save_fixtures
+from scraper import WgGesuchtScraper, EbayScraper, MAX_PAGES
+from tenants import tenant_events
+
+logging.disable(logging.INFO)
+
+def search_urls(awsEvent):
+    """(scraper class, url) of all search urls of all users."""
+    urls = []
+    for event in tenant_events(awsEvent).values():
+        urls += [(EbayScraper, url) for url in event.get("ebayUrls", [])]
+        for flatUrls in event.get("wggesuchtUrls", {}).values():
+            urls += [(WgGesuchtScraper, url) for url in flatUrls]
+    return list(dict.fromkeys(urls))
+
+def main(eventFile, directory):
+    with open(eventFile, "r") as f:
+        awsEvent = json.load(f)
+    engine = RecordingFetchEngine(awsEvent.get("FETCH_LIMITS"))
+    for scraperClass, url in search_urls(awsEvent):
+        scraper = scraperClass(fetchEngine=engine,\
+            maxPages=awsEvent.get("MAX_PAGES", MAX_PAGES))
+        print(f"{url}: {len(scraper.scrape_search_page(url))} adverts")
+    engine.close()
+    save_fixtures(engine.pages, directory)
+    print(f"Recorded {len(engine.pages)} pages to {directory}")
+
+if __name__ == "__main__":
+    main(*sys.argv[1:3])
@@ -0,0 +1,31 @@
+"""Local stand-ins for the network services, so benchmarks run offline."""
+import os
+import sys
+
+# the flatscrape modules import each other as top level modules (lambda layer)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "flatscrape"))
+
+
+class StaticResponse():
+    def __init__(self, text, status_code=200, headers=None):
+        self.text = text
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class StaticFetchEngine():
+    """FetchEngine stand-in that serves pages from a dict url -> html."""
+    def __init__(self, pages, concurrency=4):
+        self._pages = pages
+        self._concurrency = concurrency
+
+    def concurrency(self, url):
+        return self._concurrency
+
+    def get(self, url, headers=None):
+        if url not in self._pages:
+            return StaticResponse("", 404)
+        return StaticResponse(self._pages[url])
+
+    def close(self):
+        pass
@@ -0,0 +1,302 @@
+"""
+Offline benchmark suite. The search and expose pages are served from a
+local HTTP server (recorded fixtures or synthetic pages), geocoding,
+translation and telegram are local stand-ins. Each stage (fetch, parse,
+filter, enrich, message) is measured on its own, and main() end to end.
+
+For every stage the throughput, latency percentiles and peak traced memory
+are reported and written as json, to compare the results of two commits:
+
+    python benchmarks/suite.py [--offers N] [--output results.json]
+    python benchmarks/suite.py --fixtures dir --event event.json
+    python benchmarks/suite.py --compare old.json new.json
+"""
+import argparse
+import datetime as dt
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+import pages
+from localsite import LocalSite, LocalSiteFetchEngine, load_fixtures
+from standins import StaticFetchEngine
+from advert import set_distances_batch, translate_adverts
+from DataStorage import SearchParameters
+from filters import ProfileIndex
+import flatscrape
+import geocoding
+from messenger import Messenger
+from scraper import WgGesuchtScraper, EbayScraper
+import translation
+from transport import LocalTransport
+
+logging.disable(logging.WARNING)
+
+WG_URL = "https://www.wg-gesucht.de/wg-zimmer-in-Berlin.8.0.1.0.html"
+EBAY_URL = "https://www.ebay-kleinanzeigen.de/s-wohnung-mieten/berlin/c203l3331"
+OFFERS_PER_PAGE = 20
+# no politeness limits towards the local server
+FETCH_LIMITS = {site: {"rate": 10000, "burst": 10000, "concurrency": 8}\
+                for site in ["wggesucht", "ebay"]}
+NO_MESSAGE_LIMITS = {"perMinute": 10 ** 9, "minInterval": 0, "perChatRate": 10000,\
+                     "globalRate": 10000}
+TRANSPORT_LATENCY = 0.002
+BATCH_SIZE = 16
+
+def synthetic_site(numOffers):
+    """Synthetic pages for numOffers offers per site, and the event."""
+    served = {}
+    for site, url in [(WgGesuchtScraper, WG_URL), (EbayScraper, EBAY_URL)]:
+        for page in range(0, (numOffers + OFFERS_PER_PAGE - 1) // OFFERS_PER_PAGE):
+            ids = list(range(10000 + page * OFFERS_PER_PAGE,\
+                             10000 + min(numOffers, (page + 1) * OFFERS_PER_PAGE)))
+            pageURL = site()._page_url(url, page)
+            if site is WgGesuchtScraper:
+                served[pageURL] = pages.wggesucht_search_page(ids, seed=page)
+                continue
+            served[pageURL] = pages.ebay_search_page(ids, seed=page)
+            for offerId in ids:
+                served[f"https://www.ebay-kleinanzeigen.de/s-anzeige/wohnung-{offerId}/{offerId}"] =\
+                    pages.ebay_expose_page(offerId)
+    event = {"ebayUrls": [EBAY_URL], "wggesuchtUrls": {"Flat": [], "WG": [WG_URL]},
+             "city": "Berlin", "LANG": "en",
+             "POI_DISTANCES": {"Work": "Alexanderplatz", "Uni": "Ernst-Reuter-Platz"},
+             "MAX_PAGES": (numOffers + OFFERS_PER_PAGE - 1) // OFFERS_PER_PAGE}
+    return served, event
+
+def percentile(samples, p):
+    """Nearest rank percentile."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+def summary(items, duration, latencies, peak):
+    """Metrics of a stage: items per second, latencies in ms, peak in KiB."""
+    ms = [latency * 1000 for latency in latencies]
+    return {"items": items, "seconds": round(duration, 4),
+            "throughput": round(items / duration, 2) if duration else None,
+            "latencyMs": {f"p{p}": round(percentile(ms, p), 3) if ms else None\
+                          for p in (50, 90, 99)},
+            "peakKiB": round(peak / 1024, 1)}
+
+def measure(run, repetitions):
+    """
+    Call run(latencies) repetitions times, it returns the number of items
+    it handled and appends the latency of each operation. One more call
+    with tracemalloc gives the peak memory.
+    """
+    latencies, items = [], 0
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        items += run(latencies)
+    duration = time.perf_counter() - start
+    tracemalloc.start()
+    run([])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return summary(items, duration, latencies, peak)
+
+def timed(latencies, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    latencies.append(time.perf_counter() - start)
+    return result
+
+def stand_in_services():
+    return {"geocoder": geocoding.Geocoder(geocoding.StaticBackend({},\
+                default=(52.52, 13.40)), rate=10000),
+            "translator": translation.Translator(translation.StaticBackend(),\
+                rate=10000)}
+
+def search_urls(event):
+    urls = [(EbayScraper, url) for url in event.get("ebayUrls", [])]
+    for flatUrls in event.get("wggesuchtUrls", {}).values():
+        urls += [(WgGesuchtScraper, url) for url in flatUrls]
+    return urls
+
+def bench_fetch(served, repetitions):
+    with LocalSite(served) as site:
+        engine = LocalSiteFetchEngine(site, FETCH_LIMITS)
+        def run(latencies):
+            for url in served:
+                timed(latencies, engine.get, url)
+            return len(served)
+        result = measure(run, repetitions)
+        engine.close()
+    return result
+
+def parse_all(served, event, latencies=None):
+    adverts = []
+    for scraperClass, url in search_urls(event):
+        scraper = scraperClass(fetchEngine=StaticFetchEngine(served),\
+            maxPages=event.get("MAX_PAGES", 1),\
+            fastParse=event.get("FAST_PARSE", False))
+        if latencies is None:
+            adverts += scraper.scrape_search_page(url)
+        else:
+            adverts += timed(latencies, scraper.scrape_search_page, url)
+    return adverts
+
+def bench_parse(served, event, repetitions):
+    return measure(lambda latencies: len(parse_all(served, event, latencies)),\
+        repetitions)
+
+def random_profiles(num, seed=0):
+    rng = random.Random(seed)
+    profiles = {}
+    for i in range(num):
+        profile = SearchParameters({}, geocoding.Geocoder(geocoding.StaticBackend({})))
+        profile.maxPrice = rng.randint(300, 2000)
+        profile.minSize = rng.randint(0, 60)
+        profiles[i] = profile
+    return profiles
+
+def bench_filter(adverts, numProfiles, repetitions):
+    index = ProfileIndex(random_profiles(numProfiles))
+    def run(latencies):
+        for advert in adverts:
+            timed(latencies, index.match, advert)
+        return len(adverts)
+    return measure(run, repetitions)
+
+def bench_enrich(adverts, repetitions):
+    """Distances and translation in batches, cold caches every repetition."""
+    poiCoords = {"Work": (52.5219, 13.4132), "Uni": (52.5125, 13.3269)}
+    def run(latencies):
+        services = stand_in_services()
+        copies = [advert.copy() for advert in adverts]
+        for i in range(0, len(copies), BATCH_SIZE):
+            batch = copies[i:i + BATCH_SIZE]
+            def enrich():
+                set_distances_batch(batch, poiCoords, "Berlin", services["geocoder"])
+                translate_adverts(batch, "en", services["translator"])
+            timed(latencies, enrich)
+        return len(copies)
+    return measure(run, repetitions)
+
+def bench_message(adverts, repetitions):
+    """Queue all adverts and send them to three chats, latency per message."""
+    def run(latencies):
+        messenger = Messenger(None, [1, 2, 3],\
+            transport=LocalTransport(latency=TRANSPORT_LATENCY),\
+            limits=NO_MESSAGE_LIMITS)
+        send = messenger.send_message
+        messenger.send_message = lambda msg: timed(latencies, send, msg)
+        for advert in adverts:
+            messenger.handle_advert(advert)
+        messenger.close()
+        messenger.run(lambda handledIds: None)
+        return len(adverts)
+    return measure(run, repetitions)
+
+def bench_end_to_end(served, event, repetitions):
+    """main() with an empty state, latency is the time from the start of the
+    run until an offer's message was sent. The metrics summary of the last
+    run is kept as runMetrics."""
+    event = dict(event, FETCH_LIMITS=FETCH_LIMITS, MESSAGE_LIMITS=NO_MESSAGE_LIMITS,\
+        TELEGRAM_USER_IDS=[1])
+    runMetrics = []
+    with LocalSite(served) as site:
+        def run(latencies):
+            transport = LocalTransport(latency=TRANSPORT_LATENCY)
+            services = dict(stand_in_services(), transport=transport,\
+                fetchEngine=LocalSiteFetchEngine(site, FETCH_LIMITS))
+            state = {}
+            start = time.monotonic()
+            runMetrics[:] = [flatscrape.main(event, lambda: {}, state.update,\
+                services=services)]
+            latencies += [sentTime - start for (sentTime, _, _) in transport.sent]
+            return sum(len(ids) for name in ["ebay", "wggesucht"]\
+                       for ids in state[name].values())
+        return dict(measure(run, repetitions), runMetrics=runMetrics[0])
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],\
+            cwd=os.path.dirname(os.path.abspath(__file__)),\
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_suite(args):
+    if args.fixtures:
+        served = load_fixtures(args.fixtures)
+        with open(args.event, "r") as f:
+            event = json.load(f)
+    else:
+        served, event = synthetic_site(args.offers)
+    adverts = parse_all(served, event)
+    benchmarks = [
+        ("fetch", lambda: bench_fetch(served, args.repetitions)),
+        ("parse", lambda: bench_parse(served, event, args.repetitions)),
+        ("filter", lambda: bench_filter(adverts, args.profiles, args.repetitions)),
+        ("enrich", lambda: bench_enrich(adverts, args.repetitions)),
+        ("message", lambda: bench_message(adverts, args.repetitions)),
+        ("endToEnd", lambda: bench_end_to_end(served, event, args.repetitions)),
+    ]
+    stages = {}
+    for name, benchmark in benchmarks:
+        print(f"Running {name}", file=sys.stderr)
+        stages[name] = benchmark()
+    return {"commit": commit(), "time": dt.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "parameters": {"fixtures": args.fixtures, "offers": len(adverts),
+                           "pages": len(served), "profiles": args.profiles,
+                           "repetitions": args.repetitions},
+            "stages": stages}
+
+def print_results(results):
+    print(f"{'stage':10} {'items/s':>10} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'peak KiB':>10}")
+    for name, stage in results["stages"].items():
+        latency = stage["latencyMs"]
+        print(f"{name:10} {stage['throughput']:10.1f} {latency['p50']:9.3f} "
+              f"{latency['p90']:9.3f} {latency['p99']:9.3f} {stage['peakKiB']:10.1f}")
+
+def compare(oldFile, newFile):
+    """Relative change of throughput and median latency per stage."""
+    with open(oldFile, "r") as f:
+        old = json.load(f)
+    with open(newFile, "r") as f:
+        new = json.load(f)
+    print(f"{old['commit']} -> {new['commit']}")
+    print(f"{'stage':10} {'items/s':>10} {'p50':>10} {'peak':>10}")
+    for name, stage in new["stages"].items():
+        if name not in old["stages"]:
+            continue
+        before = old["stages"][name]
+        change = lambda a, b: f"{(b / a - 1) * 100:+9.1f}%" if a and b else f"{'-':>10}"
+        print(f"{name:10} {change(before['throughput'], stage['throughput'])} "
+              f"{change(before['latencyMs']['p50'], stage['latencyMs']['p50'])} "
+              f"{change(before['peakKiB'], stage['peakKiB'])}")
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--offers", type=int, default=100,\
+        help="synthetic offers per site")
+    parser.add_argument("--fixtures", help="directory of recorded pages")
+    parser.add_argument("--event", help="event of the recorded pages")
+    parser.add_argument("--profiles", type=int, default=100,\
+        help="search profiles for the filter stage")
+    parser.add_argument("--repetitions", type=int, default=3)
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    args = parser.parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.fixtures and not args.event:
+        parser.error("--fixtures needs the --event the pages were recorded with")
+    results = run_suite(args)
+    print_results(results)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=1)
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,51 +1,132 @@
 import datetime as dt
 import logging
-import geopy
-import geopy.distance
+import threading
 import util
+from geocoding import Geocoder
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-class DataField():
-    """ Typed dictionary entry I guess """
-    def __init__(self, expectedTypes=[object]):
-        self.expectedTypes = expectedTypes
-        self.isset = False
-        self.val = None
+# How values are checked when they are set on a data storage field:
+#   "strict": isinstance against all expected types
+#   "off": no check at all, e.g. for records that were validated before
+VALIDATION_MODES = ["strict", "off"]
+validationMode = "strict"
+
+class FieldView():
+    """ Get/set interface to a single field of a data storage record """
+    __slots__ = ("_record", "_index")
+    def __init__(self, record, index):
+        self._record = record
+        self._index = index
     def __bool__(self):
-        return self.isset
+        return bool(self._record._mask >> self._index & 1)
     def set(self, val):
-        if not any(map(lambda t: isinstance(val, t), self.expectedTypes)):
-            raise TypeError(f"Type {type(val)} not supported for data "+\
-                            f"field: expected any of {self.expectedTypes}.")
-        self.val = val
-        self.isset = True
+        self._record._set(self._index, val)
     def get(self):
-        if not self.isset:
+        if not self._record._mask >> self._index & 1:
             raise AttributeError(f"Cannot get unitialized data field value.")
-        return self.val
+        return self._record._values[self._index]
+    @property
+    def isset(self):
+        return bool(self)
+    @property
+    def val(self):
+        return self._record._values[self._index]
+    @property
+    def expectedTypes(self):
+        return list(self._record._expectedTypes[self._index])
+
+
+class _FieldDescriptor():
+    __slots__ = ("_index",)
+    def __init__(self, index):
+        self._index = index
+    def __get__(self, record, owner=None):
+        if record is None:
+            return self
+        return FieldView(record, self._index)
+
+
+class DataStorageRecord():
+    """
+    Base of the classes generated by DataStorageClass. The values are kept
+    in one list per record, with a bitmask of the fields that are set, so a
+    record is a single small object instead of one object per field. A
+    field view is created on every attribute access, so hot paths read and
+    write with get_value and set_value instead.
+    """
+    __slots__ = ("_values", "_mask", "_version")
+    _fieldNames = ()
+    _fieldIndex = {}
+    _expectedTypes = ()
+
+    def __init__(self):
+        self._values = [None] * len(self._fieldNames)
+        self._mask = 0
+        self._version = 0 # incremented on every change
+
+    def __getattr__(self, name):
+        # only called for names that are not fields
+        if name.startswith("__"):
+            # protocol lookups (pickle, copy) expect an AttributeError
+            raise AttributeError(name)
+        raise ValueError(f"Field `{name}` cannot be stored.")
 
+    def _set(self, index, val):
+        if validationMode != "off" and not isinstance(val, self._expectedTypes[index]):
+            raise TypeError(f"Type {type(val)} not supported for data "+\
+                f"field: expected any of {list(self._expectedTypes[index])}.")
+        self._values[index] = val
+        self._mask |= 1 << index
+        self._version += 1
+
+    def get_value(self, name, default=None):
+        """Fast read access without a field view: value or default."""
+        index = self._fieldIndex[name]
+        return self._values[index] if self._mask >> index & 1 else default
+
+    def set_value(self, name, val):
+        self._set(self._fieldIndex[name], val)
+
+    def to_dict(self):
+        """The fields that are set, as plain dict."""
+        return {name: self._values[i] for (i, name) in enumerate(self._fieldNames)\
+                if self._mask >> i & 1}
+
+    @classmethod
+    def from_dict(cls, values):
+        record = cls()
+        for name, val in values.items():
+            record.set_value(name, val)
+        return record
+
+    def copy(self):
+        """Shallow copy, values themselves are shared."""
+        record = self.__class__()
+        record._values = list(self._values)
+        record._mask = self._mask
+        return record
 
-        
 
 def DataStorageClass(classname, dataTypes):
-    """ An abomination, because I was bored """
-    class DataStorage():
-        def __init__(self):
-            self.__dict__.update({t: DataField(dataTypes[t]) for t in dataTypes.keys()})
-        def __getattr__(self, name):
-            if not name in self.__dict__:
-                raise ValueError(f"Field `{name}` cannot be stored.")
-            return self.__dict__[name]
-    DataStorage.__name__ = classname
+    """ An abomination, because I was bored. Now with slots. """
+    names = list(dataTypes.keys())
+    attributes = {name: _FieldDescriptor(i) for (i, name) in enumerate(names)}
+    attributes.update({
+        "__slots__": (),
+        "_fieldNames": tuple(names),
+        "_fieldIndex": {name: i for (i, name) in enumerate(names)},
+        "_expectedTypes": tuple(tuple(dataTypes[name]) for name in names),
+    })
+    DataStorage = type(classname, (DataStorageRecord,), attributes)
     DataStorage.__qualname__ = classname
     return DataStorage
 
 
 class SearchParameters():
     """ Glorified dictionary, generated from aws event"""
-    def __init__(self, awsEvent):
+    def __init__(self, awsEvent, geocoder=None):
         self.maxPrice = 9999999
         self.minSize = 0
         self.moveInLower = dt.datetime(1900,1,1)
@@ -56,12 +137,17 @@ class SearchParameters():
         self.wggesuchtWGUrls = []
         self.ebayUrls = []
         self.city = "Berlin"
-        self.poiDistances = {}
+        self._poiAddresses = {}
+        self._poiDistances = {}
+        self._poiLock = threading.Lock()
+        self._geocoder = None
         self.poiRoutes = []
         self.translate = None
-        self.parse_aws_event(awsEvent)
+        self.fastParse = False
+        self.maxPages = None
+        self.parse_aws_event(awsEvent, geocoder)
 
-    def parse_aws_event(self, awsEvent):
+    def parse_aws_event(self, awsEvent, geocoder=None):
         self.maxPrice = awsEvent.get("maxPrice", self.maxPrice)
         self.minSize = awsEvent.get("minSize", self.minSize)
         self.moveInLower = util.parse_german_date(awsEvent.get("moveInLower", "01.01.1900"))
@@ -72,11 +158,37 @@ class SearchParameters():
         self.wggesuchtWGUrls = awsEvent.get("wggesuchtUrls", {"WG": self.wggesuchtWGUrls}).get("WG")
         self.ebayUrls = awsEvent.get("ebayUrls", self.ebayUrls)
         self.city = awsEvent.get("city")
-        self.poiDistances = {poi: geopy.Nominatim(user_agent="flatscrape").geocode(address).point\
-            for (poi, address) in awsEvent.get("POI_DISTANCES", {}).items()}
+        # the POIs are geocoded when the distances are first needed, so runs
+        # without new adverts do not look them up
+        self._geocoder = geocoder
+        self._poiAddresses = awsEvent.get("POI_DISTANCES", {})
+        self._poiDistances = None
         self.poiRoutes = awsEvent.get("POI_ROUTES", self.poiRoutes)
         self.translate = awsEvent.get("LANG", None)
+        self.fastParse = awsEvent.get("FAST_PARSE", self.fastParse)
+        self.maxPages = awsEvent.get("MAX_PAGES", self.maxPages)
         return True
 
+    @property
+    def poiDistances(self):
+        """POI name -> (latitude, longitude), geocoded on first access."""
+        with self._poiLock:
+            if self._poiDistances is None:
+                geocoder = self._geocoder if self._geocoder else Geocoder()
+                self._poiDistances = {}
+                # kept for the whole run, so not given up on after the timeout
+                coordinates = geocoder.geocode_many(self._poiAddresses.values(), wait=True)
+                for (poi, address) in self._poiAddresses.items():
+                    if (coords := coordinates[address]):
+                        self._poiDistances[poi] = coords
+                    else:
+                        logger.warning(f"Could not find point of interest {poi}")
+            return self._poiDistances
+
+    @poiDistances.setter
+    def poiDistances(self, poiDistances):
+        with self._poiLock:
+            self._poiDistances = poiDistances
+
 
     
\ No newline at end of file
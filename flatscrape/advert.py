@@ -1,10 +1,12 @@
 import datetime as dt
 import logging
 import urllib
-import deep_translator
-import geopy
-import geopy.distance
 import DataStorage
+import distances as distances_module
+from filters import compile_filter
+from geocoding import Geocoder
+import metrics
+from translation import Translator
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -41,103 +43,129 @@ AdvertNoPrint = DataStorage.DataStorageClass("AdvertNoPrint",
 
 class Advert(AdvertNoPrint):
     """Store information from scraped advert."""
+    __slots__ = ("_rendered",)
+    def __init__(self):
+        super(Advert, self).__init__()
+        self._rendered = None # (record version, text)
+
     def __str__(self):
+        """Rendered text, memoised until a field is set again."""
+        if self._rendered is None or self._rendered[0] != self._version:
+            self._rendered = (self._version, self._render())
+        return self._rendered[1]
+
+    def _render(self):
+        value = self.get_value
         lines = []
-        if (title := self.title):
-            lines.append(title.get())
-        if (flatType := self.flatType):
-            lines.append(f"Type: {flatType.get()}")
-        if (price := self.price):
-            lines.append(f"Price: {price.get()}€")
-        if (size := self.size):
-            lines.append(f"Size: {size.get()}m^2")
-        if (distances := self.distances):
-            for dest, distance in distances.get().items():
+        if (title := value("title")) is not None:
+            lines.append(title)
+        if (flatType := value("flatType")) is not None:
+            lines.append(f"Type: {flatType}")
+        if (price := value("price")) is not None:
+            lines.append(f"Price: {price}€")
+        if (size := value("size")) is not None:
+            lines.append(f"Size: {size}m^2")
+        if (distances := value("distances")) is not None:
+            for dest, distance in distances.items():
                 lines.append(f"Distance to {dest}: {round(distance, 1)}km")
-        if (moveInDate := self.moveInDate):
-            if type(moveInDate.get()) == dt.datetime:
-                moveInText = moveInDate.get().strftime('%d.%m.%y')
-            else:
-                moveInText = moveInDate.get()
-            lines.append(f"Move in by {moveInText}")
-        if (moveOutDate := self.moveOutDate):
-            if type(moveOutDate.get()) == dt.datetime:
-                moveOutText = moveOutDate.get().strftime('%d.%m.%y')
-            else:
-                moveOutText = moveOutDate.get()
-            lines.append(f"Move out by {moveOutText}")
-        if (furnished := self.furnished):
-            lines.append("Is furnished" if furnished.get() else "Is not furnished")
-        if (kitchen := self.kitchen):
-            lines.append("Has kitchen" if kitchen.get() else "No kitchen")
-        if (description := self.description):
-            lines.append(description.get()[:MAX_DESCRIPTION_LEN])
-        if (url := self.url):
-            lines.append(f"Link: {url.get()}")
-        if (address := self.address):
-            lines.append(f"Address: {address.get()}")
-        if (routes := self.routes):
-            lines += routes.get()
+        if (moveInDate := value("moveInDate")) is not None:
+            if type(moveInDate) == dt.datetime:
+                moveInDate = moveInDate.strftime('%d.%m.%y')
+            lines.append(f"Move in by {moveInDate}")
+        if (moveOutDate := value("moveOutDate")) is not None:
+            if type(moveOutDate) == dt.datetime:
+                moveOutDate = moveOutDate.strftime('%d.%m.%y')
+            lines.append(f"Move out by {moveOutDate}")
+        if (furnished := value("furnished")) is not None:
+            lines.append("Is furnished" if furnished else "Is not furnished")
+        if (kitchen := value("kitchen")) is not None:
+            lines.append("Has kitchen" if kitchen else "No kitchen")
+        if (description := value("description")) is not None:
+            lines.append(description[:MAX_DESCRIPTION_LEN])
+        if (url := value("url")) is not None:
+            lines.append(f"Link: {url}")
+        if (address := value("address")) is not None:
+            lines.append(f"Address: {address}")
+        if (routes := value("routes")) is not None:
+            lines += routes
         return "\n\n** ".join(lines) + "\n--------\n"
 
 
-def set_distances(advert, pointsOfInterestCoordinates, city):
-    if not advert.address:
-        return False
-    start = geopy.Nominatim(user_agent="flatscrape").geocode(\
-        advert.address.get() + " " + city)
-    logger.debug("Got Nominatim")
-    if not start:
-        return False
-    distances = {poi : geopy.distance.distance(loc, start.point).km\
-                for (poi, loc) in pointsOfInterestCoordinates.items()}
-    advert.distances.set(distances)
-    return True
+def advert_site(advert):
+    """Site key of an advert, as used for the seen offers."""
+    website = advert.get_value("website", "")
+    if "ebay" in website:
+        return "ebay"
+    if "gesucht" in website:
+        return "wggesucht"
+    return ""
+
+def advert_ids(adverts):
+    """Ids of adverts per site."""
+    advertIds = {"ebay": [], "wggesucht": []}
+    for advert in adverts:
+        advertIds.setdefault(advert_site(advert), []).append(advert.get_value("adid"))
+    return advertIds
+
+def set_distances(advert, pointsOfInterestCoordinates, city, geocoder=None):
+    """Geocode the advert address and store the distances to the POIs."""
+    return set_distances_batch([advert], pointsOfInterestCoordinates, city,\
+        geocoder) == 1
+
+def set_distances_batch(adverts, pointsOfInterestCoordinates, city, geocoder=None):
+    """
+    Geocode the addresses of all adverts and store their distances to the
+    POIs, computed as one distance matrix. Return the number of adverts
+    whose distances were set.
+    """
+    if not pointsOfInterestCoordinates:
+        # nothing to measure against, no need to geocode the adverts
+        return 0
+    with metrics.timer("enrich_seconds", step="distances"):
+        return _set_distances_batch(adverts, pointsOfInterestCoordinates, city,\
+            geocoder if geocoder else Geocoder())
+
+def _set_distances_batch(adverts, pointsOfInterestCoordinates, city, geocoder):
+    queries = {advert: address + " " + city for advert in adverts\
+               if (address := advert.get_value("address")) is not None}
+    # looked up concurrently, adverts whose lookup failed or timed out
+    # are sent without distances
+    coordinates = geocoder.geocode_many(queries.values())
+    located, points = [], []
+    for advert, query in queries.items():
+        if (start := coordinates[query]):
+            located.append(advert)
+            points.append(start)
+    pois = list(pointsOfInterestCoordinates.keys())
+    matrix = distances_module.distance_matrix(points,\
+        [pointsOfInterestCoordinates[poi] for poi in pois])
+    for advert, row in zip(located, matrix):
+        advert.set_value("distances", dict(zip(pois, row)))
+    return len(located)
 
 def set_routes(advert, pointsOfInterestRoute):
     """Generate google maps strings and store them in advert."""
-    if (address := advert.address):
+    if (address := advert.get_value("address")) is not None:
         routes = [f"https://www.google.com/maps/dir/" +\
-                  f"{urllib.parse.quote_plus(address.get())}/" +\
+                  f"{urllib.parse.quote_plus(address)}/" +\
                   f"{urllib.parse.quote_plus(dest)}"\
                     for dest in pointsOfInterestRoute]
-        advert.routes.set(routes)
+        advert.set_value("routes", routes)
         return True
     else:
         return False
 
 def filter_advert(advert, searchParameters):
     """Filter advert based on the search parameters."""
-    if advert.price and advert.price.get() > searchParameters.maxPrice:
-        return False
-    if advert.size and advert.size.get() < searchParameters.minSize:
-        return False
-    if advert.moveInDate and\
-            type(advert.moveInDate.get()) == dt.datetime and\
-            advert.moveInDate.get() < searchParameters.moveInLower:
-        return False
-    if advert.moveInDate and\
-            type(advert.moveInDate.get()) == dt.datetime and\
-            advert.moveInDate.get() > searchParameters.moveInUpper:
-        return False
-    if advert.moveOutDate and\
-            type(advert.moveOutDate.get()) == dt.datetime and\
-            advert.moveOutDate.get() < searchParameters.moveOutLower:
-        return False
-    if advert.moveOutDate and\
-            type(advert.moveOutDate.get()) == dt.datetime and\
-            advert.moveOutDate.get() > searchParameters.moveOutUpper:
-        return False
-    return True
+    return compile_filter(searchParameters)(advert)
 
-def translate_advert(advert, language):
+def translate_advert(advert, language, translator=None):
     """Translate title and description."""
-    if not language: return advert
-    if (title := advert.title):
-        translatedTitle = deep_translator.GoogleTranslator(\
-            source='auto', target=language).translate(title.get())
-        title.set(translatedTitle)
-    if (description := advert.description):
-        translatedDescription = deep_translator.GoogleTranslator(\
-            source='auto', target=language).translate(description.get())
-        description.set(translatedDescription[:MAX_DESCRIPTION_LEN])
+    return translate_adverts([advert], language, translator)[0]
+
+def translate_adverts(adverts, language, translator=None):
+    """Translate title and description of several adverts at once."""
+    if not language: return adverts
+    translator = translator if translator else Translator()
+    with metrics.timer("enrich_seconds", step="translate"):
+        return translator.translate_adverts(adverts, language, MAX_DESCRIPTION_LEN)
@@ -0,0 +1,81 @@
+import hashlib
+import logging
+import threading
+from seenoffers import today
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Entries of search urls that were not requested for this long are dropped.
+MAX_AGE_DAYS = 30
+
+class ResponseCache():
+    """
+    Persistent cache of search page responses, keyed by url. It stores the
+    HTTP validators (ETag, Last-Modified) for conditional requests and a hash
+    of the offer list, so an unchanged page can be skipped without parsing it
+    even if the site does not support conditional requests.
+    """
+    def __init__(self, entries=None):
+        self._entries = entries if entries else {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fragment_hash(fragments):
+        """Hash of the relevant page content, e.g. the offer ids in order.
+        None if nothing relevant was found (never counts as unchanged)."""
+        if not fragments:
+            return None
+        return hashlib.sha1("\n".join(fragments).encode()).hexdigest()
+
+    def conditional_headers(self, url):
+        """Headers for a conditional GET of url."""
+        with self._lock:
+            entry = self._entries.get(url, {})
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("lastModified"):
+            headers["If-Modified-Since"] = entry["lastModified"]
+        return headers
+
+    def make_entry(self, resp, fragmentHash):
+        return {
+            "etag": resp.headers.get("ETag"),
+            "lastModified": resp.headers.get("Last-Modified"),
+            "hash": fragmentHash,
+            "day": today(),
+        }
+
+    def is_unchanged(self, url, entry):
+        """Check if a fresh entry has the same offer list as the cached one."""
+        with self._lock:
+            cached = self._entries.get(url)
+        return bool(cached and entry["hash"] and cached["hash"] == entry["hash"])
+
+    def store(self, url, entry):
+        """Remember entry. Only call this once the page was fully handled,
+        otherwise offers of a failed run would be skipped next time."""
+        with self._lock:
+            self._entries[url] = entry
+
+    def touch(self, url):
+        """Mark an unchanged entry as still in use."""
+        with self._lock:
+            if url in self._entries:
+                self._entries[url]["day"] = today()
+
+    def clear(self):
+        """Forget all pages, so every search page is handled again."""
+        with self._lock:
+            self._entries = {}
+
+    def to_serializable(self):
+        with self._lock:
+            return dict(self._entries)
+
+    @classmethod
+    def from_serializable(cls, data, maxAgeDays=MAX_AGE_DAYS):
+        oldest = today() - maxAgeDays
+        return cls({url: entry for (url, entry) in data.items()\
+                    if entry.get("day", 0) >= oldest})
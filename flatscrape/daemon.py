@@ -0,0 +1,227 @@
+import heapq
+import json
+import logging
+import signal
+import threading
+import time
+from flatscrape import build_pipeline, dump_state, load_services, scrape_search,\
+    scraper_options, start_messengers, PERSISTANCY_FILE_LOCAL
+import metrics
+from messenger import SlidingWindowLimiter
+from scraper import EbayScraper, WgGesuchtScraper
+import seenoffers
+from statestore import LocalFileState
+from tenants import load_tenants, subscriptions, close_broadcasters
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Bounds of the poll interval of a search url in seconds, can be overridden
+# with the POLL_INTERVALS event option, e.g. {"min": 60, "max": 1800}
+MIN_POLL_SECONDS = 120
+MAX_POLL_SECONDS = 3600
+# The interval of a search url aims at this many new offers per poll
+TARGET_NEW_PER_POLL = 1
+# Weight of the latest poll in the moving average of the new offer rate
+RATE_SMOOTHING = 0.3
+# Search url polls per site and hour, overridden with POLL_BUDGETS. The
+# requests of a poll are throttled by FETCH_LIMITS as in a single run.
+POLL_BUDGETS = {"ebay": 60, "wggesucht": 120}
+# The state is saved this often, the ids of sent messages are journaled
+# right away
+SAVE_SECONDS = 600
+INTERVAL_BUCKETS = (60, 120, 300, 600, 900, 1800, 3600, 7200)
+SCRAPERS = {"ebay": EbayScraper, "wggesucht": WgGesuchtScraper}
+
+class PollSchedule():
+    """
+    When to poll a search url next. The rate of new offers is a moving
+    average over the recent polls, and the interval is chosen so that a
+    poll finds about TARGET_NEW_PER_POLL new offers: busy searches are
+    polled often, quiet ones rarely. A url without history is polled at
+    once and then every minSeconds until it has a rate.
+    """
+    def __init__(self, url, rate=None, lastPoll=None, minSeconds=MIN_POLL_SECONDS,\
+            maxSeconds=MAX_POLL_SECONDS):
+        self.url = url
+        self.rate = rate # new offers per second
+        self.lastPoll = lastPoll # epoch seconds
+        self.minSeconds = minSeconds
+        self.maxSeconds = maxSeconds
+
+    @property
+    def interval(self):
+        if self.rate is None:
+            return self.minSeconds
+        if self.rate <= 0:
+            return self.maxSeconds
+        return min(max(TARGET_NEW_PER_POLL / self.rate, self.minSeconds), self.maxSeconds)
+
+    def next_poll(self):
+        return self.lastPoll + self.interval if self.lastPoll else 0
+
+    def record(self, numNew, now=None):
+        """Update the rate with a poll that found numNew new offers, None if
+        the poll failed."""
+        now = time.time() if now is None else now
+        if numNew is not None and self.lastPoll and now > self.lastPoll:
+            # offers of a long pause (e.g. a restart) count as one interval
+            observed = numNew / min(now - self.lastPoll, self.maxSeconds)
+            self.rate = observed if self.rate is None else\
+                RATE_SMOOTHING * observed + (1 - RATE_SMOOTHING) * self.rate
+        self.lastPoll = now
+
+    def to_serializable(self):
+        return {"rate": self.rate, "lastPoll": self.lastPoll}
+
+    @classmethod
+    def from_serializable(cls, url, data, **kwargs):
+        return cls(url, data.get("rate"), data.get("lastPoll"), **kwargs)
+
+
+class Daemon():
+    """
+    Long running mode, driven by the same event as main(). Services,
+    caches, POI coordinates, tenants and the seen offers are kept in memory
+    between polls, and every search url is polled on its own PollSchedule,
+    within a budget of polls per site and hour. Adverts go through the same
+    pipeline as in a single run. The state is saved every saveSeconds, the
+    poll schedules with it.
+    """
+    def __init__(self, awsEvent, stateStore, services=None, saveSeconds=SAVE_SECONDS):
+        self._event = awsEvent
+        self._stateStore = stateStore
+        self._overrides = services
+        self._saveSeconds = saveSeconds
+        self._stop = threading.Event()
+        self.schedules = {} # url -> PollSchedule
+
+    def stop(self):
+        """Stop polling, send what is queued, save and return from run()."""
+        self._stop.set()
+
+    def run(self):
+        event = self._event
+        state = self._stateStore.load()
+        maxAgeDays = event.get("SEEN_MAX_AGE_DAYS", seenoffers.MAX_AGE_DAYS)
+        self.seenOffers = seenoffers.load_seen_offers(state, maxAgeDays=maxAgeDays)
+        self.explored = seenoffers.load_explored_offers(state.get("explored", {}),\
+            maxAgeDays=maxAgeDays)
+        self.services = load_services(event, state, self._overrides)
+        self.tenants = load_tenants(event, state, self.services["geocoder"],\
+            self.services["transport"], maxAgeDays, self.seenOffers)
+        self.pipeline = build_pipeline(self.tenants, self.services["geocoder"],\
+            self.services["translator"], workers=event.get("PIPELINE_WORKERS"),\
+            duplicateIndex=self.services["duplicateIndex"], explored=self.explored,\
+            responseCache=self.services["responseCache"])
+        intervals = event.get("POLL_INTERVALS", {})
+        budgets = {**POLL_BUDGETS, **event.get("POLL_BUDGETS", {})}
+        savedSchedules = state.get("pollSchedule", {})
+        siteThreads = []
+        for site, scraperClass in SCRAPERS.items():
+            polls = []
+            for url, flatType, subscribers in subscriptions(self.tenants, site):
+                self.schedules[url] = PollSchedule.from_serializable(url,\
+                    savedSchedules.get(url, {}),\
+                    minSeconds=intervals.get("min", MIN_POLL_SECONDS),\
+                    maxSeconds=intervals.get("max", MAX_POLL_SECONDS))
+                polls.append((self.schedules[url], flatType, subscribers))
+            if not polls:
+                continue
+            # one scraper per site, it is only used by the site's thread
+            scraper = scraperClass(self.explored[site],\
+                fetchEngine=self.services["fetchEngine"],\
+                responseCache=self.services["responseCache"],\
+                parsePool=self.services["parsePool"],\
+                **scraper_options(self.tenants))
+            budget = SlidingWindowLimiter(budgets[site], 3600, 0)
+            siteThreads.append(threading.Thread(target=self._poll_site,\
+                args=(site, scraper, budget, polls)))
+        for t in siteThreads:
+            t.start()
+        messengerThreads = start_messengers(self.tenants, self.seenOffers,\
+            self._stateStore, self.services["responseCache"], self.explored)
+        logger.info(f"Polling {len(self.schedules)} search urls")
+        while not self._stop.wait(self._saveSeconds):
+            self.save()
+        for t in siteThreads:
+            t.join()
+        self.pipeline.close()
+        for tenant in self.tenants:
+            tenant.messenger.close()
+        for t in messengerThreads:
+            t.join()
+        close_broadcasters(self.tenants)
+        self.services["fetchEngine"].close()
+        if self.services["parsePool"]:
+            self.services["parsePool"].shutdown()
+        self.save()
+        return True
+
+    def _poll_site(self, site, scraper, budget, polls):
+        """Poll the search urls of a site, the one due first at a time."""
+        due = [(schedule.next_poll(), i) for (i, (schedule, _, _)) in enumerate(polls)]
+        heapq.heapify(due)
+        while True:
+            nextPoll, i = due[0]
+            if self._stop.wait(max(nextPoll - time.time(), 0)):
+                return
+            while (waitTime := budget.wait_time()) > 0:
+                if self._stop.wait(waitTime):
+                    return
+            heapq.heappop(due)
+            schedule, flatType, subscribers = polls[i]
+            budget.record()
+            start = time.time()
+            metrics.observe("poll_delay_seconds", max(start - nextPoll, 0),\
+                INTERVAL_BUCKETS, site=site)
+            try:
+                numNew = scrape_search(scraper, self.pipeline, schedule.url,\
+                    flatType, subscribers)
+            except Exception:
+                logger.exception(f"Polling {schedule.url} failed")
+                numNew = None
+            schedule.record(numNew, start)
+            metrics.count("polls", site=site, result="error" if numNew is None else "ok")
+            if numNew is not None:
+                metrics.observe("poll_new_offers", numNew, metrics.SIZE_BUCKETS, site=site)
+            metrics.observe("poll_interval_seconds", schedule.interval,\
+                INTERVAL_BUCKETS, site=site)
+            logger.debug(f"{numNew} new offers on {schedule.url}, "
+                         f"next poll in {schedule.interval:.0f}s")
+            heapq.heappush(due, (schedule.next_poll(), i))
+
+    def save(self):
+        """Evict expired entries, then save the seen offers, caches and poll
+        schedules."""
+        for store in list(self.seenOffers.values()) + list(self.explored.values()):
+            store.evict()
+        for tenant in self.tenants:
+            for store in (tenant.seenOffers or {}).values():
+                store.evict()
+        # the caches live as long as the daemon, a run reloads them
+        services = self.services
+        for cache in [services["duplicateIndex"], services["geocoder"],\
+                      services["translator"]]:
+            if cache is not None and hasattr(cache, "evict"):
+                cache.evict()
+        state = dump_state(self.seenOffers, self.tenants, self.services, self.explored)
+        state["pollSchedule"] = {url: schedule.to_serializable()\
+                                 for (url, schedule) in self.schedules.items()}
+        with metrics.timer("state_seconds", operation="write"):
+            self._stateStore.finish_run(state, self.seenOffers,\
+                {tenant.name: tenant.seenOffers for tenant in self.tenants\
+                 if tenant.seenOffers is not None}, self.explored)
+
+
+if __name__ == '__main__':
+    # python daemon.py event.json [metrics port]
+    import sys
+    with open(sys.argv[1], "r") as f:
+        awsEvent = json.load(f)
+    if len(sys.argv) > 2:
+        metrics.METRICS.serve_prometheus(int(sys.argv[2]))
+    daemon = Daemon(awsEvent, LocalFileState(PERSISTANCY_FILE_LOCAL))
+    signal.signal(signal.SIGTERM, lambda *_: daemon.stop())
+    signal.signal(signal.SIGINT, lambda *_: daemon.stop())
+    daemon.run()
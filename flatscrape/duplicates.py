@@ -0,0 +1,224 @@
+import hashlib
+import logging
+import re
+import threading
+from advert import advert_site
+from distances import load_numpy
+from seenoffers import today
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Signatures of adverts not seen for this long are dropped.
+MAX_AGE_DAYS = 30
+SIMHASH_BITS = 64
+# Near duplicates differ in at most MAX_DISTANCE bits of their simhash
+# (reposts with an edited title differ in up to about 10 bits, different
+# flats in 18 or more). A lookup only compares the adverts that share one of
+# NUM_BANDS bit ranges: signatures that differ in fewer bits than there are
+# bands always share one (pigeonhole), those up to MAX_DISTANCE very likely.
+MAX_DISTANCE = 10
+NUM_BANDS = 5
+# A text match alone is not enough (titles are short and similar), price and
+# size have to agree as well where both adverts have them, and the address
+# must not differ (see addresses_agree).
+MAX_PRICE_DIFFERENCE = 0.05
+MAX_SIZE_DIFFERENCE = 2
+
+_UMLAUTS = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss"})
+
+def normalise_text(text):
+    """Lower case words without umlauts and punctuation."""
+    return re.findall(r"[a-z0-9]+", text.lower().translate(_UMLAUTS))
+
+def addresses_agree(a, b):
+    """
+    Check if two normalised addresses can be the same flat: postcodes do
+    not differ, and the rest of one address is part of the other, e.g.
+    "berlin mitte" (only the district on one site) agrees with
+    "musterstrasse 1 berlin mitte". A missing address agrees with any.
+    """
+    if not a or not b:
+        return True
+    a, b = set(a.split()), set(b.split())
+    postcodesA = {word for word in a if re.fullmatch(r"\d{5}", word)}
+    postcodesB = {word for word in b if re.fullmatch(r"\d{5}", word)}
+    if postcodesA and postcodesB and not postcodesA & postcodesB:
+        return False
+    a, b = a - postcodesA, b - postcodesB
+    return a <= b or b <= a
+
+def _digest(token):
+    # stable across processes, unlike hash()
+    return hashlib.blake2b(token.encode(), digest_size=SIMHASH_BITS // 8).digest()
+
+# Without numpy, every bit of a hash is spread to its own 32 bit lane of a
+# large int, so the bits of all token hashes are counted with a few big int
+# additions instead of a loop over the 64 bits of every token.
+_LANE = 32
+_SPREAD = [[sum(1 << (_LANE * (8 * byte + bit)) for bit in range(8) if value >> bit & 1)\
+            for value in range(256)] for byte in range(SIMHASH_BITS // 8)]
+
+def _bit_counts_python(digests):
+    counts = 0 # number of hashes with the bit set, per lane
+    for digest in digests:
+        for byte, spread in zip(digest, _SPREAD):
+            counts += spread[byte]
+    mask = (1 << _LANE) - 1
+    return [counts >> (_LANE * bit) & mask for bit in range(SIMHASH_BITS)]
+
+def simhash(words):
+    """64 bit simhash of the words and word pairs, similar texts differ in
+    few bits. Bit i is byte i // 8, bit i % 8 of the token digests."""
+    tokens = words + [f"{a} {b}" for (a, b) in zip(words, words[1:])]
+    digests = [_digest(token) for token in tokens]
+    if (np := load_numpy()):
+        bits = np.unpackbits(np.frombuffer(b"".join(digests), dtype=np.uint8)\
+            .reshape(-1, SIMHASH_BITS // 8), axis=1, bitorder="little")
+        counts = bits.sum(axis=0).tolist()
+    else:
+        counts = _bit_counts_python(digests)
+    return sum(1 << bit for (bit, count) in enumerate(counts) if 2 * count > len(tokens))
+
+_BAND_BOUNDS = [SIMHASH_BITS * band // NUM_BANDS for band in range(NUM_BANDS + 1)]
+
+def _bands(signature):
+    return [(band, signature >> low & ((1 << (high - low)) - 1)) for (band, (low, high))\
+            in enumerate(zip(_BAND_BOUNDS, _BAND_BOUNDS[1:]))]
+
+def advert_key(advert):
+    """Exact key of address, price and size, None if one is missing."""
+    address, price, size = (advert.get_value(name) for name in ["address", "price", "size"])
+    if address is None or price is None or size is None:
+        return None
+    return f"{' '.join(normalise_text(address))}|{price}|{size}"
+
+def advert_signature(advert):
+    """Persisted signature of an advert (a json serialisable dict). Both
+    sites have title and address, wg-gesucht adverts have no description.
+    The simhash is of the title only, as the sites show the address in
+    different detail, the address is compared on its own."""
+    address = advert.get_value("address")
+    text = advert.get_value("title")
+    return {
+        "simhash": simhash(normalise_text(text)) if text else None,
+        "key": advert_key(advert),
+        "address": " ".join(normalise_text(address)) if address else None,
+        "price": advert.get_value("price"),
+        "size": advert.get_value("size"),
+        "users": [],
+        "day": today(),
+    }
+
+
+class DuplicateIndex():
+    """
+    Signatures of recent adverts across sites and runs, to find the same
+    flat listed on both sites or reposted under a new id before it is
+    enriched and sent again. Entries are keyed by "<site>:<id>" and record
+    the users the flat was passed on to, so a user still gets a flat whose
+    first copy only matched someone else. Lookups use a dict for the exact
+    key and simhash bands for near duplicates, so they stay fast as the
+    index grows.
+    """
+    def __init__(self, entries=None, maxAgeDays=MAX_AGE_DAYS):
+        self._maxAgeDays = maxAgeDays
+        self._entries = {}
+        self._keys = {} # exact key -> entry ids
+        self._bands = {} # (band, value) -> entry ids
+        self._lock = threading.Lock()
+        for entryId, entry in (entries if entries else {}).items():
+            self._index(entryId, entry)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _index(self, entryId, entry):
+        self._entries[entryId] = entry
+        if entry["key"]:
+            self._keys.setdefault(entry["key"], set()).add(entryId)
+        if entry["simhash"] is not None:
+            for band in _bands(entry["simhash"]):
+                self._bands.setdefault(band, set()).add(entryId)
+
+    def _unindex(self, entryId):
+        entry = self._entries.pop(entryId)
+        lookups = [(self._keys, entry["key"])] if entry["key"] else []
+        if entry["simhash"] is not None:
+            lookups += [(self._bands, band) for band in _bands(entry["simhash"])]
+        for lookup, value in lookups:
+            ids = lookup[value]
+            ids.discard(entryId)
+            if not ids:
+                del lookup[value]
+
+    def evict(self, maxAgeDays=None):
+        """Forget adverts not seen for maxAgeDays. Return number of evicted
+        entries."""
+        maxAgeDays = self._maxAgeDays if maxAgeDays is None else maxAgeDays
+        oldest = today() - maxAgeDays
+        with self._lock:
+            expired = [entryId for (entryId, entry) in self._entries.items()\
+                       if entry["day"] < oldest]
+            for entryId in expired:
+                self._unindex(entryId)
+        return len(expired)
+
+    @staticmethod
+    def _close(a, b, maxDifference):
+        return a is None or b is None or abs(a - b) <= maxDifference
+
+    def _is_near(self, signature, entry):
+        if signature["simhash"] is None or entry["simhash"] is None:
+            return False
+        if bin(signature["simhash"] ^ entry["simhash"]).count("1") > MAX_DISTANCE:
+            return False
+        # entries of older versions have no address
+        if not addresses_agree(signature["address"], entry.get("address")):
+            return False
+        price = signature["price"]
+        return self._close(price, entry["price"],\
+                           MAX_PRICE_DIFFERENCE * price if price else 0) and\
+            self._close(signature["size"], entry["size"], MAX_SIZE_DIFFERENCE)
+
+    def _find(self, entryId, signature):
+        """Ids of the other adverts that signature duplicates."""
+        found = set(self._keys.get(signature["key"], ())) if signature["key"] else set()
+        if signature["simhash"] is not None:
+            candidates = set()
+            for band in _bands(signature["simhash"]):
+                candidates.update(self._bands.get(band, ()))
+            found.update(c for c in candidates if self._is_near(signature, self._entries[c]))
+        found.discard(entryId)
+        return found
+
+    def check(self, advert, user):
+        """
+        Record that advert is passed on to user, unless user already got a
+        duplicate of it. Return the id of that duplicate or None.
+        """
+        entryId = f"{advert_site(advert)}:{advert.get_value('adid')}"
+        with self._lock:
+            entry = self._entries.get(entryId)
+            if entry is None:
+                entry = advert_signature(advert)
+                self._index(entryId, entry)
+            entry["day"] = today()
+            duplicates = [d for d in self._find(entryId, entry)\
+                          if user in self._entries[d]["users"]]
+            if user not in entry["users"]:
+                # the advert itself may come again, e.g. from another search url
+                entry["users"].append(user)
+            return min(duplicates) if duplicates else None
+
+    def to_serializable(self):
+        with self._lock:
+            return {entryId: dict(entry, users=list(entry["users"]))\
+                    for (entryId, entry) in self._entries.items()}
+
+    @classmethod
+    def from_serializable(cls, data, maxAgeDays=MAX_AGE_DAYS):
+        """Inverse of to_serializable, expired entries are dropped."""
+        oldest = today() - maxAgeDays
+        return cls({entryId: entry for (entryId, entry) in data.items()\
+                    if entry.get("day", 0) >= oldest}, maxAgeDays)
@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+import urllib
+import requests
+import requests.adapters
+import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Politeness budget per host, if nothing else is configured.
+DEFAULT_LIMITS = {
+    "rate": 0.5,       # sustained requests per second
+    "burst": 3,        # requests that may be sent without waiting
+    "concurrency": 2,  # requests in flight at the same time
+}
+# Hosts of the site keys used throughout the configuration
+SITE_HOSTS = {"ebay": ["www.ebay-kleinanzeigen.de"], "wggesucht": ["www.wg-gesucht.de"]}
+
+class TokenBucket():
+    """Thread safe token bucket. Tokens are reserved on acquire, so
+    concurrent callers are spaced out instead of all waking up at once."""
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available. Return the time waited."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst,\
+                self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            self._tokens -= 1
+            waitTime = -self._tokens / self._rate if self._tokens < 0 else 0
+        if waitTime:
+            time.sleep(waitTime)
+        return waitTime
+
+
+class _Host():
+    """Connection pool and limits for a single host."""
+    def __init__(self, limits):
+        self.limits = limits
+        self.bucket = TokenBucket(limits["rate"], limits["burst"])
+        self.slots = threading.BoundedSemaphore(limits["concurrency"])
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(\
+            pool_connections=1, pool_maxsize=limits["concurrency"])
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+
+class FetchEngine():
+    """
+    Shared HTTP client for all scrapers. Keeps one keep-alive session per
+    host and enforces a per-host rate (token bucket) and concurrency limit.
+
+    Limits are given per site as {"ebay": {"rate": 1, "concurrency": 3}},
+    with the site keys of SITE_HOSTS or host names; missing values fall back
+    to DEFAULT_LIMITS.
+    """
+    def __init__(self, siteLimits=None, timeout=30):
+        self._hostLimits = {} # host name -> configured limits
+        for site, limits in (siteLimits or {}).items():
+            if site in SITE_HOSTS:
+                for hostname in SITE_HOSTS[site]:
+                    self._hostLimits[hostname] = limits
+            elif "." in site:
+                self._hostLimits[site] = limits
+            else:
+                logger.warning(f"Ignoring limits of unknown site {site}, "
+                               f"use one of {list(SITE_HOSTS)} or a host name")
+        self._timeout = timeout
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _get_host(self, url):
+        hostname = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if hostname not in self._hosts:
+                limits = {**DEFAULT_LIMITS, **self._hostLimits.get(hostname, {})}
+                logger.debug(f"New host {hostname} with limits {limits}")
+                self._hosts[hostname] = _Host(limits)
+            return self._hosts[hostname]
+
+    def concurrency(self, url):
+        """Number of requests that may be in flight for the host of url."""
+        return self._get_host(url).limits["concurrency"]
+
+    def _target_url(self, url):
+        """Url that is actually requested for url."""
+        return url
+
+    def get(self, url, headers=None):
+        """requests.get within the politeness budget of the host."""
+        host = self._get_host(url)
+        hostname = urllib.parse.urlsplit(url).netloc
+        with host.slots:
+            metrics.observe("fetch_throttle_seconds", host.bucket.acquire(),\
+                host=hostname)
+            with metrics.timer("fetch_seconds", host=hostname):
+                resp = host.session.get(self._target_url(url), headers=headers,\
+                    timeout=self._timeout)
+        metrics.count("fetch_requests", host=hostname, status=resp.status_code)
+        metrics.count("fetch_bytes", len(resp.content), host=hostname)
+        return resp
+
+    def close(self):
+        with self._lock:
+            for host in self._hosts.values():
+                host.session.close()
+            self._hosts = {}
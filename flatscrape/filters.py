@@ -0,0 +1,113 @@
+import bisect
+import datetime as dt
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+def _bound(val):
+    """Date bounds that could not be parsed do not restrict anything."""
+    return val if type(val) == dt.datetime else None
+
+def compile_filter(searchParameters):
+    """
+    Compile search parameters into a predicate advert -> bool, equivalent
+    to filter_advert. The bounds are bound once and every advert field is
+    read once through the fast record access.
+    """
+    maxPrice = searchParameters.maxPrice
+    minSize = searchParameters.minSize
+    moveInLower = _bound(searchParameters.moveInLower)
+    moveInUpper = _bound(searchParameters.moveInUpper)
+    moveOutLower = _bound(searchParameters.moveOutLower)
+    moveOutUpper = _bound(searchParameters.moveOutUpper)
+    def predicate(advert):
+        price = advert.get_value("price")
+        if price is not None and price > maxPrice:
+            return False
+        size = advert.get_value("size")
+        if size is not None and size < minSize:
+            return False
+        moveIn = advert.get_value("moveInDate")
+        if type(moveIn) == dt.datetime and (\
+                (moveInLower and moveIn < moveInLower) or\
+                (moveInUpper and moveIn > moveInUpper)):
+            return False
+        moveOut = advert.get_value("moveOutDate")
+        if type(moveOut) == dt.datetime and (\
+                (moveOutLower and moveOut < moveOutLower) or\
+                (moveOutUpper and moveOut > moveOutUpper)):
+            return False
+        return True
+    return predicate
+
+
+class _SortedBound():
+    """
+    Profiles sorted by one bound. For a value, the profiles whose bound
+    admits it are a prefix (lower bounds) or a suffix (upper bounds) of the
+    sorted list, found by bisection.
+    """
+    def __init__(self, bounds, isUpper):
+        # profiles without this bound admit every value
+        self._unbounded = [key for (key, bound) in bounds if bound is None]
+        bounded = sorted(((bound, key) for (key, bound) in bounds\
+                          if bound is not None), key=lambda b: b[0])
+        self._bounds = [bound for (bound, _) in bounded]
+        self._keys = [key for (_, key) in bounded]
+        self._isUpper = isUpper
+
+    def _range(self, val):
+        if self._isUpper:
+            return bisect.bisect_left(self._bounds, val), len(self._bounds)
+        return 0, bisect.bisect_right(self._bounds, val)
+
+    def count(self, val):
+        start, end = self._range(val)
+        return end - start + len(self._unbounded)
+
+    def keys(self, val):
+        start, end = self._range(val)
+        return self._keys[start:end] + self._unbounded
+
+
+class ProfileIndex():
+    """
+    Match adverts against many search profiles. Each profile is compiled
+    into a predicate, and the profiles are indexed by their price, size and
+    date bounds. For an advert, the index with the fewest admitted profiles
+    (found in O(log n) each) gives the candidates, which are then checked
+    with their predicates.
+    """
+    def __init__(self, profiles):
+        """profiles: dict key -> SearchParameters"""
+        self._predicates = {key: compile_filter(params)\
+                            for (key, params) in profiles.items()}
+        def bounds(attribute, convert=_bound):
+            return [(key, convert(getattr(params, attribute)))\
+                    for (key, params) in profiles.items()]
+        number = lambda val: val
+        # (advert field, index)
+        self._indexes = [
+            ("price", _SortedBound(bounds("maxPrice", number), True)),
+            ("size", _SortedBound(bounds("minSize", number), False)),
+            ("moveInDate", _SortedBound(bounds("moveInLower"), False)),
+            ("moveInDate", _SortedBound(bounds("moveInUpper"), True)),
+            ("moveOutDate", _SortedBound(bounds("moveOutLower"), False)),
+            ("moveOutDate", _SortedBound(bounds("moveOutUpper"), True)),
+        ]
+
+    def __len__(self):
+        return len(self._predicates)
+
+    def match(self, advert):
+        """Keys of all profiles that accept the advert."""
+        best, bestCount, bestValue = None, len(self._predicates), None
+        for field, index in self._indexes:
+            val = advert.get_value(field)
+            if val is None or (field.endswith("Date") and type(val) != dt.datetime):
+                continue
+            if (count := index.count(val)) < bestCount:
+                best, bestCount, bestValue = index, count, val
+        candidates = best.keys(bestValue) if best else self._predicates.keys()
+        return [key for key in candidates if self._predicates[key](advert)]
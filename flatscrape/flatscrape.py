@@ -1,13 +1,23 @@
+import concurrent.futures
 import datetime as dt
 import json
 import logging
 import os
 import threading
 import time
-from advert import filter_advert, set_distances, set_routes, translate_advert
-from DataStorage import SearchParameters
-from messenger import Messenger
-from scraper import WgGesuchtScraper, EbayScraper
+from advert import advert_ids, advert_site, set_distances_batch, set_routes, translate_adverts
+from cache import ResponseCache
+from duplicates import DuplicateIndex
+from fetch import FetchEngine
+from filters import ProfileIndex
+from geocoding import Geocoder
+import metrics
+from pipeline import Stage, Pipeline
+from scraper import WgGesuchtScraper, EbayScraper, MAX_PAGES, make_parse_pool
+import seenoffers
+from statestore import LocalFileState
+from tenants import load_tenants, dump_tenants, subscriptions, close_broadcasters
+from translation import Translator
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -17,58 +27,171 @@ ALL_RUN_IDS = [ID_EBAY, ID_WG_SHARE, ID_WG_NOSHARE] = 0,1,2
 # For testing (non-lambda deployment)
 PERSISTANCY_FILE_LOCAL = "exploredIds.json"
 
-def ebay(exploredOfferIDs, messenger, searchParameters):
-    """ Handle ebay search URLs """
-    scraper = EbayScraper(exploredOfferIDs)
-    for searchURL in searchParameters.ebayUrls:
-        scrapedAdverts = scraper.scrape_search_page(searchURL)
-        for advert in scrapedAdverts:
-            if not advert.price:
-                # Some weird load/captcha problem with ebay
-                continue
-            if not filter_advert(advert, searchParameters):
+# Worker threads per pipeline stage, can be overridden per stage with the
+# PIPELINE_WORKERS event option. Geocoding and translation wait on remote
+# services, so they get more workers and take adverts in batches.
+PIPELINE_WORKERS = {"match": 1, "dedupe": 1, "distances": 2, "routes": 1,\
+                    "translate": 2, "send": 1}
+PIPELINE_BATCH_SIZES = {"distances": 16, "translate": 16}
+
+def _group_by_tenant(batch):
+    groups = {}
+    for tenant, advert in batch:
+        groups.setdefault(tenant.name, (tenant, []))[1].append(advert)
+    return groups.values()
+
+def build_pipeline(tenants, geocoder=None, translator=None, profileIndex=None,\
+        workers=None, duplicateIndex=None, explored=None, responseCache=None):
+    """
+    Pipeline that filters and enriches scraped adverts per tenant and passes
+    them to the tenants' messengers: match -> dedupe -> distances -> routes
+    -> translate -> send. Scrapers put (advert, subscribers, flatType) items.
+    Geocoding and translation are cached, so adverts shared by several
+    tenants are only looked up once. With a duplicateIndex, adverts a tenant
+    already got from the other site or under an older id are dropped before
+    they are enriched, and their claims released. The adverts of a failed
+    stage are released and removed from the explored offers (site ->
+    ExploredOffers), and the responseCache is cleared, so the next run
+    scrapes them again.
+    """
+    if profileIndex is None:
+        # matches adverts against all tenants' filters at once
+        profileIndex = ProfileIndex({tenant.name: tenant.searchParameters\
+                                     for tenant in tenants})
+    workers = {**PIPELINE_WORKERS, **(workers if workers else {})}
+    def match(batch):
+        matched = [] # (tenant, advert)
+        for advert, subscribers, flatType in batch:
+            # names of the tenants whose filters accept the advert
+            names = set(profileIndex.match(advert))
+            for tenant in subscribers:
+                # claimed once, the advert may come from several urls
+                if tenant.name not in names or not tenant.claim(advert):
+                    continue
+                tenantAdvert = advert
+                if len(subscribers) > 1:
+                    # every tenant gets its own distances, routes and language
+                    tenantAdvert = advert.copy()
+                if flatType:
+                    tenantAdvert.flatType.set(flatType)
+                matched.append((tenant, tenantAdvert))
+        return matched
+    def dedupe(batch):
+        unique = []
+        for tenant, advert in batch:
+            if (duplicate := duplicateIndex.check(advert, tenant.name)):
+                logger.debug(f"Dropping {advert.get_value('adid')}, duplicate of {duplicate}")
+                metrics.count("duplicates_dropped", site=advert_site(advert))
+                tenant.release(advert_ids([advert]))
                 continue
-            set_distances(advert,\
-                searchParameters.poiDistances,\
-                searchParameters.city)
-            set_routes(advert, searchParameters.poiRoutes)
-            if (language := searchParameters.translate):
-                translate_advert(advert, language)
-            logger.info("Handling advert ebay")
-            messenger.handle_advert(advert)
+            unique.append((tenant, advert))
+        return unique
+    def distances(batch):
+        for tenant, adverts in _group_by_tenant(batch):
+            searchParameters = tenant.searchParameters
+            set_distances_batch(adverts, searchParameters.poiDistances,\
+                searchParameters.city, geocoder)
+        return batch
+    def routes(batch):
+        for tenant, advert in batch:
+            set_routes(advert, tenant.searchParameters.poiRoutes)
+        return batch
+    def translate(batch):
+        for tenant, adverts in _group_by_tenant(batch):
+            if (language := tenant.searchParameters.translate):
+                translate_adverts(adverts, language, translator)
+        return batch
+    def send(batch):
+        for tenant, advert in batch:
+            tenant.messenger.handle_advert(advert)
+        return []
+    functions = [("match", match), ("dedupe", dedupe), ("distances", distances),\
+                 ("routes", routes), ("translate", translate), ("send", send)]
+    def on_failed(stageName, batch):
+        # the match stage gets the scraped items, the later ones claimed
+        # (tenant, advert) items
+        if stageName == "match":
+            adverts = [advert for (advert, _, _) in batch]
+        else:
+            adverts = [advert for (_, advert) in batch]
+            for tenant, advert in batch:
+                tenant.release(advert_ids([advert]))
+        for site, offerIds in advert_ids(adverts).items():
+            if explored and site in explored:
+                explored[site].discard(offerIds)
+        if responseCache:
+            responseCache.clear()
+    stages = [Stage(name, function, workers[name],\
+                    PIPELINE_BATCH_SIZES.get(name, 1))\
+              for (name, function) in functions\
+              if name != "dedupe" or duplicateIndex is not None]
+    return Pipeline(stages, on_failed)
+
+def scraper_options(tenants):
+    """Scraper settings, shared by all tenants of a site."""
+    return {
+        "fastParse": any(t.searchParameters.fastParse for t in tenants),
+        "maxPages": max((t.searchParameters.maxPages for t in tenants\
+                         if t.searchParameters.maxPages), default=MAX_PAGES),
+    }
+
+def scrape_search(scraper, pipeline, searchURL, flatType, subscribers):
+    """Put the new adverts of one search url into the pipeline, return
+    their number."""
+    numAdverts = 0
+    for advert in scraper.iter_search_page(searchURL):
+        # Some weird load/captcha problem with ebay
+        if advert_site(advert) == "ebay" and advert.get_value("price") is None:
+            continue
+        pipeline.put((advert, subscribers, flatType))
+        numAdverts += 1
+    return numAdverts
+
+def scrape_searches(scraper, pipeline, searches, workers=1):
+    """
+    Put the new adverts of the searches [(url, flat type, subscribers)] of a
+    site into the pipeline, workers urls at a time, so that some pages are
+    fetched while others are parsed in the parse pool. A failing url does
+    not stop the others (of other tenants). Return the number of adverts
+    per url.
+    """
+    flatTypes = {} # url -> [(flat type, subscribers)]
+    for searchURL, flatType, subscribers in searches:
+        flatTypes.setdefault(searchURL, []).append((flatType, subscribers))
+    def scrape(searchURL):
+        # one after the other, the later flat types skip the explored offers
+        numAdverts = 0
+        for flatType, subscribers in flatTypes[searchURL]:
+            try:
+                numAdverts += scrape_search(scraper, pipeline, searchURL,\
+                    flatType, subscribers)
+            except Exception:
+                logger.exception(f"Scraping {searchURL} failed")
+        return numAdverts
+    numWorkers = max(1, min(workers, len(flatTypes)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=numWorkers) as pool:
+        return dict(zip(flatTypes, pool.map(scrape, flatTypes)))
+
+def ebay(exploredOfferIDs, tenants, pipeline, fetchEngine=None,\
+        responseCache=None, parsePool=None, scrapeWorkers=1):
+    """ Handle ebay search URLs of all tenants """
+    scraper = EbayScraper(exploredOfferIDs, fetchEngine=fetchEngine,\
+        responseCache=responseCache, parsePool=parsePool,\
+        **scraper_options(tenants))
+    numAdverts = scrape_searches(scraper, pipeline,\
+        subscriptions(tenants, "ebay"), scrapeWorkers)
+    for num in numAdverts.values():
+        logger.info(f"Handling {num} adverts ebay")
     return True
 
-def wggesucht(exploredOfferIDs, messenger, searchParameters, flatshare=True):
-    """ Handle wggesucht search URLs """
-    scraper = WgGesuchtScraper(exploredOfferIDs)
-    for searchURL in searchParameters.wggesuchtFlatUrls:
-        scrapedAdverts = scraper.scrape_search_page(searchURL)
-        for advert in scrapedAdverts:
-            if not filter_advert(advert, searchParameters):
-                continue
-            advert.flatType.set("Individual Apartment")
-            set_distances(advert,\
-                searchParameters.poiDistances,\
-                searchParameters.city)
-            set_routes(advert, searchParameters.poiRoutes)
-            if (language := searchParameters.translate):
-                translate_advert(advert, language)
-            messenger.handle_advert(advert)
-    if not flatshare:
-        return True
-    for searchURL in searchParameters.wggesuchtWGUrls:
-        scrapedAdverts = scraper.scrape_search_page(searchURL)
-        for advert in scrapedAdverts:
-            if not filter_advert(advert, searchParameters):
-                continue
-            advert.flatType.set("Shared Flat (WG)")
-            set_distances(advert,\
-                searchParameters.poiDistances,\
-                searchParameters.city)
-            set_routes(advert, searchParameters.poiRoutes)
-            if (language := searchParameters.translate):
-                translate_advert(advert, language)
-            messenger.handle_advert(advert)
+def wggesucht(exploredOfferIDs, tenants, pipeline, flatshare=True,\
+        fetchEngine=None, responseCache=None, parsePool=None, scrapeWorkers=1):
+    """ Handle wggesucht search URLs of all tenants """
+    scraper = WgGesuchtScraper(exploredOfferIDs, fetchEngine=fetchEngine,\
+        responseCache=responseCache, parsePool=parsePool,\
+        **scraper_options(tenants))
+    scrape_searches(scraper, pipeline,\
+        subscriptions(tenants, "wggesucht", flatshare), scrapeWorkers)
     return True
 
 # These functions are not used in lambda (uses s3 for persistency)
@@ -80,46 +203,188 @@ def get_seen_offers():
 
 def dump_seen_offers(seenOffers):
     with open(PERSISTANCY_FILE_LOCAL, "w") as jsonfile:
-        json.dump(seenOffers, jsonfile)
- 
+        json.dump(seenOffers, jsonfile, separators=(",", ":"))
+
+def load_services(awsEvent, state, overrides=None):
+    """
+    Clients and caches shared by all scrapers and tenants, the caches
+    restored from state. overrides optionally replaces the network clients
+    (fetchEngine, geocoder, translator, transport).
+    """
+    overrides = overrides if overrides else {}
+    # rate, concurrency and timeout of the enrichment services
+    enrichLimits = awsEvent.get("ENRICH_LIMITS", {})
+    duplicateIndex = None
+    if awsEvent.get("DEDUPLICATE", True):
+        duplicateIndex = DuplicateIndex.from_serializable(\
+            state.get("duplicateIndex", {}))
+    return {
+        # one engine for all scrapers, so limits hold per host across threads
+        "fetchEngine": overrides.get("fetchEngine") or\
+            FetchEngine(awsEvent.get("FETCH_LIMITS")),
+        "responseCache": ResponseCache.from_serializable(\
+            state.get("responseCache", {})),
+        "geocoder": overrides.get("geocoder") or\
+            Geocoder.from_serializable(state.get("geocodeCache", {}),\
+                **enrichLimits.get("geocoder", {})),
+        "translator": overrides.get("translator") or\
+            Translator.from_serializable(state.get("translationCache", {}),\
+                **enrichLimits.get("translator", {})),
+        # None: one telegram transport per bot token, see load_tenants
+        "transport": overrides.get("transport"),
+        "duplicateIndex": duplicateIndex,
+        # pages are parsed in the scraper threads without PARSE_WORKERS
+        "parsePool": make_parse_pool(awsEvent.get("PARSE_WORKERS")),
+    }
+
+def dump_state(seenOffers, tenants, services, explored=None):
+    """The state to persist: seen offers of all sites and tenants, the
+    explored offers per search url and the caches of services."""
+    state = seenoffers.dump_seen_offers(seenOffers)
+    if explored is not None:
+        state["explored"] = seenoffers.dump_explored_offers(explored)
+    state["users"] = dump_tenants(tenants)
+    state["responseCache"] = services["responseCache"].to_serializable()
+    state["geocodeCache"] = services["geocoder"].to_serializable()
+    state["translationCache"] = services["translator"].to_serializable()
+    if services["duplicateIndex"] is not None:
+        state["duplicateIndex"] = services["duplicateIndex"].to_serializable()
+    return state
+
+def start_messengers(tenants, seenOffers, stateStore=None, responseCache=None,\
+        explored=None):
+    """
+    Start a dispatcher thread per tenant, which sends its queued adverts
+    until the messenger is closed. Sent ids are added to seenOffers and the
+    tenant's seen offers, and journaled by the stateStore. The ids of
+    messages that reached nobody are removed from the explored offers
+    (site -> ExploredOffers), and the responseCache is cleared, so the next
+    run scrapes and sends them again.
+    """
+    def run_messenger(tenant):
+        def on_sent(handledIds):
+            logger.info(f"Handled the ids for {tenant.name}: {handledIds}")
+            # journaled by record_sent, so finish_run leaves them out
+            journaled = stateStore is not None
+            seenOffers["ebay"].update(handledIds["ebay"], journaled=journaled)
+            seenOffers["wggesucht"].update(handledIds["wggesucht"], journaled=journaled)
+            tenant.mark_sent(handledIds, journaled)
+            if stateStore:
+                # kept even if the run dies before the end
+                stateStore.record_sent(handledIds,\
+                    tenant.name if tenant.seenOffers is not None else None)
+        def on_failed(failedIds):
+            # scraped again, so the adverts get another chance
+            logger.warning(f"Could not send the ids for {tenant.name}: {failedIds}")
+            tenant.release(failedIds)
+            for site, offerIds in failedIds.items():
+                if explored and site in explored:
+                    explored[site].discard(offerIds)
+            if responseCache:
+                # the search pages are unchanged, but their offers are not done
+                responseCache.clear()
+        tenant.messenger.run(on_sent, on_failed)
+    threads = [threading.Thread(target=run_messenger, args=(tenant,))\
+               for tenant in tenants]
+    for t in threads:
+        t.start()
+    return threads
+
 def main(awsEvent,\
         read_offer_method=get_seen_offers,\
         write_offer_method=dump_seen_offers,\
-        runIds = [ID_EBAY, ID_WG_SHARE, ID_WG_NOSHARE]):
-    seenOffers = read_offer_method()
-    searchParameters = SearchParameters(awsEvent)
-    messenger = Messenger(awsEvent.get("TELEGRAM_BOT_TOKEN"),\
-        awsEvent.get("TELEGRAM_USER_IDS"))
+        runIds = [ID_EBAY, ID_WG_SHARE, ID_WG_NOSHARE],\
+        services=None, stateStore=None):
+    """
+    Scrape all search urls once and send new offers to every user. The event
+    is either a single user's configuration or has one per user in USERS.
+    services optionally replaces the network clients (fetchEngine, geocoder,
+    translator, transport), e.g. with local stand-ins for benchmarks.
+    A stateStore (statestore.JournaledState) replaces read_offer_method and
+    write_offer_method, it journals the handled ids as messages are sent.
+    Return the metrics summary of the run.
+    """
+    runStart = time.perf_counter()
+    # metrics are kept per process, the run's share is the difference
+    metricsStart = metrics.METRICS.snapshot()
+    # the persisted state holds the seen offers and the caches
+    with metrics.timer("state_seconds", operation="read"):
+        state = stateStore.load() if stateStore else read_offer_method()
+    maxAgeDays = awsEvent.get("SEEN_MAX_AGE_DAYS", seenoffers.MAX_AGE_DAYS)
+    # offers sent to any tenant, and the offers scraped per search url
+    seenOffers = seenoffers.load_seen_offers(state, maxAgeDays=maxAgeDays)
+    explored = seenoffers.load_explored_offers(state.get("explored", {}),\
+        maxAgeDays=maxAgeDays)
+    services = load_services(awsEvent, state, services)
+    tenants = load_tenants(awsEvent, state, services["geocoder"],\
+        services["transport"], maxAgeDays, seenOffers)
+    # scrapers hand their adverts to the pipeline as soon as they are parsed
+    pipeline = build_pipeline(tenants, services["geocoder"],\
+        services["translator"], workers=awsEvent.get("PIPELINE_WORKERS"),\
+        duplicateIndex=services["duplicateIndex"], explored=explored,\
+        responseCache=services["responseCache"])
+    # services shared by all scraper threads
+    scraperServices = {key: services[key] for key in\
+                       ["fetchEngine", "responseCache", "parsePool"]}
+    # a search url per parse worker, so each worker has a page to parse
+    scraperServices["scrapeWorkers"] = awsEvent.get("PARSE_WORKERS") or 1
     # Build thread list. First, generate list of all threads, then remove
     # those that are not to be started.
+    runIds = list(runIds)
     if ID_WG_SHARE in runIds and ID_WG_NOSHARE in runIds:
         runIds.remove(ID_WG_NOSHARE)
     allThreads = [None for _ in ALL_RUN_IDS]
     allThreads[ID_EBAY] = threading.Thread(\
         target=ebay,\
-        args=(seenOffers["ebay"], messenger, searchParameters,))
+        args=(explored["ebay"], tenants, pipeline,),\
+        kwargs=scraperServices)
     allThreads[ID_WG_SHARE] = threading.Thread(\
         target=wggesucht,\
-        args=(seenOffers["wggesucht"], messenger, searchParameters,))
+        args=(explored["wggesucht"], tenants, pipeline, True,),\
+        kwargs=scraperServices)
     allThreads[ID_WG_NOSHARE] = threading.Thread(\
         target=wggesucht,\
-        args=(seenOffers["wggesucht"], messenger, searchParameters, False))
+        args=(explored["wggesucht"], tenants, pipeline, False,),\
+        kwargs=scraperServices)
     scrapeThreads = [allThreads[i] for i in runIds]
     for t in scrapeThreads:
         t.start()
-    while any(map(lambda t: t.is_alive(), scrapeThreads)) or messenger.check_queue():
-        handledIds = messenger.handle_queue()
-        if handledIds:
-            logger.info(f"Handled the ids: {handledIds}")
-            seenOffers["ebay"] += handledIds["ebay"]
-            seenOffers["wggesucht"] += handledIds["wggesucht"]
-            logger.info(f"Current offers: {seenOffers}")
-    logger.debug(f"Writing {seenOffers}")
-    write_offer_method(seenOffers)
+    def close_when_scraped():
+        for t in scrapeThreads:
+            t.join()
+        # all adverts have reached the messengers once the pipeline is drained
+        pipeline.close()
+        for tenant in tenants:
+            tenant.messenger.close()
+    threading.Thread(target=close_when_scraped).start()
+    messengerThreads = start_messengers(tenants, seenOffers, stateStore,\
+        services["responseCache"], explored)
+    # blocks until the scrapers are done and the last message is sent
+    for t in messengerThreads:
+        t.join()
+    close_broadcasters(tenants)
+    logger.debug(f"Writing {len(seenOffers['ebay'])} ebay and "+\
+                 f"{len(seenOffers['wggesucht'])} wggesucht ids")
+    services["fetchEngine"].close()
+    if services["parsePool"]:
+        services["parsePool"].shutdown()
+    state = dump_state(seenOffers, tenants, services, explored)
+    with metrics.timer("state_seconds", operation="write"):
+        if stateStore:
+            stateStore.finish_run(state, seenOffers, {tenant.name: tenant.seenOffers\
+                for tenant in tenants if tenant.seenOffers is not None}, explored)
+        else:
+            write_offer_method(state)
+    metrics.observe("run_seconds", time.perf_counter() - runStart)
+    summary = metrics.METRICS.summary(since=metricsStart)
+    # one json message, so log tools (e.g. cloudwatch) can query the fields
+    logger.info(json.dumps({"runMetrics": summary}, separators=(",", ":")))
+    return summary
 
 if __name__ == '__main__':
     # test case
     import sys
     with open(sys.argv[1], "r") as f:
         awsEvent = json.load(f)
-    main(awsEvent)
+    # same snapshot format as get_seen_offers/dump_seen_offers
+    main(awsEvent, stateStore=LocalFileState(PERSISTANCY_FILE_LOCAL))
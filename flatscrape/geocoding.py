@@ -0,0 +1,210 @@
+import concurrent.futures
+import logging
+import re
+import threading
+import time
+from fetch import TokenBucket
+import metrics
+from seenoffers import today
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Addresses hardly move, failed lookups are retried sooner in case the
+# advert address was fixed or the backend had a hiccup.
+TTL_DAYS = 180
+NEGATIVE_TTL_DAYS = 7
+# Nominatim usage policy: at most one request per second
+NOMINATIM_RATE = 1.0
+# Backend requests at the same time. Requests queue for the rate limit, the
+# timeout counts from when a request starts. A lookup that is not done by
+# then is given up on and the advert goes out without distances, the
+# request still finishes and is cached. A batch of lookups is waited for at
+# most BATCH_TIMEOUT_SECONDS in all, the queued ones are still looked up.
+CONCURRENCY = 1
+TIMEOUT_SECONDS = 10
+BATCH_TIMEOUT_SECONDS = 20
+
+class NominatimBackend():
+    """Geocoding with the public Nominatim service."""
+    def __init__(self, userAgent="flatscrape"):
+        # imported here, only runs that look up addresses need it
+        import geopy
+        self._client = geopy.Nominatim(user_agent=userAgent)
+
+    def geocode(self, query):
+        """Return (latitude, longitude) of query or None."""
+        location = self._client.geocode(query)
+        if not location:
+            return None
+        return (location.latitude, location.longitude)
+
+
+class StaticBackend():
+    """Geocoding from a fixed table, as local stand-in for tests."""
+    def __init__(self, coordinates, default=None):
+        self._coordinates = {Geocoder.normalize(address): coords\
+                             for (address, coords) in coordinates.items()}
+        self._default = default
+        self.requests = 0
+
+    def geocode(self, query):
+        self.requests += 1
+        return self._coordinates.get(Geocoder.normalize(query), self._default)
+
+
+class Geocoder():
+    """
+    Geocoding with a persistent cache of normalised address -> coordinates.
+    Misses are cached as well (with a shorter TTL). Concurrent lookups of the
+    same address wait for a single backend request. Backend requests run in
+    a pool of concurrency threads, are rate limited and waited for at most
+    timeout seconds after they started, and a batch at most batchTimeout
+    seconds.
+    """
+    def __init__(self, backend=None, entries=None, rate=NOMINATIM_RATE,\
+            ttlDays=TTL_DAYS, negativeTtlDays=NEGATIVE_TTL_DAYS,\
+            concurrency=CONCURRENCY, timeout=TIMEOUT_SECONDS,\
+            batchTimeout=BATCH_TIMEOUT_SECONDS):
+        self._backend = backend # created on the first lookup if None
+        self._entries = entries if entries else {} # address -> {"coords", "day"}
+        self._bucket = TokenBucket(rate, 1)
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency,\
+            thread_name_prefix="geocode")
+        self._timeout = timeout
+        self._batchTimeout = batchTimeout
+        self._ttlDays = ttlDays
+        self._negativeTtlDays = negativeTtlDays
+        self._inflight = {} # address -> future of the backend request
+        self._started = {} # address -> start of its running backend request
+        self._lock = threading.Lock()
+        # notified when a backend request starts or ends
+        self._requestChanged = threading.Condition(self._lock)
+
+    def _get_backend(self):
+        with self._lock:
+            if self._backend is None:
+                self._backend = NominatimBackend()
+            return self._backend
+
+    @staticmethod
+    def normalize(address):
+        """Cache key of an address: lower case, no punctuation, single spaces."""
+        return " ".join(re.sub(r"[,;.]", " ", address.lower()).split())
+
+    def _is_fresh(self, entry):
+        ttl = self._ttlDays if entry["coords"] else self._negativeTtlDays
+        return entry["day"] >= today() - ttl
+
+    def _fresh_entry(self, key):
+        entry = self._entries.get(key)
+        return entry if entry and self._is_fresh(entry) else None
+
+    def _request(self, key, address):
+        """Cached coordinates of address and None, or None and the future of
+        the backend request."""
+        with self._lock:
+            if (entry := self._fresh_entry(key)):
+                metrics.count("geocode_cache", result="hit")
+                return tuple(entry["coords"]) if entry["coords"] else None, None
+            if (future := self._inflight.get(key)) is None:
+                # nobody else is looking this address up
+                metrics.count("geocode_cache", result="miss")
+                future = self._inflight[key] = self._pool.submit(self._lookup,\
+                    key, address)
+            return None, future
+
+    def _lookup(self, key, address):
+        """Backend request, runs in the pool."""
+        coords = None
+        try:
+            metrics.observe("geocode_throttle_seconds", self._bucket.acquire())
+            with self._lock:
+                self._started[key] = time.monotonic()
+                self._requestChanged.notify_all()
+            with metrics.timer("geocode_seconds"):
+                coords = self._get_backend().geocode(address)
+            logger.debug(f"Geocoded {address}")
+            with self._lock:
+                self._entries[key] = {"coords": list(coords) if coords else None,\
+                                      "day": today()}
+        except Exception:
+            # not cached, errors are usually temporary
+            logger.exception(f"Could not geocode {address}")
+        finally:
+            with self._lock:
+                del self._inflight[key]
+                self._started.pop(key, None)
+                self._requestChanged.notify_all()
+        return tuple(coords) if coords else None
+
+    def _wait(self, key, future, deadline=None):
+        """Result of a backend request, waited for until timeout seconds
+        after it started, but not past the deadline (time.monotonic()) of
+        the batch."""
+        with self._lock:
+            # queued behind the rate limit and the other requests
+            while key not in self._started and self._inflight.get(key) is future:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise concurrent.futures.TimeoutError()
+                self._requestChanged.wait(None if deadline is None else\
+                    deadline - time.monotonic())
+            started = self._started.get(key)
+        # no start: the request is done or just finishing
+        end = None if started is None or self._timeout is None else\
+            started + self._timeout
+        if deadline is not None:
+            end = deadline if end is None else min(end, deadline)
+        return future.result(None if end is None else max(end - time.monotonic(), 0))
+
+    def geocode(self, address, wait=False):
+        """Return (latitude, longitude) of address or None. With wait, the
+        lookup is not given up on after the timeout."""
+        return self.geocode_many([address], wait)[address]
+
+    def geocode_many(self, addresses, wait=False):
+        """Geocode several addresses, each distinct address at most once,
+        with the backend requests running concurrently. Return a dict
+        address -> coordinates or None, also for lookups that timed out.
+        Without wait, the batch returns after batchTimeout seconds at the
+        latest. Lookups are not cancelled, they fill the cache when they
+        are done."""
+        deadline = None if wait or self._batchTimeout is None else\
+            time.monotonic() + self._batchTimeout
+        results, pending = {}, {}
+        for address in addresses:
+            if address in results:
+                continue
+            key = self.normalize(address)
+            results[address], future = self._request(key, address)
+            if future:
+                pending[address] = (key, future)
+        for address, (key, future) in pending.items():
+            try:
+                results[address] = future.result() if wait else\
+                    self._wait(key, future, deadline)
+            except concurrent.futures.TimeoutError:
+                logger.warning(f"Geocoding {address} timed out")
+                metrics.count("enrich_timeouts", service="geocoder")
+        return results
+
+    def evict(self):
+        """Forget expired entries. Return the number of evicted ones."""
+        with self._lock:
+            expired = [key for (key, entry) in self._entries.items()\
+                       if not self._is_fresh(entry)]
+            for key in expired:
+                del self._entries[key]
+        return len(expired)
+
+    def to_serializable(self):
+        with self._lock:
+            return dict(self._entries)
+
+    @classmethod
+    def from_serializable(cls, data, **kwargs):
+        """Inverse of to_serializable, expired entries are dropped."""
+        geocoder = cls(**kwargs)
+        geocoder._entries = {key: entry for (key, entry) in data.items()\
+                             if geocoder._is_fresh(entry)}
+        return geocoder
@@ -1,27 +1,106 @@
+import collections
 import datetime as dt
 import logging
 import threading
 import time
-import telegram
+from advert import advert_ids
+import metrics
+from priority import PriorityQueue, advert_score
+from transport import Broadcaster, TelegramTransport, PER_CHAT_RATE, GLOBAL_RATE
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-# Distance limit, at which point offers become less interesting. This is not
-# a hard filter, only to determine the priority of a message.
-DISTANCE_LIMIT_PRIO = 6
+# Telegram limits, with some margin
+MAX_MESSAGE_LENGTH = 3500
+MAX_MESSAGES_PER_MINUTE = 10
+MIN_SECONDS_BETWEEN_MESSAGES = 3
+# The adverts of a sweep (a run, or a poll of the daemon) arrive in a burst.
+# A new sweep starts when the queue is empty or no advert came for this long.
+SWEEP_GAP_SECONDS = 60
+
+class SlidingWindowLimiter(object):
+    """
+    At most maxEvents events in any window of windowSeconds, and at least
+    minInterval seconds between two events. Old events are dropped from the
+    left of a deque, so accounting is amortised O(1).
+    """
+    def __init__(self, maxEvents=MAX_MESSAGES_PER_MINUTE, windowSeconds=60,\
+            minInterval=MIN_SECONDS_BETWEEN_MESSAGES):
+        self.maxEvents = maxEvents
+        self.windowSeconds = windowSeconds
+        self.minInterval = minInterval
+        self._times = collections.deque()
+        self._lock = threading.Lock()
+
+    def wait_time(self):
+        """Seconds until the next event is allowed."""
+        with self._lock:
+            now = time.monotonic()
+            while self._times and self._times[0] <= now - self.windowSeconds:
+                self._times.popleft()
+            if not self._times:
+                return 0
+            waitTime = self._times[-1] + self.minInterval - now
+            if len(self._times) >= self.maxEvents:
+                waitTime = max(waitTime,\
+                    self._times[0] + self.windowSeconds - now)
+            return max(waitTime, 0)
+
+    def remaining(self):
+        """Number of events still allowed in the current window."""
+        self.wait_time() # drop old events
+        with self._lock:
+            return self.maxEvents - len(self._times)
+
+    def wait(self):
+        """Block until the next event is allowed."""
+        while (waitTime := self.wait_time()) > 0:
+            time.sleep(waitTime)
+
+    def record(self):
+        with self._lock:
+            self._times.append(time.monotonic())
+
+
+def make_broadcaster(teleBotToken, transport=None, limits=None):
+    """Broadcaster of a bot, within the perChatRate and globalRate of
+    limits (see Messenger)."""
+    limits = limits if limits else {}
+    return Broadcaster(transport if transport else TelegramTransport(teleBotToken),\
+        perChatRate=limits.get("perChatRate", PER_CHAT_RATE),\
+        globalRate=limits.get("globalRate", GLOBAL_RATE))
+
 
 class Messenger(object):
     """Send messages via telegram"""
-    def __init__(self, teleBotToken, teleUserIds, translate=None):
+    def __init__(self, teleBotToken, teleUserIds, translate=None, transport=None,\
+            limits=None, priorityWeights=None, broadcaster=None):
+        """limits: optional {"perMinute", "minInterval", "perChatRate",
+        "globalRate"} to replace the telegram limits. priorityWeights:
+        optional weights of the advert score, see priority.DEFAULT_WEIGHTS.
+        broadcaster: shared by the messengers of one bot, so its global rate
+        holds across them (see make_broadcaster), closed by the owner"""
         self.teleBotToken = teleBotToken
         self.teleUserIds = teleUserIds
+        limits = limits if limits else {}
+        # one bot for all messages, recipients are sent to concurrently
+        self._ownsBroadcaster = broadcaster is None
+        self.broadcaster = broadcaster if broadcaster else\
+            make_broadcaster(teleBotToken, transport, limits)
         self.joiner = ""
-        self.individualMessagesQueue = []
-        self.bulkMessageQueue = []
-        self.individualMessageLock = threading.Lock()
-        self.bulkMessageLock = threading.Lock()
-        self.sendTimes = []
+        # best scored adverts are sent first, the worst folded into bulk
+        self.individualMessagesQueue = PriorityQueue()
+        self.priorityWeights = priorityWeights
+        # start of the current sweep and arrival of the last advert
+        self.sweepStarted = self.lastQueued = time.monotonic()
+        self.bulkMessageQueue = collections.deque()
+        # guards both queues, notified when adverts are queued or on close
+        self.queueCondition = threading.Condition()
+        self.closed = False
+        self.limiter = SlidingWindowLimiter(\
+            limits.get("perMinute", MAX_MESSAGES_PER_MINUTE), 60,\
+            limits.get("minInterval", MIN_SECONDS_BETWEEN_MESSAGES))
         self.translate = translate
 
     def handle_advert(self, advert):
@@ -30,54 +109,73 @@ class Messenger(object):
         the advert information to the end user.
         """
         individual = self.should_send_individually(advert)
-        self.add_to_queue(advert, individual=individual)    
+        now = time.monotonic()
+        with self.queueCondition:
+            if not len(self.individualMessagesQueue) or\
+                    now - self.lastQueued > SWEEP_GAP_SECONDS:
+                self.sweepStarted = now
+            self.lastQueued = now
+        score = advert_score(advert, self.priorityWeights,\
+            (now - self.sweepStarted) / 60)
+        self.add_to_queue(advert, individual=individual, score=score)
 
     def should_send_individually(self, advert):
         """
         Determine whether an advert should be sent in a separate or bulk
         message. The reason for bulk messaging is that there is a limit on
-        the number of messages we can sent in a time frame. The decision is
-        made based on attractiveness of the advert and the current demand on
-        messaging.
+        the number of messages we can sent in a time frame. Only exchange
+        offers go to bulk right away, the others are queued by their score
+        and the worst ones are folded into bulk when the budget gets tight
+        (see _fold_low_scorers).
         """
-        if advert.title and "tausch" in advert.title.get().lower():
-            return False
-        if advert.distances and \
-                all(map(lambda d: d > DISTANCE_LIMIT_PRIO, advert.distances.get().values())):
-            return False
-        # if many messages are queued and it is wg, it is low priority
-        if len(self.individualMessagesQueue) > 9 and advert.flatType and \
-                advert.flatType.get().lower() in ["wg", "wohngemeinschaft"]:
+        if "tausch" in advert.get_value("title", "").lower():
             return False
         return True
 
-    def add_to_queue(self, msg, individual=True):
-        """Thread safe queueing for asynchronous messaging."""
+    def add_to_queue(self, msg, individual=True, score=0):
+        """Thread safe queueing for asynchronous messaging. Individual
+        messages are sent by descending score."""
         logger.debug(f"Adding to queue {individual=}")
-        queue = self.individualMessagesQueue if individual else self.bulkMessageQueue
-        lock = self.individualMessageLock if individual else self.bulkMessageLock
-        lock.acquire()
-        logger.debug("Queue lock acquired")
-        queue.append(msg)
-        lock.release()
-        logger.debug("Queue lock released")
+        with self.queueCondition:
+            if individual:
+                self.individualMessagesQueue.push(msg, score)
+                depth = len(self.individualMessagesQueue)
+            else:
+                self.bulkMessageQueue.append(msg)
+                depth = len(self.bulkMessageQueue)
+            self.queueCondition.notify()
+        metrics.observe("messenger_queue_depth", depth, metrics.SIZE_BUCKETS,\
+            queue="individual" if individual else "bulk")
         return True
 
+    def close(self):
+        """Signal that no more adverts will be queued. The dispatcher sends
+        what is left and then returns."""
+        with self.queueCondition:
+            self.closed = True
+            self.queueCondition.notify_all()
+
     def send_message(self, msg):
-        """Public method for sending the message via telegram."""
-        self._send_message_telegram(msg)
-        self.sendTimes.append(time.time())
+        """Public method for sending the message via telegram. Return whether
+        it reached at least one recipient, None if every recipient rejected
+        it."""
+        with metrics.timer("message_send_seconds"):
+            sent = self._send_message_telegram(msg)
+        metrics.count({True: "messages_sent", None: "messages_rejected",\
+                       False: "messages_failed"}[sent])
+        self.limiter.record()
+        return sent
 
 
     def _send_message_telegram(self, msg):
         """Private method for sending message. Not to be called directly."""
-        try:
-            for teleUserId in self.teleUserIds:
-                telegram.Bot(self.teleBotToken).send_message(teleUserId, msg[:3500],\
-                    disable_notification=True)
-        except ValueError as e:
-            logger.critical("Error sending message: ", e)
-            
+        results = self.broadcaster.broadcast(self.teleUserIds, msg[:MAX_MESSAGE_LENGTH])
+        if not all(results.values()):
+            logger.critical(f"Error sending message: {results}")
+        if any(results.values()):
+            return True
+        rejected = results and all(sent is None for sent in results.values())
+        return None if rejected else False
 
     def wait_until_message_can_be_sent(self):
         """
@@ -85,60 +183,118 @@ class Messenger(object):
             1. no more than ten messages sent in last minute
             2. at least 3 seconds have passed since last message
         """
-        while len(list(filter(lambda t: t >= time.time() - 60, self.sendTimes))) >= 10:
-            time.sleep(0.1)
-        if len(self.sendTimes) > 0:
-            time.sleep(max(self.sendTimes[-1] - time.time() + 3, 0))
+        with metrics.timer("message_wait_seconds"):
+            self.limiter.wait()
         return True
 
     def create_bulk_message(self):
         """
         Pop as many messages off the bulk queue while staying within the length
-        limit.
-        """
-        sendList = []
-        while len(self.bulkMessageQueue) > 0:
-            if len(self.joiner.join(
-                list(map(str, sendList)) +\
-                    [str(self.bulkMessageQueue[0])])) < 3500:
-                sendList.append(self.bulkMessageQueue.pop(0))
-            else:
-                break
+        limit. Adverts are packed first fit decreasing: the longest ones are
+        placed first and the short ones fill the remaining space, so fewer,
+        fuller messages are needed. The message keeps the queue order.
+        """
+        if not self.bulkMessageQueue:
+            return []
+        lengths = [len(str(ad)) for ad in self.bulkMessageQueue]
+        chosen = set()
+        messageLength = 0
+        for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+            addedLength = lengths[i] + (len(self.joiner) if chosen else 0)
+            if messageLength + addedLength < MAX_MESSAGE_LENGTH or not chosen:
+                chosen.add(i)
+                messageLength += addedLength
+        sendList = [ad for (i, ad) in enumerate(self.bulkMessageQueue) if i in chosen]
+        self.bulkMessageQueue = collections.deque(\
+            ad for (i, ad) in enumerate(self.bulkMessageQueue) if i not in chosen)
         return sendList
 
     def check_queue(self):
         """Check if asynchronous messenger is finished."""
         return len(self.individualMessagesQueue) + len(self.bulkMessageQueue) > 0
 
+    def _fold_low_scorers(self):
+        """
+        Move the worst individual adverts to the bulk queue until they fit
+        the messages left in the current window, keeping one message for
+        bulk. The best advert is always kept. Call with queueCondition held.
+        """
+        budget = self.limiter.remaining()
+        folded = 0
+        while len(self.individualMessagesQueue) > max(budget - 1, 1):
+            self.bulkMessageQueue.append(self.individualMessagesQueue.pop_worst())
+            folded += 1
+        if folded:
+            logger.debug(f"Folded {folded} adverts into bulk, {budget=}")
+            metrics.count("adverts_folded", folded)
+
+    def _pop_send_list(self):
+        """Adverts for the next message, the best individual one first."""
+        with self.queueCondition:
+            if self.individualMessagesQueue:
+                self._fold_low_scorers()
+                return [self.individualMessagesQueue.pop_best()]
+            if self.bulkMessageQueue:
+                return self.create_bulk_message()
+        return []
+
+    def _send_adverts(self, sendList):
+        """Send adverts as one message, return the advert ids per site, or
+        None if no recipient got the message. Adverts of a message that was
+        rejected by every recipient count as handled, sending them again
+        would fail the same way."""
+        logger.debug("Sending message")
+        msg = self.joiner.join(list(map(str, sendList)))
+        if (sent := self.send_message(msg)) is None:
+            metrics.count("adverts_rejected", len(sendList))
+            return advert_ids(sendList)
+        if not sent:
+            metrics.count("adverts_failed", len(sendList))
+            return None
+        metrics.count("adverts_sent", len(sendList))
+        return advert_ids(sendList)
+
     def handle_queue(self):
         """
         Generate a message from the queues and send it. Return the advert ids
-        that were covered by the message.
+        that were covered by the message, None if nothing was sent.
         """
-        if self.individualMessagesQueue or\
-                self.bulkMessageQueue:
+        if self.check_queue():
             self.wait_until_message_can_be_sent()
-            sendList = []
-            if len(self.individualMessagesQueue) > 0:
-                self.individualMessageLock.acquire()
-                sendList = [self.individualMessagesQueue.pop(0)]
-                self.individualMessageLock.release()
-            elif len(self.bulkMessageQueue) > 0:
-                self.bulkMessageLock.acquire()
-                sendList = self.create_bulk_message()
-                self.bulkMessageLock.release()
-            if sendList:
-                logger.debug("Sending message")
-                msg = self.joiner.join(list(map(str, sendList)))
-                self.send_message(msg)
-                handledIds = {"ebay": [], "wggesucht": []}
-                for ad in sendList:
-                    if ad.website and "ebay" in ad.website.get():
-                        site = "ebay"
-                    elif ad.website and "gesucht" in ad.website.get():
-                        site = "wggesucht"
-                    else:
-                        site = ""
-                    handledIds[site].append(ad.adid.get())
-                return handledIds
+            if (sendList := self._pop_send_list()):
+                return self._send_adverts(sendList)
         return None
+
+    def wait_for_send_list(self):
+        """
+        Block until a message may be sent and there is something to send,
+        then return the adverts for it. Return None once the messenger is
+        closed and both queues are empty.
+        """
+        while True:
+            with self.queueCondition:
+                self.queueCondition.wait_for(lambda: self.closed or self.check_queue())
+                if not self.check_queue():
+                    return None
+            # wait outside the lock, more bulk adverts can come in meanwhile
+            self.wait_until_message_can_be_sent()
+            if (sendList := self._pop_send_list()):
+                return sendList
+
+    def run(self, on_sent=None, on_failed=None):
+        """
+        Dispatch queued adverts until close() is called and the queues are
+        drained. on_sent is called with the handled ids of every message,
+        on_failed with the ids of a message that reached nobody (and was not
+        rejected by everybody), so they are not marked as seen and can be
+        sent again.
+        """
+        while (sendList := self.wait_for_send_list()) is not None:
+            if (handledIds := self._send_adverts(sendList)) is not None:
+                if on_sent:
+                    on_sent(handledIds)
+            elif on_failed:
+                on_failed(advert_ids(sendList))
+        if self._ownsBroadcaster:
+            self.broadcaster.close()
+        return True
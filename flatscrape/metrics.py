@@ -0,0 +1,180 @@
+import bisect
+import contextlib
+import http.server
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Upper bounds of the histogram buckets, in seconds for latencies
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+class Histogram():
+    """Count, sum and bucket counts of observed values (like prometheus)."""
+    def __init__(self, buckets=SECONDS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.count = self.count
+        histogram.sum = self.sum
+        return histogram
+
+    def minus(self, other):
+        """Observations since other, an earlier copy of this histogram."""
+        histogram = self.copy()
+        if other:
+            histogram.counts = [a - b for (a, b) in zip(self.counts, other.counts)]
+            histogram.count -= other.count
+            histogram.sum -= other.sum
+        return histogram
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Registry():
+    """
+    Counters and histograms of a process, keyed by name and labels. All
+    methods are thread safe. Values are cumulative, a run's share is taken
+    as the difference to a snapshot from its start.
+    """
+    def __init__(self):
+        self._counters = {} # (name, labels) -> value
+        self._histograms = {} # (name, labels) -> Histogram
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def count(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=SECONDS_BUCKETS, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(buckets)
+            self._histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observe the seconds spent in the with block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return (dict(self._counters),\
+                    {key: h.copy() for (key, h) in self._histograms.items()})
+
+    @staticmethod
+    def _name(name, labels):
+        if not labels:
+            return name
+        return name + "{" + ",".join(f'{k}="{v}"' for (k, v) in labels) + "}"
+
+    def summary(self, since=None):
+        """
+        Counters and histograms (count, sum, mean and bucket quantiles) as
+        a json serialisable dict, of everything since the snapshot since.
+        """
+        counters, histograms = self.snapshot()
+        oldCounters, oldHistograms = since if since else ({}, {})
+        result = {"counters": {}, "histograms": {}}
+        for (name, labels), value in sorted(counters.items()):
+            if (value := value - oldCounters.get((name, labels), 0)):
+                result["counters"][self._name(name, labels)] = round(value, 6)
+        for (name, labels), histogram in sorted(histograms.items()):
+            histogram = histogram.minus(oldHistograms.get((name, labels)))
+            if not histogram.count:
+                continue
+            result["histograms"][self._name(name, labels)] = {
+                "count": histogram.count,
+                "sum": round(histogram.sum, 6),
+                "mean": round(histogram.sum / histogram.count, 6),
+                "p50": histogram.quantile(0.5),
+                "p90": histogram.quantile(0.9),
+                "p99": histogram.quantile(0.99),
+            }
+        return result
+
+    def to_prometheus(self):
+        """All metrics in the prometheus text exposition format."""
+        counters, histograms = self.snapshot()
+        lines = []
+        for name in sorted({name for (name, _) in counters}):
+            lines.append(f"# TYPE flatscrape_{name} counter")
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"{self._name('flatscrape_' + name, labels)} {value}")
+        for name in sorted({name for (name, _) in histograms}):
+            lines.append(f"# TYPE flatscrape_{name} histogram")
+            for (n, labels), histogram in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    bucketLabels = labels + (("le", bound),)
+                    lines.append(f"{self._name(f'flatscrape_{name}_bucket', bucketLabels)} {cumulative}")
+                lines.append(f"{self._name(f'flatscrape_{name}_sum', labels)} {histogram.sum}")
+                lines.append(f"{self._name(f'flatscrape_{name}_count', labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def serve_prometheus(self, port, host="0.0.0.0"):
+        """Serve to_prometheus on http://host:port/metrics in a daemon
+        thread, for the long running mode. Return the server."""
+        registry = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"Serving metrics on port {port}")
+        return server
+
+
+# metrics of the whole process, shared by all modules
+METRICS = Registry()
+count = METRICS.count
+observe = METRICS.observe
+timer = METRICS.timer
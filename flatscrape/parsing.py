@@ -0,0 +1,50 @@
+import importlib.util
+import logging
+import bs4
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# lxml is a lot faster than the builtin parser, but it is optional (and
+# only imported by bs4 when a page is parsed)
+FAST_PARSER = "lxml" if importlib.util.find_spec("lxml") else "html.parser"
+
+def has_class(attrs, classes):
+    """Check the raw attributes of a tag for any of the given css classes."""
+    classValue = attrs.get("class") or ""
+    if not isinstance(classValue, str):
+        classValue = " ".join(classValue)
+    return any(c in classes for c in classValue.split())
+
+def has_attribute(attrs, name, values):
+    """Check the raw attributes of a tag for name in values."""
+    return attrs.get(name) in values
+
+if hasattr(bs4, "ElementFilter"):
+    # bs4 >= 4.13 passes the raw attributes to ElementFilter.allow_tag_creation
+    class _TagFilter(bs4.ElementFilter):
+        def __init__(self, keepTag):
+            super(_TagFilter, self).__init__()
+            self._keepTag = keepTag
+        def allow_tag_creation(self, nsprefix, name, attrs):
+            return self._keepTag(attrs or {})
+        def allow_string_creation(self, string):
+            return False
+
+    def make_strainer(keepTag):
+        return _TagFilter(keepTag)
+else:
+    # older versions call a name function with the name and raw attributes
+    def make_strainer(keepTag):
+        return bs4.SoupStrainer(lambda name, attrs=None: keepTag(dict(attrs or {})))
+
+def make_soup(text, keepTag=None):
+    """
+    Parse a page as soup. If keepTag is given, only the subtrees of tags for
+    which keepTag(attrs) is true are built (with the fast parser). All other
+    markup is skipped, so keepTag must accept every element that is searched
+    for later on.
+    """
+    if keepTag is None:
+        return bs4.BeautifulSoup(text, 'html.parser')
+    return bs4.BeautifulSoup(text, FAST_PARSER, parse_only=make_strainer(keepTag))
@@ -0,0 +1,110 @@
+import logging
+import queue
+import threading
+import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Items waiting in front of a stage. A full queue blocks the stage before
+# it (and eventually the scrapers), so a slow stage slows down the sweep
+# instead of buffering everything in memory.
+QUEUE_SIZE = 32
+_DONE = object() # end of input marker, one per worker
+
+class Stage():
+    """
+    One step of a pipeline. Worker threads take items from the input queue
+    and call function with a list of them: a single item, or up to
+    batchSize items that are already waiting (a batch never waits for more
+    items). function returns a list of items for the next stage, so it can
+    drop, pass on or multiply items. If function raises, the batch is
+    dropped and passed to on_failed(stage name, batch).
+    """
+    def __init__(self, name, function, workers=1, batchSize=1, queueSize=QUEUE_SIZE):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.batchSize = batchSize
+        self.input = queue.Queue(maxsize=queueSize)
+        self.next = None
+        self.on_failed = None
+        self._threads = []
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._work, name=f"{self.name}-{i}")\
+                         for i in range(self.workers)]
+        for t in self._threads:
+            t.start()
+
+    def _take_batch(self):
+        """Next batch and whether the input is finished for this worker."""
+        item = self.input.get()
+        if item is _DONE:
+            return [], True
+        batch = [item]
+        while len(batch) < self.batchSize:
+            try:
+                item = self.input.get_nowait()
+            except queue.Empty:
+                break
+            if item is _DONE:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _work(self):
+        done = False
+        while not done:
+            batch, done = self._take_batch()
+            if not batch:
+                continue
+            metrics.observe("pipeline_queue_depth", self.input.qsize(),\
+                metrics.SIZE_BUCKETS, stage=self.name)
+            try:
+                with metrics.timer("pipeline_stage_seconds", stage=self.name):
+                    results = self.function(batch)
+            except Exception:
+                logger.exception(f"Stage {self.name} failed, dropping {len(batch)} items")
+                self._fail(batch)
+                continue
+            if self.next:
+                for result in results:
+                    self.next.input.put(result)
+
+    def _fail(self, batch):
+        if not self.on_failed:
+            return
+        try:
+            self.on_failed(self.name, batch)
+        except Exception:
+            # the worker keeps going, or the stages before it would block
+            logger.exception(f"Handling the failed items of {self.name} failed")
+
+    def close(self):
+        """Signal the end of input and wait until all items are processed."""
+        for _ in self._threads:
+            self.input.put(_DONE)
+        for t in self._threads:
+            t.join()
+
+
+class Pipeline():
+    """Stages connected by bounded queues, each with its own workers.
+    on_failed(stage name, batch) is called with the items a stage failed on."""
+    def __init__(self, stages, on_failed=None):
+        self.stages = stages
+        for stage, nextStage in zip(stages, stages[1:]):
+            stage.next = nextStage
+        for stage in stages:
+            stage.on_failed = on_failed
+            stage.start()
+
+    def put(self, item):
+        """Feed an item, blocks while the first stage is busy."""
+        self.stages[0].input.put(item)
+
+    def close(self):
+        """Drain the pipeline: wait until every item passed all stages."""
+        for stage in self.stages:
+            stage.close()
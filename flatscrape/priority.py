@@ -0,0 +1,81 @@
+import heapq
+import itertools
+
+# Weights of the score terms, each term is about 1 for a typical offer:
+#   price: per PRICE_SCALE euros (cheaper is better)
+#   size: per SIZE_SCALE square metres (larger is better)
+#   distance: per DISTANCE_SCALE km to the closest point of interest
+#   freshness: per minute the advert was found after its sweep (a run or a
+#       poll) started, search results are newest first, so earlier found
+#       means fresher. At most FRESHNESS_MAX_MINUTES count.
+DEFAULT_WEIGHTS = {"price": 1.0, "size": 0.5, "distance": 1.0, "freshness": 0.1}
+FRESHNESS_MAX_MINUTES = 10
+PRICE_SCALE = 1000
+SIZE_SCALE = 50
+# Distance at which offers become less interesting (km)
+DISTANCE_SCALE = 6
+
+def advert_score(advert, weights=None, minutesFound=0):
+    """
+    Attractiveness of an advert, higher is better. Missing fields do not
+    count. weights overrides single entries of DEFAULT_WEIGHTS. minutesFound
+    is the time from the start of the sweep until the advert was found.
+    """
+    weights = dict(DEFAULT_WEIGHTS, **weights) if weights else DEFAULT_WEIGHTS
+    score = -weights["freshness"] * min(minutesFound, FRESHNESS_MAX_MINUTES)
+    if (price := advert.get_value("price")) is not None:
+        score -= weights["price"] * price / PRICE_SCALE
+    if (size := advert.get_value("size")) is not None:
+        score += weights["size"] * size / SIZE_SCALE
+    if (distances := advert.get_value("distances")):
+        score -= weights["distance"] * min(distances.values()) / DISTANCE_SCALE
+    return score
+
+
+class PriorityQueue():
+    """
+    Items by score, where both the best and the worst item can be popped in
+    O(log n): a max heap and a min heap over the same entries, an entry
+    popped from one heap is only marked and skipped when it surfaces in the
+    other. Equal scores are popped first in first out (best) and last in
+    first out (worst). Not thread safe.
+    """
+    def __init__(self):
+        self._best = [] # (-score, seq, entry)
+        self._worst = [] # (score, -seq, entry)
+        self._seq = itertools.count()
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def push(self, item, score):
+        seq = next(self._seq)
+        entry = [item, True] # item, still queued
+        heapq.heappush(self._best, (-score, seq, entry))
+        heapq.heappush(self._worst, (score, -seq, entry))
+        self._len += 1
+
+    def _pop(self, heap):
+        while heap:
+            entry = heapq.heappop(heap)[2]
+            if entry[1]:
+                entry[1] = False
+                self._len -= 1
+                self._prune()
+                return entry[0]
+        raise IndexError("pop from an empty priority queue")
+
+    def _prune(self):
+        # drop the marked entries once they are the majority, amortised O(1)
+        if len(self._best) + len(self._worst) > 4 * self._len + 64:
+            self._best = [e for e in self._best if e[2][1]]
+            self._worst = [e for e in self._worst if e[2][1]]
+            heapq.heapify(self._best)
+            heapq.heapify(self._worst)
+
+    def pop_best(self):
+        return self._pop(self._best)
+
+    def pop_worst(self):
+        return self._pop(self._worst)
@@ -1,13 +1,18 @@
 import abc
-import bs4
+import concurrent.futures
 import datetime as dt
 import logging
+import multiprocessing
 import re
-import requests
 import time
 import urllib
 import advert as advert_module
+import metrics
 import util
+from cache import ResponseCache
+from fetch import FetchEngine
+from parsing import make_soup, has_class, has_attribute
+from seenoffers import ExploredOffers, SeenOfferStore
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -19,13 +24,54 @@ logger.setLevel(logging.DEBUG)
 # all this may not work anymore (the parsing/souping has to be adapted).
 
 MAX_REQUEST = 10
+# Search pages are sorted newest first. Older pages are only crawled while
+# they still hold new offers, so this bound only matters for the first run.
+MAX_PAGES = 5
+
+def make_parse_pool(workers):
+    """
+    Process pool for extract_records, so pages are parsed on all cores while
+    the scraper threads fetch. None (parse in the scraper threads) without
+    workers. Workers are spawned, forking a process with running threads is
+    not safe. Needs shared memory, so it does not work in aws lambda.
+    """
+    if not workers:
+        return None
+    return concurrent.futures.ProcessPoolExecutor(workers,\
+        mp_context=multiprocessing.get_context("spawn"))
+
+def extract_records(site, kind, text, fastParse=False, skipIds=()):
+    """
+    Advert records (Advert.to_dict()) of a fetched page of site, kind is
+    "search" or "expose". Offers with an id in skipIds are left out. Needs
+    neither network nor scraper state, so it can run in a parse pool.
+    """
+    scraperClass = {"wggesucht": WgGesuchtScraper, "ebay": EbayScraper}[site]
+    return scraperClass._extract_records(kind, text, fastParse, skipIds)
+
 
 class Scraper(abc.ABC):
     """Base class for scraping offers from websites"""
-    def __init__(self, exploredOfferIDs = [], maxPrice=900):
-        self._requestTimes = [] # store times of requests for ddos detection
-        self._exploredOfferIDs = exploredOfferIDs # seen offers, do not handle same ad twice
+    # regex for the offer ids on a raw search page
+    _offerIdPattern = None
+    _site = None # metrics label
+    _baseURL = None
+
+    def __init__(self, exploredOfferIDs=None, maxPrice=900, fetchEngine=None,\
+            responseCache=None, fastParse=False, maxPages=MAX_PAGES,\
+            parsePool=None):
+        # shared connection pools and per-host request throttling
+        self._fetchEngine = fetchEngine if fetchEngine else FetchEngine()
+        self._responseCache = responseCache # skip unchanged search pages
+        # explored offers per search url (ExploredOffers), or one store for
+        # all urls, so the same ad is not handled twice under a url
+        if not isinstance(exploredOfferIDs, (ExploredOffers, SeenOfferStore)):
+            exploredOfferIDs = SeenOfferStore(exploredOfferIDs or [])
+        self._exploredOfferIDs = exploredOfferIDs
         self._maxPrice = maxPrice # max price in euros
+        self._fastParse = fastParse # only build the subtrees that are used
+        self._maxPages = maxPages # result pages crawled per search url
+        self._parsePool = parsePool # process pool for extract_records, optional
 
     def _get_user_agent(self):
         """Get constant or random user agent to make requests."""
@@ -33,33 +79,112 @@ class Scraper(abc.ABC):
             'AppleWebKit/605.1.15 (KHTML, like Gecko) ' +\
             'Version/15.4 Safari/605.1.15'
 
-    def _make_request(self, url):
-        """Wrapper for requests.get and soup parser. """
-
-        # wait depending on number of recent requests
-        now = time.time()
-        relevantRequestTimes = list(
-            filter(lambda t: now - t < 60, self._requestTimes))
-        waitTime = min(len(relevantRequestTimes) * 0.25, 5)
-        time.sleep(waitTime)
-
-        # make request
-        headers = {'User-agent': self._get_user_agent()}
-        reqCount = 0
+    def _request(self, url, headers=None):
+        """Wrapper for the fetch engine. """
+        headers = dict(headers or {})
+        headers['User-agent'] = self._get_user_agent()
+        reqCount = 1
         # again, this is weird but seems to happen. 404 sometimes goes away
-        while reqCount < MAX_REQUEST and \
-                (resp := requests.get(url, headers=headers)).status_code == 404:
+        while (resp := self._fetchEngine.get(url, headers=headers)).status_code == 404\
+                and reqCount < MAX_REQUEST:
             logger.warning("Got 404")
-            self._requestTimes.append(time.time())
+            reqCount += 1
+            metrics.count("fetch_retries", site=self._site)
+            metrics.count("retry_sleep_seconds", 5, site=self._site)
             time.sleep(5)
-        if resp.status_code != 200:
+        if resp.status_code not in (200, 304):
             logger.warning(f"Got response {resp.status_code}: {resp.text}")
-            # parse as soup
-        soup = bs4.BeautifulSoup(resp.text, 'html.parser')
-        logger.debug("Parser done souping")
-        return soup
+        return resp
+
+    @staticmethod
+    def _parse(text, keepTag=None, fastParse=False):
+        """Parse a page as soup. In fast parse mode, only the tags accepted
+        by keepTag (and everything below them) are parsed."""
+        return make_soup(text, keepTag if fastParse else None)
+
+    @classmethod
+    @abc.abstractmethod
+    def _extract_records(cls, kind, text, fastParse=False, skipIds=()):
+        """The work of extract_records for this site."""
+        pass
+
+    def _submit_extract(self, kind, text, skipIds=()):
+        """Start extracting the advert records of a fetched page, in the parse
+        pool if there is one, so the thread can fetch meanwhile. Return a
+        future of the records, done already without a pool."""
+        if self._parsePool is not None:
+            return self._parsePool.submit(extract_records, self._site, kind, text,\
+                self._fastParse, skipIds)
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(extract_records(self._site, kind, text,\
+                self._fastParse, skipIds))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _records(self, future):
+        """Wait for the records of _submit_extract. parse_seconds is the time
+        the thread is blocked by parsing."""
+        with metrics.timer("parse_seconds", site=self._site):
+            return future.result()
+
+    def _extract(self, kind, text, skipIds=()):
+        """Advert records of a fetched page, extracted in the parse pool if
+        there is one. The thread waits meanwhile, but other threads keep
+        fetching."""
+        with metrics.timer("parse_seconds", site=self._site):
+            return self._submit_extract(kind, text, skipIds).result()
+
+    @staticmethod
+    def _keep_search_page_tag(attrs):
+        """Fast parse filter for search pages: accept the offers."""
+        return True
 
-    def _find_in_soup(self, soup, *args, **kwargs):
+    def _explored(self, searchURL):
+        """The explored offers of a search url."""
+        if isinstance(self._exploredOfferIDs, ExploredOffers):
+            return self._exploredOfferIDs.store(searchURL)
+        return self._exploredOfferIDs
+
+    def _request_search_page(self, searchURL, explored):
+        """
+        Fetch a search page. Return its text and a response cache entry. The
+        text is None if the offer list did not change since the page was
+        last handled, so neither parsing nor the offers are needed.
+        """
+        if not self._responseCache:
+            return self._request(searchURL).text, None
+        resp = self._request(searchURL,\
+            self._responseCache.conditional_headers(searchURL))
+        if resp.status_code == 304:
+            logger.debug(f"Search page not modified: {searchURL}")
+            metrics.count("response_cache", site=self._site, result="not_modified")
+            self._responseCache.touch(searchURL)
+            return None, None
+        # the offer ids in order are the relevant part of the page, the rest
+        # (ads, tokens, timestamps) changes on every request
+        offerIds = re.findall(self._offerIdPattern, resp.text)
+        entry = self._responseCache.make_entry(resp,\
+            ResponseCache.fragment_hash(offerIds))
+        if self._responseCache.is_unchanged(searchURL, entry):
+            logger.debug(f"Offer list unchanged: {searchURL}")
+            metrics.count("response_cache", site=self._site, result="unchanged")
+            self._responseCache.touch(searchURL)
+            for offerId in map(int, offerIds):
+                if offerId in explored:
+                    explored.add(offerId)
+            return None, None
+        metrics.count("response_cache", site=self._site, result="changed")
+        return resp.text, entry
+
+    def _mark_search_page_handled(self, searchURL, cacheEntry):
+        """Store the cache entry of a search page whose offers are handled."""
+        if self._responseCache and cacheEntry:
+            self._responseCache.store(searchURL, cacheEntry)
+
+    @staticmethod
+    def _find_in_soup(soup, *args, **kwargs):
         """Wrapper for soup.find with error handling."""
         soupElement = soup.find(*args, **kwargs)
         if not soupElement:
@@ -77,37 +202,116 @@ class Scraper(abc.ABC):
         return True
 
     @abc.abstractmethod
+    def _page_url(self, searchURL, page):
+        """Url of the result page with index page (0 is the first page)."""
+        pass
+
+    def _search_skip_ids(self, offerIds, explored):
+        """Ids of a search page that are not extracted."""
+        return ()
+
+    def _fetch_page(self, pageURL, explored):
+        """
+        Fetch a result page and start extracting its records. Return the
+        page (url, offer ids, cache entry, future of the records), the
+        future is None if the offer list did not change.
+        """
+        text, cacheEntry = self._request_search_page(pageURL, explored)
+        if text is None:
+            return pageURL, [], None, None
+        offerIds = list(map(int, re.findall(self._offerIdPattern, text)))
+        skipIds = self._search_skip_ids(offerIds, explored)
+        return pageURL, offerIds, cacheEntry,\
+            self._submit_extract("search", text, skipIds)
+
+    @abc.abstractmethod
+    def _iter_page(self, page, explored):
+        """Yield the new adverts found on a fetched result page (see
+        _fetch_page) as soon as they are parsed, return the number of offers
+        on it that are not in explored. The page counts as handled once the
+        generator is exhausted."""
+        pass
+
+    def _prefetch_page(self, pageURL, explored):
+        """_fetch_page, but an error is returned and raised once the page is
+        needed, so the adverts of the page before are not lost."""
+        try:
+            return self._fetch_page(pageURL, explored)
+        except Exception as e:
+            return e
+
+    def iter_search_page(self, searchURL):
+        """
+        Yield the new adverts of a search, walking the result pages newest
+        first. The crawl stops at the first page without unseen offers, so
+        the number of requests grows with the number of new offers. With a
+        parse pool, the next page is fetched while a page with unseen offers
+        is parsed.
+        """
+        explored = self._explored(searchURL)
+        pageURLs = [self._page_url(searchURL, page) for page in range(self._maxPages)]
+        page = self._prefetch_page(pageURLs[0], explored)
+        for index, pageURL in enumerate(pageURLs):
+            if isinstance(page, Exception):
+                raise page
+            nextPage = None
+            if self._parsePool is not None and index + 1 < len(pageURLs) and\
+                    any(offerId not in explored for offerId in page[1]):
+                nextPage = self._prefetch_page(pageURLs[index + 1], explored)
+            if not (yield from self._iter_page(page, explored)):
+                # the offers further down were already seen in earlier runs
+                logger.debug(f"No new offers on page {index + 1}: {pageURL}")
+                if nextPage is not None and not isinstance(nextPage, Exception)\
+                        and nextPage[3] is not None:
+                    nextPage[3].cancel()
+                break
+            if index + 1 < len(pageURLs):
+                page = nextPage if nextPage is not None else\
+                    self._prefetch_page(pageURLs[index + 1], explored)
+
     def scrape_search_page(self, searchURL):
         """Return list of relevant information on adverts found on the url."""
-        pass
+        return list(self.iter_search_page(searchURL))
 
     def get_exploredOfferIds(self):
         return self._exploredOfferIDs
 
 
 class WgGesuchtScraper(Scraper):
-    def __init__(self, *args, **kwargs):
-        super(WgGesuchtScraper, self).__init__(*args, **kwargs)
-        self._baseURL = 'https://www.wg-gesucht.de'
+    _offerIdPattern = r'data-id="(\d+)"'
+    _site = "wggesucht"
+    _baseURL = 'https://www.wg-gesucht.de'
 
-    def scrape_search_page(self, searchURL):
-        """Return list of relevant information on adverts found on the url."""
-        soup = self._make_request(searchURL)
-        adverts = []
+    @staticmethod
+    def _keep_search_page_tag(attrs):
+        return has_class(attrs, ["offer_list_item"])
+
+    def _page_url(self, searchURL, page):
+        # the page index is the last number of the path,
+        # e.g. wg-zimmer-in-Berlin.8.0.1.0.html
+        parts = urllib.parse.urlsplit(searchURL)
+        path = re.sub(r"\.\d+\.html$", f".{page}.html", parts.path)
+        return urllib.parse.urlunsplit(parts._replace(path=path))
+
+    @classmethod
+    def _extract_records(cls, kind, text, fastParse=False, skipIds=()):
+        """Records of the offers on a search page, the whole advert is on it."""
+        soup = cls._parse(text, cls._keep_search_page_tag, fastParse)
+        records = []
         for expose in soup.find_all(class_="offer_list_item"):
             exposeId = int(expose.get("data-id"))
-            if exposeId in self._exploredOfferIDs:
+            if exposeId in skipIds:
                 continue
-            self._exploredOfferIDs.append(exposeId)
             advert = advert_module.Advert()
             advert.adid.set(exposeId)
-            advert.title.set(self._find_in_soup(
+            advert.title.set(cls._find_in_soup(
                 expose, class_="truncate_title noprint"))
-            advert.website.set(self._baseURL)
-            advert.url.set(urllib.parse.urljoin(self._baseURL, expose.find(
+            advert.website.set(cls._baseURL)
+            advert.url.set(urllib.parse.urljoin(cls._baseURL, expose.find(
                 class_="truncate_title noprint").find(href=True)["href"]))
-            # sometimes weird ad pages...
+            # sometimes weird ad pages, only their id is needed
             if "?" in advert.url.get():
+                records.append(advert.to_dict())
                 continue
             flatType, _, address = expose.find(
                 class_="col-xs-11").text.split("|")
@@ -132,32 +336,77 @@ class WgGesuchtScraper(Scraper):
                     util.parse_german_date(limited.group("moveIn")))
                 advert.moveOutDate.set(
                     util.parse_german_date(limited.group("moveOut")))
-            adverts.append(advert)
-        return adverts
+            records.append(advert.to_dict())
+        return records
+
+    def _search_skip_ids(self, offerIds, explored):
+        # seen offers are only refreshed, not extracted
+        seen = {offerId for offerId in offerIds if offerId in explored}
+        for offerId in seen:
+            # refresh, so offers still listed are not evicted
+            explored.add(offerId)
+        return seen
+
+    def _iter_page(self, page, explored):
+        pageURL, _, cacheEntry, records = page
+        if records is None:
+            return 0
+        numNew = 0
+        for record in self._records(records):
+            if record["adid"] in explored:
+                # also on the page before, which was handled meanwhile
+                explored.add(record["adid"])
+                continue
+            numNew += 1
+            explored.add(record["adid"])
+            # sometimes weird ad pages...
+            if "?" in record["url"]:
+                continue
+            yield advert_module.Advert.from_dict(record)
+        self._mark_search_page_handled(pageURL, cacheEntry)
+        return numNew
 
 class EbayScraper(Scraper):
     """docstring for EbayScraper"""
+    _offerIdPattern = r'data-adid="(\d+)"'
+    _site = "ebay"
+    _baseURL = 'https://www.ebay-kleinanzeigen.de'
 
-    def __init__(self, *args, **kwargs):
-        super(EbayScraper, self).__init__(*args, **kwargs)
-        self._baseURL = 'https://www.ebay-kleinanzeigen.de'
+    @staticmethod
+    def _keep_search_page_tag(attrs):
+        return has_class(attrs, ["aditem"])
 
-    def _extract_from_expose(self, exposeUrl):
-        exposeBS = self._make_request(exposeUrl)
+    @staticmethod
+    def _keep_expose_tag(attrs):
+        return has_class(attrs, ["boxedarticle--title", "boxedarticle--price",\
+                                 "addetailslist--detail", "checktag"]) or\
+            has_attribute(attrs, "itemprop", ["locality", "description"])
+
+    @classmethod
+    def _extract_records(cls, kind, text, fastParse=False, skipIds=()):
+        """Search pages only list the offers ({"adid", "url"}), the advert
+        is extracted from its expose page."""
+        if kind == "expose":
+            return cls._extract_expose_record(text, fastParse)
+        soup = cls._parse(text, cls._keep_search_page_tag, fastParse)
+        records = []
+        for expose in soup.find_all(class_="aditem"):
+            exposeId = int(expose.get("data-adid"))
+            if exposeId not in skipIds:
+                records.append({"adid": exposeId, "url": urllib.parse.urljoin(\
+                    cls._baseURL, expose.get("data-href"))})
+        return records
+
+    @classmethod
+    def _extract_expose_record(cls, text, fastParse=False):
+        exposeBS = cls._parse(text, cls._keep_expose_tag, fastParse)
         advert = advert_module.Advert()
-        advert.website.set(self._baseURL)
-        advert.url.set(exposeUrl)
-        advert.title.set(self._find_in_soup(
+        advert.title.set(cls._find_in_soup(
             exposeBS, class_="boxedarticle--title"))
-        if not advert.title:
-            logger.warning(f"Advert without title: {exposeUrl}")
-        advert.address.set(self._find_in_soup(
+        advert.address.set(cls._find_in_soup(
             exposeBS, itemprop="locality"))
-        priceText = self._find_in_soup(exposeBS, class_="boxedarticle--price")
-        price = util.get_int_from_text(
-            self._find_in_soup(exposeBS, class_="boxedarticle--price"))
         if (price := util.get_int_from_text(
-                self._find_in_soup(exposeBS, class_="boxedarticle--price"))):
+                cls._find_in_soup(exposeBS, class_="boxedarticle--price"))):
             advert.price.set(price)
         for detail in exposeBS.find_all(class_="addetailslist--detail"):
             key, val = list(map(lambda t: t.strip(),
@@ -180,21 +429,67 @@ class EbayScraper(Scraper):
                 advert.furnished.set(True)
         if kitchen:
             advert.kitchen.set(kitchen)
-        advert.description.set(self._find_in_soup(
+        advert.description.set(cls._find_in_soup(
             exposeBS, itemprop="description"))
+        return advert.to_dict()
+
+    def _extract_from_expose(self, exposeUrl):
+        record = self._extract("expose", self._request(exposeUrl).text)
+        advert = advert_module.Advert.from_dict(record)
+        advert.website.set(self._baseURL)
+        advert.url.set(exposeUrl)
+        if not advert.title:
+            logger.warning(f"Advert without title: {exposeUrl}")
         return advert
 
-    def scrape_search_page(self, searchURL):
-        offerSoup = self._make_request(searchURL)
-        adverts = []
-        for expose in offerSoup.find_all(class_="aditem"):
-            exposeId = int(expose.get("data-adid"))
-            if exposeId in self._exploredOfferIDs:
+    def _try_extract_from_expose(self, exposeUrl):
+        """Like _extract_from_expose, but return None if the expose fails."""
+        try:
+            return self._extract_from_expose(exposeUrl)
+        except Exception:
+            logger.exception(f"Could not extract expose {exposeUrl}")
+            return None
+
+    def _page_url(self, searchURL, page):
+        # pages after the first get a seite:<n> segment before the category,
+        # e.g. /s-wohnung-mieten/berlin/seite:2/c203l3331
+        parts = urllib.parse.urlsplit(searchURL)
+        path = re.sub(r"/seite:\d+/", "/", parts.path)
+        if page:
+            head, _, category = path.rstrip("/").rpartition("/")
+            path = f"{head}/seite:{page + 1}/{category}"
+        return urllib.parse.urlunsplit(parts._replace(path=path))
+
+    def _iter_page(self, page, explored):
+        pageURL, _, cacheEntry, records = page
+        if records is None:
+            return 0
+        exposes = {} # id -> url, in search page order
+        for record in self._records(records):
+            exposeId = record["adid"]
+            if exposeId in explored:
+                explored.add(exposeId)
                 continue
-            exposeUri = expose.get("data-href")
-            exposeUrl = urllib.parse.urljoin(self._baseURL, exposeUri)
-            advert = self._extract_from_expose(exposeUrl)
-            advert.adid.set(exposeId)
-            adverts.append(advert)
-            self._exploredOfferIDs.append(exposeId)
-        return adverts
+            exposes.setdefault(exposeId, record["url"])
+        if not exposes:
+            self._mark_search_page_handled(pageURL, cacheEntry)
+            return 0
+        # expose pages are fetched in parallel, the fetch engine still keeps
+        # the requests within the limits of the host
+        numWorkers = min(self._fetchEngine.concurrency(self._baseURL), len(exposes))
+        failed = False
+        with concurrent.futures.ThreadPoolExecutor(max_workers=numWorkers) as pool:
+            # map keeps the search page order and yields each advert as soon
+            # as its expose is parsed
+            results = pool.map(self._try_extract_from_expose, exposes.values())
+            for exposeId, advert in zip(exposes.keys(), results):
+                if advert is None:
+                    # not marked as explored, so it is tried again next time
+                    failed = True
+                    continue
+                advert.adid.set(exposeId)
+                explored.add(exposeId)
+                yield advert
+        if not failed:
+            self._mark_search_page_handled(pageURL, cacheEntry)
+        return len(exposes)
@@ -0,0 +1,209 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Offers that have not been seen on any search page for this many days are
+# forgotten. Search pages are sorted by date, so old offers do not come back.
+MAX_AGE_DAYS = 60
+SITES = ["ebay", "wggesucht"]
+
+def today():
+    """Day number (days since epoch), used as compact timestamp."""
+    return int(time.time() // 86400)
+
+
+class SeenOfferStore():
+    """
+    Set of offer ids that have already been handled, together with the day
+    each id was last seen. Replaces the plain id list, so membership checks
+    are O(1) and the persisted data does not grow with duplicates. Thread
+    safe, so it can be saved while scrapers and messengers add ids.
+    """
+    def __init__(self, ids=(), maxAgeDays=MAX_AGE_DAYS):
+        self._lastSeen = {} # offer id -> day number
+        self._changes = {} # offer id -> day, added or refreshed since loading
+        self._maxAgeDays = maxAgeDays
+        self._lock = threading.Lock()
+        self.update(ids)
+
+    def __contains__(self, offerId):
+        return offerId in self._lastSeen
+
+    def __len__(self):
+        return len(self._lastSeen)
+
+    def __iter__(self):
+        return iter(self._lastSeen)
+
+    def add(self, offerId, day=None, journaled=False):
+        """Add an id or refresh the day it was last seen. A journaled id is
+        persisted elsewhere (statestore.record_sent), so it is no change."""
+        day = today() if day is None else day
+        with self._lock:
+            if journaled:
+                self._changes.pop(offerId, None)
+            elif self._lastSeen.get(offerId) != day:
+                self._changes[offerId] = day
+            self._lastSeen[offerId] = day
+
+    # keep the list interface used by older callers
+    append = add
+
+    def update(self, offerIds, day=None, journaled=False):
+        day = today() if day is None else day
+        for offerId in offerIds:
+            self.add(offerId, day, journaled)
+
+    def discard(self, offerIds):
+        """Forget ids, e.g. of adverts that could not be sent."""
+        with self._lock:
+            for offerId in offerIds:
+                self._lastSeen.pop(offerId, None)
+                self._changes.pop(offerId, None)
+
+    def merge(self, offerIdsByDay):
+        """Add ids grouped by day (as in to_serializable). An id that is
+        already known keeps the later of both days."""
+        for day, offerIds in offerIdsByDay.items():
+            day = int(day)
+            for offerId in offerIds:
+                if self._lastSeen.get(offerId, day) <= day:
+                    self.add(offerId, day)
+
+    def pop_changes(self):
+        """Ids added or refreshed since the store was loaded or this was last
+        called, grouped by day like to_serializable."""
+        with self._lock:
+            changes, self._changes = self._changes, {}
+        byDay = {}
+        for offerId, day in changes.items():
+            byDay.setdefault(str(day), []).append(offerId)
+        return byDay
+
+    def evict(self, maxAgeDays=None):
+        """Forget ids older than maxAgeDays. Return number of evicted ids."""
+        maxAgeDays = self._maxAgeDays if maxAgeDays is None else maxAgeDays
+        oldest = today() - maxAgeDays
+        with self._lock:
+            expired = [i for (i, day) in self._lastSeen.items() if day < oldest]
+            for offerId in expired:
+                del self._lastSeen[offerId]
+        return len(expired)
+
+    def to_serializable(self):
+        """Compact representation: ids grouped by the day they were last seen,
+        e.g. {"19650": [123, 456]}."""
+        with self._lock:
+            lastSeen = list(self._lastSeen.items())
+        byDay = {}
+        for offerId, day in lastSeen:
+            byDay.setdefault(str(day), []).append(offerId)
+        return byDay
+
+    @classmethod
+    def from_serializable(cls, data, **kwargs):
+        """Inverse of to_serializable. Also accepts the old format (a plain
+        list of ids), in which case all ids are treated as seen today."""
+        store = cls(**kwargs)
+        if isinstance(data, list):
+            store.update(data)
+        else:
+            for day, offerIds in data.items():
+                store.update(offerIds, int(day))
+        store._changes = {}
+        return store
+
+
+class ExploredOffers():
+    """
+    Offers already scraped, per search url of a site: url -> SeenOfferStore.
+    An offer found under one url is still handled when it first shows up
+    under another url, which may belong to other tenants. Thread safe.
+    """
+    def __init__(self, maxAgeDays=MAX_AGE_DAYS):
+        self._stores = {} # search url -> SeenOfferStore
+        self._maxAgeDays = maxAgeDays
+        self._lock = threading.Lock()
+
+    def store(self, url):
+        """The explored offers of a search url, created on first use."""
+        with self._lock:
+            if url not in self._stores:
+                self._stores[url] = SeenOfferStore(maxAgeDays=self._maxAgeDays)
+            return self._stores[url]
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(store) for store in self._stores.values())
+
+    def discard(self, offerIds):
+        """Forget ids under all urls, e.g. of adverts that could not be sent."""
+        with self._lock:
+            stores = list(self._stores.values())
+        for store in stores:
+            store.discard(offerIds)
+
+    def evict(self, maxAgeDays=None):
+        """Forget old ids and urls without ids. Return number of evicted ids."""
+        with self._lock:
+            stores = list(self._stores.items())
+        evicted = sum(store.evict(maxAgeDays) for (_, store) in stores)
+        with self._lock:
+            for url, store in stores:
+                if not len(store) and self._stores.get(url) is store:
+                    del self._stores[url]
+        return evicted
+
+    def pop_changes(self):
+        """Changed ids per url, url -> {day: [ids]}, see SeenOfferStore."""
+        with self._lock:
+            stores = list(self._stores.items())
+        return {url: changes for (url, store) in stores\
+                if (changes := store.pop_changes())}
+
+    def to_serializable(self):
+        """{url: {day: [ids]}}"""
+        with self._lock:
+            stores = list(self._stores.items())
+        return {url: store.to_serializable() for (url, store) in stores}
+
+    @classmethod
+    def from_serializable(cls, data, maxAgeDays=MAX_AGE_DAYS):
+        explored = cls(maxAgeDays=maxAgeDays)
+        for url, offerIds in data.items():
+            explored._stores[url] = SeenOfferStore.from_serializable(offerIds,\
+                maxAgeDays=maxAgeDays)
+        return explored
+
+
+def load_explored_offers(data, maxAgeDays=MAX_AGE_DAYS):
+    """One ExploredOffers per site from the "explored" entry of the state."""
+    explored = {}
+    for site in SITES:
+        explored[site] = ExploredOffers.from_serializable(data.get(site, {}),\
+            maxAgeDays=maxAgeDays)
+        evicted = explored[site].evict()
+        logger.debug(f"Loaded {len(explored[site])} explored {site} offers, "+\
+                     f"evicted {evicted}")
+    return explored
+
+def dump_explored_offers(explored):
+    return {site: offers.to_serializable() for (site, offers) in explored.items()}
+
+def load_seen_offers(data, maxAgeDays=MAX_AGE_DAYS):
+    """Build one store per site from the output of a read_offer_method."""
+    stores = {}
+    for site in SITES:
+        stores[site] = SeenOfferStore.from_serializable(data.get(site, []),\
+            maxAgeDays=maxAgeDays)
+        evicted = stores[site].evict()
+        logger.debug(f"Loaded {len(stores[site])} seen {site} offers, "+\
+                     f"evicted {evicted}")
+    return stores
+
+def dump_seen_offers(stores):
+    """Inverse of load_seen_offers, passed to a write_offer_method."""
+    return {site: store.to_serializable() for (site, store) in stores.items()}
@@ -0,0 +1,403 @@
+import abc
+import copy
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from seenoffers import SeenOfferStore, today
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# The journal is folded into a new snapshot once it has this many records.
+COMPACT_EVERY = 200
+# In an object store a cold start reads every journal object with its own
+# request, the records of a run share one object and the journal is folded
+# into the snapshot once it has this many objects (runs).
+OBJECT_COMPACT_EVERY = 10
+CACHE_KEYS = ["responseCache", "geocodeCache", "translationCache", "duplicateIndex",\
+              "pollSchedule"]
+
+def _cache_delta(old, new):
+    """Entries of a cache dict that were set or deleted between old and new."""
+    delta = {"set": {key: entry for (key, entry) in new.items() if old.get(key) != entry},
+             "deleted": [key for key in old if key not in new]}
+    return delta if delta["set"] or delta["deleted"] else None
+
+
+class JournaledState(abc.ABC):
+    """
+    Persisted state (seen offers and caches, the dict main() reads and
+    writes) as a snapshot plus an append-only journal. Handled ids are
+    journaled as soon as their message is sent, so a run that dies keeps
+    its progress, and a run writes records proportional to its new offers.
+    The journal is folded into a new snapshot every compactEvery records.
+
+    Records are dicts with any of
+        "seen": {site: {day: [ids]}}
+        "users": {name: {site: {day: [ids]}}}
+        "explored": {site: {search url: {day: [ids]}}}
+        "caches": {cache key: {"set": {key: entry}, "deleted": [keys]}}
+    Replaying a record twice has no effect, so a crash during compaction
+    does not corrupt the state.
+    """
+    def __init__(self, compactEvery=COMPACT_EVERY):
+        self._compactEvery = compactEvery
+        self._journalLength = 0
+        self._baseline = {} # caches as loaded, to journal their changes
+        self._lock = threading.Lock()
+
+    @abc.abstractmethod
+    def _read_snapshot(self):
+        """The last snapshot, or None."""
+        pass
+
+    @abc.abstractmethod
+    def _write_snapshot(self, state):
+        pass
+
+    @abc.abstractmethod
+    def _read_journal(self):
+        """All journal records since the last snapshot, in order."""
+        pass
+
+    @abc.abstractmethod
+    def _append_journal(self, record):
+        """Durably append one record."""
+        pass
+
+    @abc.abstractmethod
+    def _clear_journal(self):
+        """Drop the records returned by _read_journal and appended since."""
+        pass
+
+    def _end_run(self):
+        """Called after the last record of a run is journaled."""
+        pass
+
+    @staticmethod
+    def replay(state, records):
+        """Apply journal records to a state dict (in place) and return it."""
+        stores = {} # path in state, e.g. ("users", user, site) -> SeenOfferStore
+        def store(*path):
+            if path not in stores:
+                data = state
+                for key in path:
+                    data = data.get(key, {})
+                stores[path] = SeenOfferStore.from_serializable(data)
+            return stores[path]
+        for record in records:
+            for site, offerIds in record.get("seen", {}).items():
+                store(site).merge(offerIds)
+            for user, sites in record.get("users", {}).items():
+                for site, offerIds in sites.items():
+                    store("users", user, site).merge(offerIds)
+            for site, urls in record.get("explored", {}).items():
+                for url, offerIds in urls.items():
+                    store("explored", site, url).merge(offerIds)
+            for key, delta in record.get("caches", {}).items():
+                cache = state.setdefault(key, {})
+                cache.update(delta["set"])
+                for entryKey in delta["deleted"]:
+                    cache.pop(entryKey, None)
+        for path, seenStore in stores.items():
+            data = state
+            for key in path[:-1]:
+                data = data.setdefault(key, {})
+            data[path[-1]] = seenStore.to_serializable()
+        return state
+
+    def load(self):
+        """The state of the last snapshot with the journal replayed. Can be
+        used as read_offer_method."""
+        state = self._read_snapshot() or {}
+        records = self._read_journal()
+        self._journalLength = len(records)
+        self.replay(state, records)
+        logger.debug(f"Loaded state with {len(records)} journal records")
+        self._set_baseline(state)
+        return state
+
+    def append(self, record):
+        """Journal a record, e.g. the ids of a sent message."""
+        with self._lock:
+            self._append_journal(record)
+            self._journalLength += 1
+
+    def record_sent(self, handledIds, user=None, day=None):
+        """Journal the ids of a sent message (site -> ids), for a user in
+        multi user mode."""
+        day = str(day if day is not None else today())
+        seen = {site: {day: ids} for (site, ids) in handledIds.items() if ids}
+        if not seen:
+            return
+        record = {"seen": seen}
+        if user is not None:
+            record["users"] = {user: seen}
+        self.append(record)
+
+    def finish_run(self, state, seenOffers=None, userOffers=None, explored=None):
+        """
+        Journal what changed in the run: the ids added or refreshed in the
+        seen offer stores (site -> store, user -> site -> store), in the
+        explored offers (site -> ExploredOffers) and the changed cache
+        entries. Then compact if the journal is long. Can be
+        used as write_offer_method (without the stores, then only caches
+        are journaled).
+        """
+        record = {}
+        if seenOffers:
+            record["seen"] = {site: changes for (site, store) in seenOffers.items()\
+                              if (changes := store.pop_changes())}
+        if userOffers:
+            record["users"] = {}
+            for user, stores in userOffers.items():
+                changes = {site: changes for (site, store) in stores.items()\
+                           if (changes := store.pop_changes())}
+                if changes:
+                    record["users"][user] = changes
+        if explored:
+            record["explored"] = {site: changes for (site, offers) in explored.items()\
+                                  if (changes := offers.pop_changes())}
+        caches = {key: delta for key in CACHE_KEYS\
+                  if (delta := _cache_delta(self._baseline.get(key, {}), state.get(key, {})))}
+        if caches:
+            record["caches"] = caches
+        if any(record.values()):
+            self.append(record)
+        self._end_run()
+        if self._journalLength >= self._compactEvery:
+            self.compact(state)
+        else:
+            self._set_baseline(state)
+
+    def compact(self, state):
+        """Write state as the new snapshot and drop the journal."""
+        with self._lock:
+            self._write_snapshot(state)
+            self._clear_journal()
+            logger.debug(f"Compacted {self._journalLength} journal records")
+            self._journalLength = 0
+        self._set_baseline(state)
+
+    def _set_baseline(self, state):
+        self._baseline = copy.deepcopy({key: state.get(key, {}) for key in CACHE_KEYS})
+
+
+class LocalFileState(JournaledState):
+    """Snapshot in a json file, journal as json lines next to it."""
+    def __init__(self, path, compactEvery=COMPACT_EVERY):
+        super(LocalFileState, self).__init__(compactEvery)
+        self._path = path
+        self._journalPath = path + ".journal"
+
+    def _read_snapshot(self):
+        if not os.path.exists(self._path):
+            return None
+        with open(self._path, "r") as f:
+            return json.load(f)
+
+    def _write_snapshot(self, state):
+        # replace atomically, a crash leaves the old snapshot and journal
+        tmpPath = self._path + ".tmp"
+        with open(tmpPath, "w") as f:
+            json.dump(state, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, self._path)
+
+    def _read_journal(self):
+        if not os.path.exists(self._journalPath):
+            return []
+        records = []
+        with open(self._journalPath, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # torn last line of a run that died while writing
+                    logger.warning("Skipping broken journal record")
+        return records
+
+    def _append_journal(self, record):
+        with open(self._journalPath, "a") as f:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _clear_journal(self):
+        if os.path.exists(self._journalPath):
+            os.remove(self._journalPath)
+
+
+class ObjectStoreState(JournaledState):
+    """
+    State in an S3 like object store (boto3 client interface). Objects
+    cannot be appended to, so every journal record is its own object under
+    <prefix>journal/, named so they list in the order they were written.
+    At the end of a run its records are rewritten as one object
+    {"records": [...]}, and compactEvery counts objects, so a cold start
+    reads fewer than compactEvery objects of finished runs.
+    """
+    def __init__(self, client, bucket, prefix="", compactEvery=OBJECT_COMPACT_EVERY):
+        super(ObjectStoreState, self).__init__(compactEvery)
+        self._client = client
+        self._bucket = bucket
+        self._snapshotKey = prefix + "snapshot.json"
+        self._journalPrefix = prefix + "journal/"
+        self._journalKeys = [] # keys read or written since the last snapshot
+        self._runRecords = [] # (key, record) appended in the current run
+
+    @staticmethod
+    def _is_missing(error):
+        code = getattr(error, "response", {}).get("Error", {}).get("Code")
+        return code in ("NoSuchKey", "404")
+
+    def _get(self, key):
+        try:
+            resp = self._client.get_object(Bucket=self._bucket, Key=key)
+        except Exception as e:
+            if self._is_missing(e):
+                return None
+            raise
+        return json.loads(resp["Body"].read())
+
+    def _put(self, key, data):
+        self._client.put_object(Bucket=self._bucket, Key=key,\
+            Body=json.dumps(data, separators=(",", ":")).encode())
+
+    def _read_snapshot(self):
+        return self._get(self._snapshotKey)
+
+    def _write_snapshot(self, state):
+        self._put(self._snapshotKey, state)
+
+    def _read_journal(self):
+        keys, token = [], None
+        while True:
+            kwargs = {"ContinuationToken": token} if token else {}
+            resp = self._client.list_objects_v2(Bucket=self._bucket,\
+                Prefix=self._journalPrefix, **kwargs)
+            keys += [obj["Key"] for obj in resp.get("Contents", [])]
+            if not resp.get("IsTruncated"):
+                break
+            token = resp["NextContinuationToken"]
+        self._journalKeys = sorted(keys)
+        records = []
+        for key in self._journalKeys:
+            data = self._get(key)
+            if data is None:
+                continue
+            # the records of a run, or a single record of an unfinished run
+            records += data["records"] if "records" in data else [data]
+        return records
+
+    def load(self):
+        state = super(ObjectStoreState, self).load()
+        self._journalLength = len(self._journalKeys)
+        self._runRecords = []
+        return state
+
+    def _new_journal_key(self):
+        # time first for the order, random part against concurrent writers
+        return f"{self._journalPrefix}{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.json"
+
+    def _append_journal(self, record):
+        key = self._new_journal_key()
+        self._put(key, record)
+        self._journalKeys.append(key)
+        self._runRecords.append((key, record))
+
+    def _end_run(self):
+        """Replace the record objects of the run by one object. A crash in
+        between leaves both, replaying the records twice is harmless."""
+        with self._lock:
+            if len(self._runRecords) > 1:
+                key = self._new_journal_key()
+                self._put(key, {"records": [record for (_, record) in self._runRecords]})
+                runKeys = {runKey for (runKey, _) in self._runRecords}
+                self._delete(list(runKeys))
+                self._journalKeys = [k for k in self._journalKeys if k not in runKeys]
+                self._journalKeys.append(key)
+            self._runRecords = []
+            self._journalLength = len(self._journalKeys)
+
+    def _delete(self, keys):
+        # delete_objects takes at most 1000 keys
+        for i in range(0, len(keys), 1000):
+            self._client.delete_objects(Bucket=self._bucket, Delete={"Objects":\
+                [{"Key": key} for key in keys[i:i + 1000]]})
+
+    def _clear_journal(self):
+        self._delete(self._journalKeys)
+        self._journalKeys = []
+        self._runRecords = []
+
+    @classmethod
+    def s3(cls, bucket, prefix="", **kwargs):
+        import boto3 # available in the lambda runtime
+        return cls(boto3.client("s3"), bucket, prefix, **kwargs)
+
+
+class NoSuchKey(Exception):
+    """Missing object, shaped like the botocore error."""
+    def __init__(self, key):
+        super(NoSuchKey, self).__init__(f"No such key: {key}")
+        self.response = {"Error": {"Code": "NoSuchKey"}}
+
+
+class LocalObjectStore():
+    """
+    In memory stand-in for the part of the boto3 S3 client used by
+    ObjectStoreState, for tests and benchmarks. Counts the requests, and
+    lists at most pageSize keys per request like S3.
+    """
+    def __init__(self, pageSize=1000):
+        self.objects = {} # (bucket, key) -> bytes
+        self.requests = {"get": 0, "put": 0, "list": 0, "delete": 0}
+        self.bytesWritten = 0
+        self._pageSize = pageSize
+        self._lock = threading.Lock()
+
+    def get_object(self, Bucket, Key):
+        with self._lock:
+            self.requests["get"] += 1
+            if (Bucket, Key) not in self.objects:
+                raise NoSuchKey(Key)
+            body = self.objects[(Bucket, Key)]
+        return {"Body": _Body(body)}
+
+    def put_object(self, Bucket, Key, Body):
+        with self._lock:
+            self.requests["put"] += 1
+            self.bytesWritten += len(Body)
+            self.objects[(Bucket, Key)] = Body
+
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None):
+        with self._lock:
+            self.requests["list"] += 1
+            keys = sorted(key for (bucket, key) in self.objects\
+                          if bucket == Bucket and key.startswith(Prefix)\
+                          and (ContinuationToken is None or key > ContinuationToken))
+        page = keys[:self._pageSize]
+        resp = {"Contents": [{"Key": key} for key in page],\
+                "IsTruncated": len(keys) > len(page)}
+        if resp["IsTruncated"]:
+            resp["NextContinuationToken"] = page[-1]
+        return resp
+
+    def delete_objects(self, Bucket, Delete):
+        with self._lock:
+            self.requests["delete"] += 1
+            for obj in Delete["Objects"]:
+                self.objects.pop((Bucket, obj["Key"]), None)
+
+
+class _Body():
+    def __init__(self, data):
+        self._data = data
+
+    def read(self):
+        return self._data
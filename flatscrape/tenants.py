@@ -0,0 +1,141 @@
+import logging
+import threading
+from advert import advert_site
+from DataStorage import SearchParameters
+from messenger import Messenger, make_broadcaster
+import seenoffers
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Name of the only tenant if the event has no USERS
+DEFAULT_TENANT = "default"
+
+class Tenant():
+    """
+    A user with their own search parameters, messenger and seen offers.
+    Adverts are scraped once for all tenants and then filtered, enriched and
+    sent per tenant.
+    """
+    def __init__(self, name, searchParameters, messenger, seenOffers=None,\
+            sentOffers=None):
+        self.name = name
+        self.searchParameters = searchParameters
+        self.messenger = messenger
+        # None for a single tenant, who uses the sent offers of all tenants
+        self.seenOffers = seenOffers
+        self.sentOffers = seenOffers if seenOffers is not None else sentOffers
+        # offers passed on and not yet sent, (site, id), an offer can be
+        # scraped from several search urls of the tenant
+        self._claimed = set()
+        self._lock = threading.Lock()
+
+    def is_new(self, advert):
+        """Check if the advert was not sent to this tenant before."""
+        if self.sentOffers is None:
+            return True
+        site = advert_site(advert)
+        return not (site in self.sentOffers and\
+                    advert.get_value("adid") in self.sentOffers[site])
+
+    def claim(self, advert):
+        """Check if the advert is new and not passed on to the tenant yet,
+        and if so, mark it as passed on."""
+        key = (advert_site(advert), advert.get_value("adid"))
+        with self._lock:
+            if key in self._claimed or not self.is_new(advert):
+                return False
+            self._claimed.add(key)
+            return True
+
+    def release(self, offerIds):
+        """Forget the claims of offers (site -> ids), once they are sent or
+        failed to send."""
+        with self._lock:
+            for site, siteIds in offerIds.items():
+                self._claimed.difference_update((site, i) for i in siteIds)
+
+    def mark_sent(self, handledIds, journaled=False):
+        if self.seenOffers is not None:
+            for site, offerIds in handledIds.items():
+                if site in self.seenOffers:
+                    self.seenOffers[site].update(offerIds, journaled=journaled)
+        self.release(handledIds)
+
+    def search_urls(self, site, flatshare=True):
+        """(url, flat type) of the searches of this tenant on site."""
+        if site == "ebay":
+            return [(url, None) for url in self.searchParameters.ebayUrls]
+        urls = [(url, "Individual Apartment")\
+                for url in self.searchParameters.wggesuchtFlatUrls]
+        if flatshare:
+            urls += [(url, "Shared Flat (WG)")\
+                     for url in self.searchParameters.wggesuchtWGUrls]
+        return urls
+
+
+def tenant_events(awsEvent):
+    """
+    Split an event into one event per tenant. Without USERS, the event
+    itself is the only tenant. Otherwise every entry of USERS is merged over
+    the top level keys, so shared settings only need to be given once.
+    """
+    if "USERS" not in awsEvent:
+        return {DEFAULT_TENANT: awsEvent}
+    shared = {key: val for (key, val) in awsEvent.items() if key != "USERS"}
+    return {name: dict(shared, **userEvent)\
+            for (name, userEvent) in awsEvent["USERS"].items()}
+
+def load_tenants(awsEvent, state, geocoder=None, transport=None, maxAgeDays=None,\
+        sentOffers=None):
+    """Build the tenants of an event, with their seen offers from state.
+    transport replaces the telegram transports, e.g. with a stand-in. A
+    single tenant checks new offers against sentOffers (site -> store)."""
+    events = tenant_events(awsEvent)
+    multiTenant = "USERS" in awsEvent
+    maxAgeDays = maxAgeDays if maxAgeDays else seenoffers.MAX_AGE_DAYS
+    tenants = []
+    # one transport and broadcaster per bot (TELEGRAM_BOT_TOKEN can be set
+    # per user), Telegram's global limit is per bot and not per user, the
+    # limits of the first user of a bot apply. A given transport is used
+    # for all bots.
+    broadcasters = {}
+    for name, event in events.items():
+        token = event.get("TELEGRAM_BOT_TOKEN")
+        if token not in broadcasters:
+            broadcasters[token] = make_broadcaster(token, transport,\
+                event.get("MESSAGE_LIMITS"))
+        messenger = Messenger(token, event.get("TELEGRAM_USER_IDS"),\
+            limits=event.get("MESSAGE_LIMITS"),\
+            priorityWeights=event.get("PRIORITY_WEIGHTS"),\
+            broadcaster=broadcasters[token])
+        seenOffers = None
+        if multiTenant:
+            seenOffers = seenoffers.load_seen_offers(\
+                state.get("users", {}).get(name, {}), maxAgeDays=maxAgeDays)
+        tenants.append(Tenant(name, SearchParameters(event, geocoder),\
+            messenger, seenOffers, sentOffers))
+    return tenants
+
+def close_broadcasters(tenants):
+    """Close the shared broadcasters, once all messengers are done."""
+    for broadcaster in {id(t.messenger.broadcaster): t.messenger.broadcaster\
+                        for t in tenants}.values():
+        broadcaster.close()
+
+def dump_tenants(tenants):
+    """Seen offers of all tenants, for the persisted state."""
+    return {tenant.name: seenoffers.dump_seen_offers(tenant.seenOffers)\
+            for tenant in tenants if tenant.seenOffers is not None}
+
+def subscriptions(tenants, site, flatshare=True):
+    """
+    Union of the search urls of all tenants on site, each with its flat
+    type and the tenants that search it: [(url, flat type, [tenants])].
+    """
+    subscribers = {}
+    for tenant in tenants:
+        for url, flatType in tenant.search_urls(site, flatshare):
+            subscribers.setdefault((url, flatType), []).append(tenant)
+    return [(url, flatType, urlTenants)\
+            for ((url, flatType), urlTenants) in subscribers.items()]
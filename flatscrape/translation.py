@@ -0,0 +1,168 @@
+import concurrent.futures
+import hashlib
+import logging
+import threading
+import time
+from fetch import TokenBucket
+import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Translations are kept for this long, for the tenants that get the same
+# advert and for later runs or polls. The newest MAX_ENTRIES are persisted,
+# so the full texts do not make the state grow with the adverts.
+TTL_SECONDS = 6 * 3600
+MAX_ENTRIES = 1000
+# Backend requests (one per text) per second and at the same time. Texts
+# that are not translated after the timeout are given up on and go out
+# untranslated; a request that already started still finishes and is cached.
+RATE = 2.0
+CONCURRENCY = 2
+TIMEOUT_SECONDS = 20
+
+class GoogleBackend():
+    """Google translate through deep_translator, one translator per language."""
+    def __init__(self):
+        self._translators = {}
+        self._lock = threading.Lock()
+
+    def _get_translator(self, language):
+        # imported on first use, runs without translation do not need it
+        import deep_translator
+        with self._lock:
+            if language not in self._translators:
+                self._translators[language] = deep_translator.GoogleTranslator(\
+                    source='auto', target=language)
+            return self._translators[language]
+
+    def translate(self, text, language):
+        return self._get_translator(language).translate(text)
+
+
+class StaticBackend():
+    """Translation stand-in for tests: marks texts instead of translating."""
+    def __init__(self):
+        self.requests = 0
+
+    def translate(self, text, language):
+        self.requests += 1
+        return f"[{language}] {text}"
+
+
+class Translator():
+    """
+    Translation with a persistent cache keyed by a hash of language and
+    text, so an advert is translated once. Every missing text is one
+    backend request, the requests run in a pool of concurrency threads and
+    are rate limited. The texts of a call are waited for at most timeout
+    seconds in all.
+    """
+    def __init__(self, backend=None, ttlSeconds=TTL_SECONDS, rate=RATE,\
+            concurrency=CONCURRENCY, timeout=TIMEOUT_SECONDS):
+        self._backend = backend if backend else GoogleBackend()
+        self._entries = {} # hash -> (translation, time it was translated)
+        self._ttlSeconds = ttlSeconds
+        self._bucket = TokenBucket(rate, concurrency)
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency,\
+            thread_name_prefix="translate")
+        self._timeout = timeout
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(text, language):
+        return hashlib.sha1(f"{language}\n{text}".encode()).hexdigest()
+
+    def _translate(self, key, text, language):
+        """Backend request for one text, runs in the pool. Return its
+        translation or None."""
+        self._bucket.acquire()
+        try:
+            with metrics.timer("translate_seconds"):
+                translated = self._backend.translate(text, language)
+        except Exception:
+            # only this text goes out untranslated
+            logger.exception("Could not translate")
+            return None
+        if translated:
+            with self._lock:
+                self._entries[key] = (translated, time.time())
+        return translated
+
+    def translate_many(self, texts, language):
+        """Translate texts, return the translations in the same order.
+        Texts that cannot be translated in time are returned unchanged."""
+        keys = [self.key(text, language) for text in texts]
+        oldest = time.time() - self._ttlSeconds
+        with self._lock:
+            cached = {}
+            for key in keys:
+                if (entry := self._entries.get(key)) and entry[1] >= oldest:
+                    cached[key] = entry[0]
+        misses = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and text:
+                misses[key] = text
+        metrics.count("translation_cache", len(cached), result="hit")
+        metrics.count("translation_cache", len(misses), result="miss")
+        if misses:
+            futures = {key: self._pool.submit(self._translate, key, text, language)\
+                       for (key, text) in misses.items()}
+            done, pending = concurrent.futures.wait(futures.values(), self._timeout)
+            for key, future in futures.items():
+                if future in done and (translated := future.result()):
+                    cached[key] = translated
+            logger.debug(f"Translated {len(done)} of {len(misses)} texts")
+            if pending:
+                logger.warning(f"Translating {len(pending)} texts timed out")
+                metrics.count("enrich_timeouts", service="translator")
+                for future in pending:
+                    # the started requests still finish and are cached
+                    future.cancel()
+        return [cached.get(key, text) for (key, text) in zip(keys, texts)]
+
+    def translate(self, text, language):
+        return self.translate_many([text], language)[0]
+
+    def translate_adverts(self, adverts, language, maxDescriptionLength):
+        """Translate title and description of all adverts in one batch. The
+        description is truncated first, so no discarded text is translated."""
+        fields = [] # (advert, field name, text, maximum length)
+        for advert in adverts:
+            if (title := advert.get_value("title")) is not None:
+                fields.append((advert, "title", title, None))
+            if (description := advert.get_value("description")) is not None:
+                fields.append((advert, "description",\
+                    description[:maxDescriptionLength], maxDescriptionLength))
+        if not fields:
+            return adverts
+        translated = self.translate_many([text for (_, _, text, _) in fields], language)
+        for (advert, name, _, maxLength), text in zip(fields, translated):
+            advert.set_value(name, text[:maxLength])
+        return adverts
+
+    def evict(self):
+        """Forget expired translations. Return the number of evicted ones."""
+        oldest = time.time() - self._ttlSeconds
+        with self._lock:
+            expired = [key for (key, (_, translated)) in self._entries.items()\
+                       if translated < oldest]
+            for key in expired:
+                del self._entries[key]
+        return len(expired)
+
+    def to_serializable(self, maxEntries=MAX_ENTRIES):
+        """The newest maxEntries translations, hash -> [translation, time]."""
+        with self._lock:
+            newest = sorted(self._entries.items(), key=lambda item: item[1][1],\
+                            reverse=True)[:maxEntries]
+        return {key: [text, translated] for (key, (text, translated)) in newest}
+
+    @classmethod
+    def from_serializable(cls, data, **kwargs):
+        """Inverse of to_serializable, expired entries are dropped."""
+        translator = cls(**kwargs)
+        oldest = time.time() - translator._ttlSeconds
+        translator._entries = {key: (text, translated) for\
+            (key, (text, translated)) in data.items() if translated >= oldest}
+        return translator
@@ -0,0 +1,145 @@
+import concurrent.futures
+import logging
+import threading
+import time
+from fetch import TokenBucket
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Telegram bot limits: about one message per second to the same chat and
+# 30 messages per second overall.
+PER_CHAT_RATE = 1.0
+GLOBAL_RATE = 30.0
+MAX_RETRIES = 3
+BACKOFF_SECONDS = 1.0
+
+class RetryAfter(Exception):
+    """The backend asks to wait seconds before sending again."""
+    def __init__(self, seconds):
+        super(RetryAfter, self).__init__(f"Retry after {seconds}s")
+        self.seconds = seconds
+
+class TransientError(Exception):
+    """Temporary network problem, sending again may work."""
+
+class PermanentError(Exception):
+    """The message was rejected (e.g. unknown chat, blocked bot), sending
+    it again fails the same way."""
+
+
+class TelegramTransport():
+    """Send messages with a single bot, which keeps its connection pool."""
+    def __init__(self, token, poolSize=8):
+        self._token = token
+        self._poolSize = poolSize
+        self._bot = None
+        self._lock = threading.Lock()
+
+    def _get_bot(self):
+        # created on first use, so a messenger can be built without a token
+        # and telegram is only imported if something is sent
+        import telegram
+        import telegram.utils.request
+        with self._lock:
+            if self._bot is None:
+                self._bot = telegram.Bot(self._token,\
+                    request=telegram.utils.request.Request(con_pool_size=self._poolSize))
+            return self._bot
+
+    def send(self, chatId, text):
+        bot = self._get_bot()
+        import telegram.error
+        try:
+            bot.send_message(chatId, text, disable_notification=True)
+        except telegram.error.RetryAfter as e:
+            raise RetryAfter(e.retry_after)
+        # before NetworkError, BadRequest is a subclass of it
+        except (telegram.error.BadRequest, telegram.error.Unauthorized,\
+                telegram.error.ChatMigrated) as e:
+            raise PermanentError(str(e))
+        except (telegram.error.TimedOut, telegram.error.NetworkError) as e:
+            raise TransientError(str(e))
+
+
+class LocalTransport():
+    """
+    Stand-in transport for offline load tests. Records all messages, and can
+    simulate latency and flood control (every rateLimitEvery-th send raises
+    RetryAfter).
+    """
+    def __init__(self, latency=0, rateLimitEvery=0, retryAfter=0.1):
+        self.latency = latency
+        self.rateLimitEvery = rateLimitEvery
+        self.retryAfter = retryAfter
+        self.sent = [] # (time, chat id, text)
+        self._attempts = 0
+        self._lock = threading.Lock()
+
+    def send(self, chatId, text):
+        with self._lock:
+            self._attempts += 1
+            limited = self.rateLimitEvery and self._attempts % self.rateLimitEvery == 0
+        if self.latency:
+            time.sleep(self.latency)
+        if limited:
+            raise RetryAfter(self.retryAfter)
+        with self._lock:
+            self.sent.append((time.monotonic(), chatId, text))
+
+
+class Broadcaster():
+    """
+    Send a message to several chats concurrently over one transport, within
+    a per-chat and a global rate limit. Flood control (RetryAfter) and
+    transient errors are retried with backoff, rejected messages are not.
+    """
+    def __init__(self, transport, maxWorkers=4, perChatRate=PER_CHAT_RATE,\
+            globalRate=GLOBAL_RATE, maxRetries=MAX_RETRIES):
+        self._transport = transport
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers)
+        self._perChatRate = perChatRate
+        self._chatBuckets = {}
+        self._globalBucket = TokenBucket(globalRate, globalRate)
+        self._maxRetries = maxRetries
+        self._lock = threading.Lock()
+
+    def _chat_bucket(self, chatId):
+        with self._lock:
+            if chatId not in self._chatBuckets:
+                self._chatBuckets[chatId] = TokenBucket(self._perChatRate, 1)
+            return self._chatBuckets[chatId]
+
+    def _send(self, chatId, text):
+        """Send to one chat, return True on success, None if the message
+        was rejected and False if sending failed otherwise."""
+        for attempt in range(self._maxRetries + 1):
+            self._chat_bucket(chatId).acquire()
+            self._globalBucket.acquire()
+            try:
+                self._transport.send(chatId, text)
+                return True
+            except RetryAfter as e:
+                logger.warning(f"Flood control for {chatId}, waiting {e.seconds}s")
+                time.sleep(e.seconds)
+            except PermanentError as e:
+                logger.error(f"Message to {chatId} rejected: {e}")
+                return None
+            except TransientError as e:
+                logger.warning(f"Sending to {chatId} failed: {e}")
+                time.sleep(BACKOFF_SECONDS * 2 ** attempt)
+            except Exception:
+                logger.exception(f"Error sending message to {chatId}")
+                return False
+        logger.error(f"Giving up sending message to {chatId}")
+        return False
+
+    def broadcast(self, chatIds, text):
+        """Send text to all chats concurrently. Return chat id -> success
+        (see _send)."""
+        futures = {chatId: self._pool.submit(self._send, chatId, text)\
+                   for chatId in chatIds}
+        return {chatId: future.result() for (chatId, future) in futures.items()}
+
+    def close(self):
+        self._pool.shutdown(wait=True)
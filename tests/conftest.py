@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the flatscrape modules import each other as top level modules (lambda
+# layer), the benchmarks provide the local pages and stand-ins
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+sys.path.insert(0, os.path.join(ROOT, "flatscrape"))
@@ -0,0 +1,50 @@
+from advert import Advert
+from duplicates import DuplicateIndex, addresses_agree
+
+def make_advert(site, adid, title, address, price=800, size=50, description=None):
+    advert = Advert()
+    advert.adid.set(adid)
+    advert.website.set("https://www.wg-gesucht.de" if site == "wggesucht"
+                       else "https://www.ebay-kleinanzeigen.de")
+    advert.title.set(title)
+    advert.address.set(address)
+    advert.price.set(price)
+    advert.size.set(size)
+    if description:
+        advert.description.set(description)
+    return advert
+
+def test_addresses_agree():
+    assert addresses_agree("10115 berlin mitte", "musterstrasse 1 berlin mitte")
+    assert addresses_agree("berlin", "10115 berlin mitte")
+    assert addresses_agree(None, "10115 berlin mitte")
+    assert not addresses_agree("10115 berlin mitte", "17115 berlin mitte")
+    assert not addresses_agree("musterstrasse 1 berlin", "beispielweg 7 berlin")
+
+def test_same_text_at_another_postcode_is_not_a_duplicate():
+    index = DuplicateIndex()
+    title = "Helle 2 Zimmer Wohnung mit Balkon in Berlin Mitte"
+    assert index.check(make_advert("ebay", 1, title, "10115 Berlin - Mitte"), "user") is None
+    assert index.check(make_advert("ebay", 2, title, "17115 Berlin - Mitte"), "user") is None
+
+def test_flat_on_both_sites_is_a_duplicate():
+    index = DuplicateIndex()
+    title = "Helle 2 Zimmer Wohnung mit Balkon in Berlin Mitte"
+    wg = make_advert("wggesucht", 1, title, "Musterstrasse 1, Berlin Mitte")
+    ebay = make_advert("ebay", 2, title, "10115 Berlin - Mitte", price=810,
+                       description="Die Wohnung liegt ruhig im Hinterhaus, nahe Park.")
+    assert index.check(wg, "user") is None
+    assert index.check(ebay, "user") == "wggesucht:1"
+    # another user did not get it yet
+    assert index.check(ebay, "other") is None
+
+def test_evict_forgets_old_adverts():
+    index = DuplicateIndex()
+    title = "Helle 2 Zimmer Wohnung mit Balkon in Berlin Mitte"
+    index.check(make_advert("ebay", 1, title, "10115 Berlin - Mitte"), "user")
+    index.check(make_advert("ebay", 2, "Zimmer in WG", "10117 Berlin - Mitte"), "user")
+    index._entries["ebay:1"]["day"] -= 31
+    assert index.evict() == 1
+    assert len(index) == 1
+    # no longer found as a duplicate
+    assert index.check(make_advert("ebay", 3, title, "10115 Berlin - Mitte"), "user") is None
@@ -0,0 +1,38 @@
+import time
+from geocoding import Geocoder, StaticBackend
+
+class SlowBackend(StaticBackend):
+    def __init__(self, delay):
+        super(SlowBackend, self).__init__({}, default=(52.5, 13.4))
+        self.delay = delay
+
+    def geocode(self, query):
+        time.sleep(self.delay)
+        return super(SlowBackend, self).geocode(query)
+
+def test_queued_lookups_are_not_dropped():
+    # the batch takes longer than the timeout, every request is fast
+    geocoder = Geocoder(SlowBackend(0.01), rate=20, timeout=0.2)
+    results = geocoder.geocode_many([f"Strasse {i}, Berlin" for i in range(8)])
+    assert all(results.values())
+    assert geocoder._started == {} and geocoder._inflight == {}
+
+def test_slow_lookup_times_out_and_is_cached_later():
+    geocoder = Geocoder(SlowBackend(0.3), rate=100, timeout=0.1)
+    start = time.monotonic()
+    assert geocoder.geocode("Strasse 1, Berlin") is None
+    assert time.monotonic() - start < 0.25
+    time.sleep(0.4)
+    assert geocoder.geocode("Strasse 1, Berlin") == (52.5, 13.4)
+    assert geocoder._backend.requests == 1
+
+def test_batch_returns_at_its_deadline_and_the_rest_is_cached_later():
+    geocoder = Geocoder(SlowBackend(0.01), rate=20, timeout=1, batchTimeout=0.2)
+    addresses = [f"Strasse {i}, Berlin" for i in range(16)]
+    start = time.monotonic()
+    results = geocoder.geocode_many(addresses)
+    assert time.monotonic() - start < 0.4
+    assert not all(results.values())
+    time.sleep(1)
+    assert all(geocoder.geocode_many(addresses).values())
+    assert geocoder._backend.requests == 16
@@ -0,0 +1,33 @@
+import messenger
+from advert import Advert
+from messenger import Messenger
+from priority import advert_score, FRESHNESS_MAX_MINUTES
+from transport import LocalTransport
+
+def make_advert(price=500):
+    advert = Advert()
+    advert.price.set(price)
+    return advert
+
+def test_freshness_is_capped():
+    advert = make_advert()
+    assert advert_score(advert, minutesFound=FRESHNESS_MAX_MINUTES * 100) ==\
+        advert_score(advert, minutesFound=FRESHNESS_MAX_MINUTES)
+    assert advert_score(advert, minutesFound=1) > advert_score(advert, minutesFound=2)
+
+def test_freshness_restarts_with_each_sweep(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(messenger.time, "monotonic", lambda: now[0])
+    m = Messenger(None, [1], transport=LocalTransport())
+    scores = []
+    monkeypatch.setattr(m, "add_to_queue", lambda advert, individual, score:\
+        (scores.append(score), m.individualMessagesQueue.push(advert, score)))
+    m.handle_advert(make_advert())
+    now[0] += 50
+    m.handle_advert(make_advert())
+    # the next poll, hours later, while the queue is not drained
+    now[0] += 3 * 3600
+    m.handle_advert(make_advert())
+    assert scores[0] > scores[1]
+    assert scores[2] == scores[0]
+    m.broadcaster.close()
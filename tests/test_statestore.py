@@ -0,0 +1,143 @@
+import copy
+import json
+import os
+import pytest
+from seenoffers import ExploredOffers, SeenOfferStore, today
+from statestore import LocalFileState, LocalObjectStore, ObjectStoreState
+from translation import StaticBackend, Translator
+
+@pytest.fixture(params=["file", "object"])
+def open_state(request, tmp_path):
+    """Opens the same persisted state again, as a new run would."""
+    objectStore = LocalObjectStore(pageSize=2)
+    def open_state(compactEvery=100):
+        if request.param == "file":
+            return LocalFileState(os.path.join(tmp_path, "state.json"), compactEvery)
+        return ObjectStoreState(objectStore, "bucket", "flatscrape/", compactEvery)
+    return open_state
+
+def ids(state, site, *path):
+    for key in path:
+        state = state.get(key, {})
+    return sorted(i for dayIds in state.get(site, {}).values() for i in dayIds)
+
+def test_sent_ids_survive_a_crash_before_finish_run(open_state):
+    store = open_state()
+    store.load()
+    store.record_sent({"ebay": [1, 2], "wggesucht": []})
+    store.record_sent({"wggesucht": [3]}, user="alice")
+    # the run dies here, finish_run is never called
+    state = open_state().load()
+    assert ids(state, "ebay") == [1, 2]
+    assert ids(state, "wggesucht") == [3]
+    assert ids(state, "wggesucht", "users", "alice") == [3]
+
+def test_finish_run_journals_changes(open_state):
+    store = open_state()
+    state = store.load()
+    seenOffers = {"ebay": SeenOfferStore([1]), "wggesucht": SeenOfferStore()}
+    explored = {"ebay": ExploredOffers(), "wggesucht": ExploredOffers()}
+    explored["ebay"].store("https://ebay/search").update([1, 2])
+    state["responseCache"] = {"https://ebay/search": {"hash": "a"}}
+    store.finish_run(state, seenOffers, {"alice": {"ebay": SeenOfferStore([1])}}, explored)
+    state = open_state().load()
+    assert ids(state, "ebay") == [1]
+    assert ids(state, "ebay", "users", "alice") == [1]
+    assert ids(state, "https://ebay/search", "explored", "ebay") == [1, 2]
+    assert state["responseCache"] == {"https://ebay/search": {"hash": "a"}}
+
+def test_sent_ids_are_journaled_once(tmp_path):
+    path = os.path.join(tmp_path, "state.json")
+    store = LocalFileState(path)
+    state = store.load()
+    seenOffers = {"ebay": SeenOfferStore(), "wggesucht": SeenOfferStore()}
+    # as on_sent does with a state store
+    seenOffers["ebay"].update([1, 2], journaled=True)
+    store.record_sent({"ebay": [1, 2]})
+    store.finish_run(state, seenOffers)
+    with open(path + ".journal") as f:
+        records = [json.loads(line) for line in f]
+    assert [record["seen"] for record in records] == [{"ebay": {str(today()): [1, 2]}}]
+    assert ids(LocalFileState(path).load(), "ebay") == [1, 2]
+
+def test_cache_deletions_are_replayed(open_state):
+    store = open_state()
+    state = store.load()
+    state["geocodeCache"] = {"a": [52.5, 13.4], "b": [52.4, 13.3]}
+    store.finish_run(state)
+    store = open_state()
+    state = store.load()
+    del state["geocodeCache"]["a"]
+    store.finish_run(state)
+    assert open_state().load()["geocodeCache"] == {"b": [52.4, 13.3]}
+
+def test_compaction_keeps_the_state(open_state):
+    store = open_state(compactEvery=2)
+    for run in range(3):
+        state = store.load()
+        store.record_sent({"ebay": [run]})
+        state["ebay"] = {str(today()): ids(state, "ebay") + [run]}
+        store.finish_run(state)
+    state = open_state().load()
+    assert ids(state, "ebay") == [0, 1, 2]
+    # compacted after the second run, the third one is journaled
+    assert store._journalLength == 1
+
+def test_replay_twice_has_no_effect():
+    record = {"seen": {"ebay": {str(today()): [1]}},
+              "caches": {"geocodeCache": {"set": {"a": [1, 2]}, "deleted": ["b"]}}}
+    state = {"geocodeCache": {"b": [3, 4]}}
+    once = LocalFileState.replay(copy.deepcopy(state), [record])
+    twice = LocalFileState.replay(copy.deepcopy(state), [record, record])
+    assert once == twice
+
+def test_torn_journal_line_is_skipped(tmp_path):
+    path = os.path.join(tmp_path, "state.json")
+    store = LocalFileState(path)
+    store.load()
+    store.record_sent({"ebay": [1]})
+    with open(path + ".journal", "a") as f:
+        f.write('{"seen": {"ebay"')
+    assert ids(LocalFileState(path).load(), "ebay") == [1]
+
+def test_object_store_reads_one_object_per_run():
+    objectStore = LocalObjectStore()
+    for run in range(3):
+        store = ObjectStoreState(objectStore, "bucket", compactEvery=100)
+        state = store.load()
+        runIds = list(range(run * 10, run * 10 + 10))
+        for offerId in runIds:
+            store.record_sent({"ebay": [offerId]})
+        state["ebay"] = {str(today()): ids(state, "ebay") + runIds}
+        store.finish_run(state)
+    objectStore.requests["get"] = 0
+    state = ObjectStoreState(objectStore, "bucket").load()
+    assert ids(state, "ebay") == list(range(30))
+    # the snapshot (missing) and one journal object per run
+    assert objectStore.requests["get"] == 4
+
+def test_object_store_compacts_by_runs():
+    objectStore = LocalObjectStore()
+    store = ObjectStoreState(objectStore, "bucket", compactEvery=2)
+    for run in range(2):
+        state = store.load()
+        store.record_sent({"ebay": [run]})
+        store.record_sent({"ebay": [run + 10]})
+        state["ebay"] = {str(today()): ids(state, "ebay") + [run, run + 10]}
+        store.finish_run(state)
+    assert [key for (_, key) in objectStore.objects] == ["snapshot.json"]
+    assert ids(ObjectStoreState(objectStore, "bucket").load(), "ebay") == [0, 1, 10, 11]
+
+def test_translations_are_kept_between_runs(open_state):
+    store = open_state()
+    state = store.load()
+    translator = Translator.from_serializable(state.get("translationCache", {}),\
+        backend=StaticBackend())
+    translator.translate_many(["Hallo", "Welt"], "en")
+    state["translationCache"] = translator.to_serializable()
+    store.finish_run(state)
+    backend = StaticBackend()
+    translator = Translator.from_serializable(\
+        open_state().load()["translationCache"], backend=backend)
+    assert translator.translate_many(["Welt", "Hallo"], "en") == ["[en] Welt", "[en] Hallo"]
+    assert backend.requests == 0
@@ -0,0 +1,86 @@
+import logging
+import pages
+from standins import StaticFetchEngine
+import flatscrape
+from geocoding import Geocoder, StaticBackend as StaticGeocoder
+from transport import LocalTransport
+from translation import Translator, StaticBackend as StaticTranslator
+
+logging.disable(logging.WARNING)
+
+URL_A = "https://www.wg-gesucht.de/wg-zimmer-in-Berlin-a.8.0.1.0.html"
+URL_B = "https://www.wg-gesucht.de/wg-zimmer-in-Berlin-b.8.0.1.0.html"
+LIMITS = {"perMinute": 1000, "minInterval": 0, "perChatRate": 1000, "globalRate": 1000}
+
+class BrokenTranslator(Translator):
+    def translate_adverts(self, adverts, language, maxDescriptionLength):
+        raise RuntimeError("translation stage bug")
+
+def run(event, served, state, translator=None):
+    transport = LocalTransport()
+    services = {"fetchEngine": StaticFetchEngine(served),
+                "geocoder": Geocoder(StaticGeocoder({}, default=(52.5, 13.4)), rate=1000),
+                "translator": translator or Translator(StaticTranslator()),
+                "transport": transport}
+    flatscrape.main(event, lambda: state, state.update,
+                    runIds=[flatscrape.ID_WG_SHARE], services=services)
+    return transport
+
+def sent_ids(transport, chatId):
+    """Offer ids in the messages to a chat."""
+    return sorted(offerId for offerId in range(1, 10)
+                  for (_, chat, text) in transport.sent
+                  if chat == chatId and f"Mitte.{offerId}.html" in text)
+
+def overlapping_event():
+    return {"MAX_PAGES": 1, "MESSAGE_LIMITS": LIMITS, "city": "Berlin",
+            "ebayUrls": [], "maxPrice": 5000,
+            "USERS": {
+                "alice": {"TELEGRAM_USER_IDS": [1],
+                          "wggesuchtUrls": {"Flat": [], "WG": [URL_A]}},
+                "bob": {"TELEGRAM_USER_IDS": [2],
+                        "wggesuchtUrls": {"Flat": [], "WG": [URL_B]}}}}
+
+def test_overlapping_urls_reach_all_tenants():
+    served = {URL_A: pages.wggesucht_search_page([1, 2, 3]),
+              URL_B: pages.wggesucht_search_page([1, 2, 3, 4])}
+    transport = run(overlapping_event(), served, {})
+    assert sent_ids(transport, 1) == [1, 2, 3]
+    assert sent_ids(transport, 2) == [1, 2, 3, 4]
+
+def test_offer_on_two_urls_of_a_tenant_is_sent_once():
+    event = overlapping_event()
+    event["USERS"]["bob"]["wggesuchtUrls"]["WG"] = [URL_A, URL_B]
+    served = {URL_A: pages.wggesucht_search_page([1, 2, 3]),
+              URL_B: pages.wggesucht_search_page([1, 2, 3, 4])}
+    transport = run(event, served, {})
+    assert sent_ids(transport, 2) == [1, 2, 3, 4]
+    assert len([chat for (_, chat, _) in transport.sent if chat == 2]) == 4
+
+def test_next_run_sends_only_new_offers():
+    state = {}
+    run(overlapping_event(), {URL_A: pages.wggesucht_search_page([1, 2, 3]),
+                              URL_B: pages.wggesucht_search_page([1, 2, 3, 4])}, state)
+    transport = run(overlapping_event(),
+                    {URL_A: pages.wggesucht_search_page([5, 1, 2, 3]),
+                     URL_B: pages.wggesucht_search_page([1, 2, 3, 4])}, state)
+    assert sent_ids(transport, 1) == [5]
+    assert sent_ids(transport, 2) == []
+
+def test_failing_url_does_not_stop_the_other_tenants():
+    # a layout change on alice's search page
+    broken = pages.wggesucht_search_page([1, 2]).replace(" | Berlin Mitte", "")
+    served = {URL_A: broken, URL_B: pages.wggesucht_search_page([3, 4])}
+    transport = run(overlapping_event(), served, {})
+    assert sent_ids(transport, 2) == [3, 4]
+
+def test_adverts_of_a_failed_stage_are_scraped_again():
+    event = overlapping_event()
+    event["USERS"]["alice"]["LANG"] = "en"
+    served = {URL_A: pages.wggesucht_search_page([1, 2]),
+              URL_B: pages.wggesucht_search_page([3, 4])}
+    state = {}
+    transport = run(event, served, state, BrokenTranslator(StaticTranslator()))
+    assert sent_ids(transport, 1) == [] and sent_ids(transport, 2) == [3, 4]
+    transport = run(event, served, state)
+    assert sent_ids(transport, 1) == [1, 2] and sent_ids(transport, 2) == []
@@ -0,0 +1,22 @@
+import time
+from translation import Translator, StaticBackend
+
+class FlakyBackend(StaticBackend):
+    def translate(self, text, language):
+        if text == "kaputt":
+            raise ValueError("backend error")
+        return super(FlakyBackend, self).translate(text, language)
+
+def test_failing_text_does_not_drop_the_others():
+    translator = Translator(FlakyBackend(), rate=1000)
+    assert translator.translate_many(["Hallo", "kaputt", "Welt"], "en") ==\
+        ["[en] Hallo", "kaputt", "[en] Welt"]
+
+def test_every_request_is_rate_limited():
+    backend = StaticBackend()
+    translator = Translator(backend, rate=10, concurrency=1)
+    start = time.monotonic()
+    translator.translate_many([f"Satz {i}" for i in range(4)], "en")
+    # the first request uses the burst, the others wait for a token each
+    assert time.monotonic() - start >= 0.25
+    assert backend.requests == 4
@@ -0,0 +1,34 @@
+import pytest
+telegram = pytest.importorskip("telegram")
+import telegram.error
+from transport import Broadcaster, PermanentError, TelegramTransport, TransientError
+
+class FailingBot():
+    def __init__(self, error):
+        self.error = error
+        self.calls = 0
+
+    def send_message(self, chatId, text, disable_notification=False):
+        self.calls += 1
+        raise self.error
+
+def transport_with(error):
+    transport = TelegramTransport("token")
+    transport._bot = FailingBot(error)
+    return transport
+
+@pytest.mark.parametrize("error", [telegram.error.BadRequest("Chat not found"),\
+    telegram.error.Unauthorized("Forbidden: bot was blocked by the user"),\
+    telegram.error.ChatMigrated(42)])
+def test_rejected_message_is_not_retried(error):
+    transport = transport_with(error)
+    with pytest.raises(PermanentError):
+        transport.send(1, "text")
+    broadcaster = Broadcaster(transport)
+    assert broadcaster.broadcast([1], "text") == {1: None}
+    broadcaster.close()
+    assert transport._bot.calls == 2
+
+def test_network_errors_are_temporary():
+    with pytest.raises(TransientError):
+        transport_with(telegram.error.TimedOut()).send(1, "text")